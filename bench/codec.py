@@ -0,0 +1,33 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Throughput benchmark for encoding and decoding KEYS listings with each codec in :mod:`zht.codec`.
+
+Run with::
+
+   python bench/codec.py [key count]
+"""
+import sys
+import timeit
+from zht.codec import CODECS
+from zht.table import Table
+
+REPEAT = 5
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    table = Table()
+    for i in range(count):
+        table.putValue("key%08d" % i, "value%08d" % i, 1300000000.0 + i / 3.0)
+    entries = list(table.getEntries(''))
+    print "KEYS listing of %d keys" % (count,)
+    print "%-6s %12s %16s %16s" % ("codec", "bytes", "encode keys/s", "decode keys/s")
+    for name, codec in sorted(CODECS.items()):
+        data = codec.encodeKeys(entries)
+        encode = min(timeit.repeat(lambda: codec.encodeKeys(entries), number=1, repeat=REPEAT))
+        decode = min(timeit.repeat(lambda: codec.decodeKeys(data), number=1, repeat=REPEAT))
+        print "%-6s %12d %16.0f %16.0f" % (name, len(data), count / encode, count / decode)
+
+if __name__ == "__main__":
+    main()
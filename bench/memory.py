@@ -0,0 +1,78 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Memory benchmark for :class:`zht.table.Table`, reporting bytes per key with the old `__dict__`-based entries (hex
+digests, one dict per entry) and with the current slot-based entries (binary digests).
+
+Run with::
+
+   python bench/memory.py [key count]
+"""
+import gc
+import sys
+import types
+from zht import table
+from zht.table import Table, hex_hash
+
+class LegacyTableEntry(object):
+    """
+    A TableEntry laid out the way it was before entries used `__slots__`.
+    """
+    def __init__(self, key, value=None, timestamp=None, digest=None):
+        self._key = key
+        self._hash = hex_hash(key)
+        self._value = value
+        self._timestamp = timestamp
+        self._modified = None
+
+    def putValue(self, value, timestamp):
+        if self._timestamp < timestamp or self._timestamp is None:
+            self._value = value
+            self._timestamp = timestamp
+            return True
+        return False
+
+def deepSizeOf(root):
+    """
+    Return the number of bytes used by every object reachable from `root`, counting shared objects once.
+    """
+    seen = set()
+    pending = [root]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total
+
+def measure(entryClass, count):
+    """
+    Fill a Table using `entryClass` for its entries and return (total bytes per key, overhead bytes per key).
+    """
+    table.TableEntry = entryClass
+    t = Table()
+    payload = 0
+    for i in range(count):
+        key = "key%08d" % i
+        value = "value%08d" % i
+        t.putValue(key, value, float(i))
+        payload += sys.getsizeof(key) + sys.getsizeof(value)
+    total = deepSizeOf(t)
+    return float(total) / count, float(total - payload) / count
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    current = table.TableEntry
+    print "%d keys" % (count,)
+    print "%-24s %12s %16s" % ("entries", "bytes/key", "overhead/key")
+    for name, entryClass in (("__dict__, hex digest", LegacyTableEntry), ("__slots__, binary digest", current)):
+        total, overhead = measure(entryClass, count)
+        print "%-24s %12.1f %16.1f" % (name, total, overhead)
+    table.TableEntry = current
+
+if __name__ == "__main__":
+    main()
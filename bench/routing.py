@@ -0,0 +1,60 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Micro-benchmark comparing the old linear peer/bucket scan used by Node._rget with the prefix trie in
+:mod:`zht.routing`.
+
+Run with::
+
+   python bench/routing.py
+"""
+import random
+import timeit
+from zht.routing import RoutingTable
+from zht.table import hex_hash
+
+PREFIX_LENGTH = 3
+REPLICAS = 3
+LOOKUPS = 2000
+
+def makeCluster(peerCount):
+    """
+    Spread every bucket of length PREFIX_LENGTH over `peerCount` peers, REPLICAS times over.
+
+    :return: A :class:`dict` mapping peer identities to their set of owned bucket prefixes.
+    """
+    peers = dict(("peer%d" % i, set()) for i in range(peerCount))
+    names = sorted(peers)
+    for i in range(16 ** PREFIX_LENGTH):
+        prefix = "%0*x" % (PREFIX_LENGTH, i)
+        for name in random.sample(names, min(REPLICAS, peerCount)):
+            peers[name].add(prefix)
+    return peers
+
+def scanLookup(peers, h):
+    """
+    The lookup Node._rget used to do: try every bucket of every peer.
+    """
+    for pName in peers.keys():
+        for b in peers[pName]:
+            if h.startswith(b):
+                return pName
+
+def main():
+    random.seed(0)
+    hashes = [hex_hash(str(i)) for i in range(LOOKUPS)]
+    print "%6s %14s %14s %8s" % ("peers", "scan us/op", "trie us/op", "speedup")
+    for peerCount in (10, 100, 1000):
+        peers = makeCluster(peerCount)
+        routes = RoutingTable()
+        for name, prefixes in peers.items():
+            routes.setPeerBuckets(name, prefixes)
+        for h in hashes[:100]:
+            assert scanLookup(peers, h) in routes.lookup(h)
+        scan = min(timeit.repeat(lambda: [scanLookup(peers, h) for h in hashes], number=1, repeat=3))
+        trie = min(timeit.repeat(lambda: [routes.lookup(h) for h in hashes], number=1, repeat=3))
+        print "%6d %14.2f %14.2f %7.0fx" % (peerCount, scan * 1e6 / LOOKUPS, trie * 1e6 / LOOKUPS, scan / trie)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Throughput benchmark for a host running several worker processes behind a :class:`~zht.shard.Frontend`, comparing
+batched PUTs and GETs per second with different numbers of workers.
+
+Every worker runs with a single replica, so the workers split the key space between them rather than each storing a
+copy of it, as they would with replicas on other hosts. Throughput can only grow with the number of workers while
+there are free cores for them.
+
+Run with::
+
+   python bench/shards.py [most workers] [client count] [seconds]
+"""
+import os
+import sys
+import tempfile
+import zmq
+from multiprocessing import Process, Queue, cpu_count
+from time import sleep, time
+from zht.shard import startShards
+from zht.shell import ZHTControl
+
+BATCH = 100
+
+def client(identity, index, seconds, results):
+    """
+    Write and read batches of keys through the Frontend for `seconds`, and report how many keys were written and
+    read.
+    """
+    ctx = zmq.Context()
+    control = ZHTControl(ctx, identity)
+    keys = ["client%d-key%d" % (index, i) for i in range(BATCH)]
+    writes = reads = 0
+    deadline = time() + seconds
+    while time() < deadline:
+        control.mput(dict((key, key) for key in keys))
+        writes += BATCH
+        control.get(keys)
+        reads += BATCH
+    control._sock.close()
+    ctx.term()
+    results.put((writes, reads))
+
+def waitUntilReady(control, workers):
+    """
+    Wait until every worker is connected to every other and has taken over its partitions.
+    """
+    while True:
+        shards = control.stats()['shards']
+        if len(shards) == workers and all(stats['peers'] == workers - 1 and not stats['incomingPartitions']
+                                          for stats in shards.values()):
+            return
+        sleep(0.1)
+
+def run(workers, clients, seconds, sockDir):
+    """
+    Start a host of `workers` worker processes, and load it with `clients` client processes.
+
+    :return: A tuple of (keys written per second, keys read per second).
+    """
+    identity = "bench%d" % (workers,)
+    processes = startShards(identity, workers, "ipc://%s/%sREP" % (sockDir, identity),
+                            "ipc://%s/%sPUB" % (sockDir, identity), antiEntropyInterval=None, replicas=1)
+    ctx = zmq.Context()
+    control = ZHTControl(ctx, identity)
+    waitUntilReady(control, workers)
+    results = Queue()
+    loaders = [Process(target=client, args=(identity, i, seconds, results)) for i in range(clients)]
+    for loader in loaders:
+        loader.start()
+    writes = reads = 0
+    for loader in loaders:
+        w, r = results.get()
+        writes += w
+        reads += r
+    for loader in loaders:
+        loader.join()
+    control.EOF()
+    for process in processes:
+        process.join()
+    control._sock.close()
+    ctx.term()
+    # A process may exit before its control socket's ipc file is removed.
+    for name in os.listdir('.'):
+        if name.startswith('.zhtnode-control-%s' % (identity,)):
+            os.remove(name)
+    return writes / float(seconds), reads / float(seconds)
+
+def main():
+    maxWorkers = int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count()
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 2 * maxWorkers
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    sockDir = tempfile.mkdtemp()
+    print "%d cores, %d clients, batches of %d keys, %.0fs per run" % (cpu_count(), clients, BATCH, seconds)
+    print "%-8s %14s %14s %9s" % ("workers", "puts/s", "gets/s", "speedup")
+    baseline = None
+    workers = 1
+    while workers <= maxWorkers:
+        puts, gets = run(workers, clients, seconds, sockDir)
+        baseline = baseline or (puts + gets)
+        print "%-8d %14.0f %14.0f %8.2fx" % (workers, puts, gets, (puts + gets) / baseline)
+        workers *= 2
+    for name in os.listdir(sockDir):
+        os.remove(os.path.join(sockDir, name))
+    os.rmdir(sockDir)
+
+if __name__ == "__main__":
+    main()
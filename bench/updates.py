@@ -0,0 +1,86 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Message-count benchmark for UPDATE dissemination in a fully connected cluster of Nodes over ipc, comparing the
+update forwarding strategies in :data:`zht.node.FORWARDING_STRATEGIES`.
+
+Run with::
+
+   python bench/updates.py [node count] [write count]
+"""
+import gevent
+import os
+import sys
+import tempfile
+from zht.node import Node, FORWARDING_STRATEGIES
+
+def countUpdates(node, counts):
+    """
+    Wrap a Node's SUB handler to count the UPDATE messages it receives.
+    """
+    handleSubMessage = node._handleSubMessage
+    def countingHandler(m):
+        if m[0].startswith('UPDATE|'):
+            counts[0] += 1
+            counts[1] += (len(m) - 2) / 4
+        return handleSubMessage(m)
+    node._handleSubMessage = countingHandler
+
+def run(strategy, nodeCount, writes, sockDir):
+    """
+    Start a cluster, write `writes` keys spread over its Nodes one at a time, and count the UPDATE traffic. Every
+    Node owns every partition, so each update fans out to the whole cluster.
+
+    :return: A tuple of (messages received, update entries received, keys missing) across the cluster.
+    """
+    nodes = []
+    for i in range(nodeCount):
+        identity = "%s%d" % (strategy, i)
+        node = Node(identity, "ipc://%s/%sREP" % (sockDir, identity), "ipc://%s/%sPUB" % (sockDir, identity),
+                    antiEntropyInterval=None, forwarding=strategy, updateInterval=0, replicas=nodeCount)
+        node.start()
+        nodes.append(node)
+    for node in nodes[1:]:
+        nodes[0].connect(node._repAddr)
+    while not all(len(node._peers) == nodeCount - 1 and all(peer.isInitialized() for peer in node._peers.values())
+                  for node in nodes):
+        gevent.sleep(0.1)
+    gevent.sleep(0.5)
+    counts = [0, 0]
+    for node in nodes:
+        countUpdates(node, counts)
+    for i in range(writes):
+        node = nodes[i % nodeCount]
+        key = "key%d" % (i,)
+        node._table[key] = "value%d" % (i,)
+        node._pubUpdate(key)
+        gevent.sleep(0.001)
+    gevent.sleep(1)
+    missing = 0
+    for node in nodes:
+        for i in range(writes):
+            try:
+                node._table.getValue("key%d" % (i,))
+            except (KeyError, NotImplementedError):
+                missing += 1
+        node._greenletPool.kill()
+        node._controlSock.close()
+    return counts[0], counts[1], missing
+
+def main():
+    nodeCount = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    sockDir = tempfile.mkdtemp()
+    print "%d nodes, %d writes" % (nodeCount, writes)
+    print "%-8s %12s %14s %14s %10s" % ("strategy", "messages", "messages/write", "entries/write", "missing")
+    for strategy in FORWARDING_STRATEGIES:
+        messages, entries, missing = run(strategy, nodeCount, writes, sockDir)
+        print "%-8s %12d %14.1f %14.1f %10d" % (strategy, messages, float(messages) / writes,
+                                                float(entries) / writes, missing)
+    for name in os.listdir(sockDir):
+        os.remove(os.path.join(sockDir, name))
+    os.rmdir(sockDir)
+
+if __name__ == "__main__":
+    main()
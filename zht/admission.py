@@ -0,0 +1,123 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Admission control for the messages a Node receives.
+
+Requests and published messages are sorted into traffic classes, each with a :class:`WorkQueue` of its own: a
+bounded queue of waiting messages and a limit on how many are handled at once. A burst of one class, such as the
+synchronization requests every Peer sends a Node that has just restarted, fills only its own queue, so the others
+are still handled promptly. Messages that arrive when their queue is full are shed rather than queued without bound;
+a request is answered with a BUSY error, so the Peer that sent it can back off and retry or fail over.
+"""
+from gevent.pool import Group
+from gevent.queue import Queue, Full
+from time import time
+from latency import LatencyTracker
+import logging
+log = logging.getLogger('zht.admission')
+
+#: The classes of traffic a Node handles separately: reads and writes made for clients ('client'), synchronization
+#: and migration between Peers ('sync'), membership and ownership messages ('membership'), and published updates
+#: ('updates').
+TRAFFIC_CLASSES = ('client', 'sync', 'membership', 'updates')
+
+#: The default (workers, depth) limits of each traffic class: how many of its messages are handled at once, and how
+#: many more may wait.
+DEFAULT_LIMITS = {
+    'client': (64, 1000),
+    'sync': (8, 100),
+    'membership': (8, 100),
+    'updates': (16, 1000),
+}
+
+class WorkQueue(object):
+    """
+    Construct a new, empty WorkQueue.
+
+    Worker greenlets are spawned as work arrives, up to the limit, and exit once the queue is empty. They belong to
+    the WorkQueue's own group rather than the Node's greenlet pool, so submitting work never waits for room in a pool
+    that other traffic has filled.
+
+    :param name: The name of the traffic class, for logging.
+    :param workers: The most items to handle at once.
+    :param depth: The most items to keep waiting. Items submitted beyond it are shed.
+    :param samples: The number of recent queue wait times to keep (see :class:`~zht.latency.LatencyTracker`).
+    """
+    def __init__(self, name, workers, depth, samples=1000):
+        self.name = name
+        self._workers = workers
+        self._queue = Queue(depth)
+        self._greenlets = Group()
+        self._active = 0
+        self._maxDepth = 0
+        self._processed = 0
+        self._shed = 0
+        self._wait = LatencyTracker(samples)
+
+    def submit(self, f, *args):
+        """
+        Queue a call to be made by a worker greenlet.
+
+        :param f: The callable to call.
+        :param args: Arguments to call it with.
+        :return: `True` if the call was queued, `False` if it was shed because the queue is full.
+        """
+        try:
+            self._queue.put_nowait((time(), f, args))
+        except Full:
+            self._shed += 1
+            return False
+        self._maxDepth = max(self._maxDepth, self._queue.qsize())
+        if self._active < self._workers:
+            self._active += 1
+            self._greenlets.spawn(self._work)
+        return True
+
+    def _work(self):
+        """
+        Make queued calls until the queue is empty.
+        """
+        try:
+            while not self._queue.empty():
+                queued, f, args = self._queue.get_nowait()
+                self._wait.add(time() - queued)
+                try:
+                    f(*args)
+                except Exception:
+                    log.exception("Unhandled error in %s work", self.name)
+                self._processed += 1
+        finally:
+            self._active -= 1
+
+    def join(self, timeout=None):
+        """
+        Wait for the worker greenlets to exit, once the queue is empty.
+
+        :param timeout: Seconds to wait at most, or `None` to wait forever.
+        """
+        self._greenlets.join(timeout)
+
+    def kill(self):
+        """
+        Kill the worker greenlets, when the Node shuts down. Items still waiting are dropped.
+        """
+        self._greenlets.kill()
+
+    def stats(self):
+        """
+        :return: A :class:`dict` of the number of items waiting and being handled, the most that have waited at once,
+            the numbers handled and shed, and the times they waited (see :meth:`~zht.latency.LatencyTracker.stats`),
+            for the STATS control command.
+        """
+        return {
+            'depth': self._queue.qsize(),
+            'maxDepth': self._maxDepth,
+            'active': self._active,
+            'processed': self._processed,
+            'shed': self._shed,
+            'wait': self._wait.stats(),
+        }
+
+    def __len__(self):
+        return self._queue.qsize()
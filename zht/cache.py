@@ -0,0 +1,160 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Bounded in-memory caches.
+"""
+from collections import OrderedDict
+from time import time
+
+class RecentSet(object):
+    """
+    Construct a new, empty RecentSet.
+
+    A RecentSet remembers the most recently added items, forgetting the oldest once it holds more than `size`.
+
+    :param size: The maximum number of items to remember.
+    """
+    def __init__(self, size):
+        self._size = size
+        self._items = OrderedDict()
+
+    def add(self, item):
+        """
+        Remember an item.
+
+        :param item: The item to add. It must be hashable.
+        :return: `True` if the item wasn't already remembered, `False` otherwise.
+        """
+        if item in self._items:
+            return False
+        self._items[item] = None
+        if len(self._items) > self._size:
+            self._items.popitem(last=False)
+        return True
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+class NearCache(object):
+    """
+    Construct a new, empty NearCache.
+
+    A NearCache holds values a Node has fetched for keys it doesn't own, so repeated reads of hot remote keys don't
+    need a round trip. It is bounded by the total size of its keys and values, evicting the least recently used
+    entries first. It counts hits and misses for :meth:`stats`.
+
+    :param maxBytes: The maximum total size of the cached keys and values.
+    :param prefixLength: The length of the key hash prefixes reported by :meth:`prefixes`.
+    :param ttl: Seconds after which a cached value is no longer trusted. `None` trusts values until they are
+        evicted or updated.
+    """
+    def __init__(self, maxBytes, prefixLength=1, ttl=None):
+        self._maxBytes = maxBytes
+        self._prefixLength = prefixLength
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._prefixCounts = dict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """
+        Look up a key, counting a hit or a miss.
+
+        :param key: The key to look up.
+        :return: A (value, timestamp) tuple, or `None` if the key isn't cached.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None or (self._ttl is not None and entry[3] + self._ttl < time()):
+            if entry is not None:
+                self._forget(key, entry)
+            self._misses += 1
+            return None
+        self._entries[key] = entry
+        self._hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key, keyHash, value, timestamp):
+        """
+        Cache a value fetched for a key, unless a newer one is already cached.
+
+        :param key: The key.
+        :param keyHash: The hex digest of `key`.
+        :param value: The value.
+        :param timestamp: The timestamp of the value.
+        """
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._forget(key, old)
+            if old[2] > timestamp:
+                value, timestamp = old[1], old[2]
+        size = len(key) + len(value)
+        if size > self._maxBytes:
+            return
+        self._entries[key] = (keyHash, value, timestamp, time())
+        self._bytes += size
+        prefix = keyHash[:self._prefixLength]
+        self._prefixCounts[prefix] = self._prefixCounts.get(prefix, 0) + 1
+        while self._bytes > self._maxBytes:
+            oldKey, oldEntry = self._entries.popitem(last=False)
+            self._forget(oldKey, oldEntry)
+
+    def update(self, key, value, timestamp):
+        """
+        Apply an update for a key, if it is cached and the update is newer.
+
+        :return: `True` if the cached value was replaced.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[2] >= timestamp:
+            return False
+        self.put(key, entry[0], value, timestamp)
+        return True
+
+    def invalidate(self, key):
+        """
+        Drop a key from the cache, if it is cached.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._forget(key, entry)
+
+    def _forget(self, key, entry):
+        """
+        Account for an entry that has been removed from :attr:`_entries`.
+        """
+        self._bytes -= len(key) + len(entry[1])
+        prefix = entry[0][:self._prefixLength]
+        self._prefixCounts[prefix] -= 1
+        if not self._prefixCounts[prefix]:
+            del self._prefixCounts[prefix]
+
+    def prefixes(self):
+        """
+        :return: The set of key hash prefixes (of the configured length) that cached keys fall under.
+        """
+        return set(self._prefixCounts)
+
+    def stats(self):
+        """
+        :return: A :class:`dict` of the number of entries, their size in bytes, and the hits, misses and hit rate.
+        """
+        lookups = self._hits + self._misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hitRate': float(self._hits) / lookups if lookups else 0.0,
+        }
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,331 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+A client that talks to the Nodes that own each key directly.
+
+:class:`~zht.shell.ZHTControl` sends every command through one Node's control socket, and that Node forwards reads
+and writes of keys it doesn't own to their owners, an extra hop for each. A :class:`ZHTClient` instead learns which
+Nodes own which Buckets, with the PEERS and BUCKETS requests Nodes make of each other, and sends each read or write
+straight to an owner's XREP socket. Requests are tagged with request IDs as between Peers, so any number of greenlets
+can have requests outstanding through the same client at once.
+
+A Node that is sent keys it doesn't serve answers with a NotOwner error, after which the client fetches the Bucket map
+again and retries.
+"""
+from gevent_zeromq import zmq
+from gevent import Timeout, spawn, joinall
+from gevent.event import AsyncResult
+from binascii import hexlify
+from itertools import count
+from random import choice
+from routing import RoutingTable
+from table import HASH_FUNCTIONS
+from peer import RequestTimeout, PeerBusy
+from codec import detect
+import logging
+log = logging.getLogger('zht.client')
+
+class NoOwner(Exception):
+    """
+    Raised when no Node is known to own a key, even after fetching the Bucket map again.
+    """
+
+class HashMismatch(Exception):
+    """
+    Raised when a Node refuses a request because the client hashes keys with a different function than the cluster.
+    """
+
+class _Connection(object):
+    """
+    Construct a new _Connection.
+
+    :param ctx: The ZMQ context to create the DEALER socket in.
+    :param addr: The ZMQ address of the Node's XREP socket.
+    """
+    def __init__(self, ctx, addr):
+        self._sock = ctx.socket(zmq.XREQ)
+        self._sock.connect(addr)
+        self._pending = dict()
+        self._requestIds = count()
+        self._reader = spawn(self._handleReplies)
+
+    def _handleReplies(self):
+        """
+        Read replies from the Node and wake up the greenlet waiting on each one.
+        """
+        while True:
+            m = self._sock.recv_multipart()
+            result = self._pending.pop(m[0], None)
+            if result is not None:
+                result.set(m[2:])
+
+    def request(self, req, timeout=None):
+        """
+        Make a request to the Node.
+
+        :param req: The request to send.
+        :param timeout: Seconds to wait for the reply, or `None` to wait forever.
+        :return: The reply.
+        :raise: :class:`~zht.peer.RequestTimeout` if there is no reply in time.
+        """
+        requestId = str(next(self._requestIds))
+        result = AsyncResult()
+        self._pending[requestId] = result
+        self._sock.send_multipart([requestId, ""] + req)
+        try:
+            return result.get(timeout=timeout)
+        except Timeout:
+            self._pending.pop(requestId, None)
+            raise RequestTimeout("No reply to %s request within %ss" % (req[0], timeout))
+
+    def close(self):
+        self._reader.kill()
+        self._sock.close(linger=0)
+
+class ZHTClient(object):
+    """
+    Construct a new ZHTClient, and fetch the Bucket map from the seed Nodes.
+
+    The client must be used from greenlets, since it waits on its sockets with gevent.
+
+    :param seeds: The ZMQ addresses of the XREP sockets of some Nodes in the cluster. The rest are learned from their
+        PEERS replies.
+    :param ctx: The ZMQ Context object to operate from.
+    :param hashFunction: The name of the key hash function the cluster uses (see :data:`~zht.table.HASH_FUNCTIONS`).
+        Nodes check the key hashes they are sent, and refuse requests made with another function (see
+        :class:`HashMismatch`).
+    :param timeout: Seconds to wait for each reply. An owner that doesn't answer in time, or is too busy, is skipped
+        in favour of the other owners of its keys.
+    :param connections: The number of DEALER sockets to keep open to each Node, used in turn.
+    :param retries: The number of times to fetch the Bucket map again and retry keys sent to a Node that doesn't own
+        them.
+    """
+    def __init__(self, seeds, ctx=None, hashFunction='sha1', timeout=5.0, connections=1, retries=2):
+        self._ctx = ctx or zmq.Context.instance()
+        self._hashFunction = hashFunction
+        self._digest = HASH_FUNCTIONS[hashFunction]
+        self._timeout = timeout
+        self._connections = connections
+        self._retries = retries
+        self._pool = dict()
+        self._nextConnection = count()
+        self._addrs = set(seeds)
+        self._routes = RoutingTable()
+        self._refreshes = 0
+        self._staleRoutes = 0
+        self._refreshing = None
+        self.refresh()
+
+    def _connection(self, addr):
+        """
+        :param addr: The XREP address of a Node.
+        :return: A :class:`_Connection` to the Node from the pool, opening one if there are fewer than allowed.
+        """
+        connections = self._pool.setdefault(addr, [])
+        if len(connections) < self._connections:
+            connections.append(_Connection(self._ctx, addr))
+            return connections[-1]
+        return connections[next(self._nextConnection) % len(connections)]
+
+    def _request(self, addr, req):
+        """
+        Make a request to a Node.
+
+        :raise: :class:`~zht.peer.PeerBusy` if the Node is too busy to handle it,
+            :class:`~zht.peer.RequestTimeout` if it doesn't answer in time, or :class:`HashMismatch` if it uses a
+            different key hash function.
+        """
+        reply = self._connection(addr).request(req, self._timeout)
+        if reply[:2] == ["ERROR", "Busy"]:
+            raise PeerBusy("%s was too busy for a %s request" % (addr, req[0]))
+        if reply[:2] == ["ERROR", "HashMismatch"]:
+            raise HashMismatch("%s hashes keys with '%s', not '%s'" % (addr, reply[3], self._hashFunction))
+        return reply
+
+    def refresh(self):
+        """
+        Fetch the Bucket map from every Node known of, learning of other Nodes from their PEERS replies.
+
+        Nodes that don't answer are left out of the map until they answer a later refresh. Greenlets that ask for a
+        refresh while one is under way wait for it instead of starting another.
+        """
+        if self._refreshing is not None:
+            self._refreshing.get()
+            return
+        self._refreshing = AsyncResult()
+        try:
+            self._refreshes += 1
+            fetched = set()
+            while self._addrs - fetched:
+                addrs = self._addrs - fetched
+                joinall([spawn(self._fetchNode, addr) for addr in addrs])
+                fetched.update(addrs)
+            log.debug("Fetched the Bucket map from %d nodes", len(fetched))
+        finally:
+            self._refreshing.set()
+            self._refreshing = None
+
+    def _fetchNode(self, addr):
+        """
+        Learn the Nodes a Node knows of, and the Buckets it serves.
+
+        :param addr: The XREP address of the Node.
+        """
+        try:
+            reply = self._request(addr, ["PEERS"])
+            self._addrs.update(detect(reply[1:]).decodePeers(reply[1]).values())
+            reply = self._request(addr, ["BUCKETS"])
+            self._routes.setPeerBuckets(addr, detect(reply[1:]).decodeBuckets(reply[1]))
+        except RequestTimeout:
+            log.warning("Node %s didn't answer, leaving it out of the Bucket map", addr)
+            self._routes.setPeerBuckets(addr, [])
+
+    def _groupByOwner(self, keys, exclude=()):
+        """
+        Group keys by a Node that owns each, chosen at random among the owners.
+
+        :param keys: A list of (key, key hash) tuples.
+        :param exclude: The addresses of Nodes not to choose.
+        :return: A :class:`dict` mapping Node addresses to lists of (key, key hash) tuples, and a list of the keys that
+            no Node is known to own.
+        """
+        byNode = dict()
+        unowned = []
+        for key, keyHash in keys:
+            owners = [addr for addr in self._routes.lookup(keyHash) if not addr in exclude]
+            if owners:
+                byNode.setdefault(choice(owners), []).append((key, keyHash))
+            else:
+                unowned.append((key, keyHash))
+        return byNode, unowned
+
+    def _route(self, keys, send, exclude=(), attempt=0):
+        """
+        Send keys to their owners, and retry any that a Node refused because it doesn't own them.
+
+        :param keys: A list of (key, key hash) tuples.
+        :param send: A function taking a Node address and a list of (key, key hash) tuples, returning the keys to
+            send again if the Node refused them because it doesn't own some of them.
+        :param exclude: The addresses of Nodes that have already failed to answer.
+        :param attempt: The number of times the Bucket map has been fetched again for these keys.
+        :raise: :class:`NoOwner` if no Node is known to own some of the keys.
+        """
+        byNode, unowned = self._groupByOwner(keys, exclude)
+        if unowned:
+            if attempt >= self._retries:
+                raise NoOwner("No node is known to own %d keys" % (len(unowned),))
+            self.refresh()
+            self._route(unowned, send, exclude, attempt + 1)
+        requests = [(addr, nodeKeys, spawn(send, addr, nodeKeys)) for addr, nodeKeys in byNode.items()]
+        joinall([request for addr, nodeKeys, request in requests])
+        stale = []
+        failed = []
+        for addr, nodeKeys, request in requests:
+            if isinstance(request.exception, RequestTimeout):
+                log.info("Node %s didn't answer, trying the other owners of %d keys", addr, len(nodeKeys))
+                failed.append((addr, nodeKeys))
+            elif not request.successful():
+                raise request.exception
+            elif request.value:
+                stale.extend(request.value)
+        for addr, nodeKeys in failed:
+            tried = set(exclude) | set([addr])
+            if self._groupByOwner(nodeKeys, tried)[1]:
+                raise RequestTimeout("No owner of some of %d keys answered in time" % (len(nodeKeys),))
+            self._route(nodeKeys, send, tried, attempt)
+        if stale:
+            self._staleRoutes += 1
+            if attempt >= self._retries:
+                raise NoOwner("The owners of %d keys kept moving" % (len(stale),))
+            self.refresh()
+            self._route(stale, send, exclude, attempt + 1)
+
+    def keyHash(self, key):
+        """
+        :return: The hex digest of a key, using the cluster's hash function.
+        """
+        return hexlify(self._digest(key))
+
+    def mget(self, keys):
+        """
+        Look up several keys on the Nodes that own them, with one request per Node.
+
+        :param keys: An iterable of keys.
+        :return: A :class:`dict` mapping each key that was found to its value.
+        """
+        found = dict()
+        def send(addr, nodeKeys):
+            req = ["MGET-CLIENT"]
+            for key, keyHash in nodeKeys:
+                req.extend((key, keyHash))
+            reply = self._request(addr, req)
+            if reply[:2] == ["ERROR", "NotOwner"]:
+                return nodeKeys
+            for key, value, timestamp in detect(reply[1:]).decodeValues(reply[1:]):
+                found[key] = value
+            return []
+        self._route([(key, self.keyHash(key)) for key in keys], send)
+        return found
+
+    def get(self, key):
+        """
+        Look up a key on a Node that owns it.
+
+        :return: The key's value.
+        :raise: :class:`KeyError` if the key has no value.
+        """
+        return self.mget([key])[key]
+
+    def mput(self, items):
+        """
+        Store several entries on the Nodes that own them, with one request per Node. Each Node stores the entries on
+        the other owners as well.
+
+        :param items: A :class:`dict` or list of (key, value) pairs to store.
+        :return: The number of entries that were stored.
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        values = dict(items)
+        stored = [0]
+        def send(addr, nodeKeys):
+            req = ["MPUT-CLIENT"]
+            for key, keyHash in nodeKeys:
+                req.extend((key, keyHash, values[key]))
+            reply = self._request(addr, req)
+            if reply[:2] == ["ERROR", "NotOwner"]:
+                return nodeKeys
+            stored[0] += int(reply[1])
+            return []
+        self._route([(key, self.keyHash(key)) for key in values], send)
+        return stored[0]
+
+    def put(self, key, value):
+        """
+        Store a value on the Nodes that own a key.
+
+        :return: `True` if it was stored.
+        """
+        return self.mput([(key, value)]) == 1
+
+    def stats(self):
+        """
+        :return: A :class:`dict` of the number of Nodes known of, connections open, Bucket map fetches and requests
+            that were sent to a Node that doesn't own their keys.
+        """
+        return {
+            'nodes': len(self._addrs),
+            'connections': sum(len(connections) for connections in self._pool.values()),
+            'refreshes': self._refreshes,
+            'staleRoutes': self._staleRoutes,
+        }
+
+    def close(self):
+        """
+        Close every connection.
+        """
+        for connections in self._pool.values():
+            for connection in connections:
+                connection.close()
+        self._pool.clear()
@@ -0,0 +1,260 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Encodings for the payloads of peer protocol messages.
+
+Nodes agree on a codec in the PEER handshake (see :doc:`/RequestProtocol`). :class:`JSONCodec` is the original text
+encoding that every Node understands. :class:`BinaryCodec` packs the same payloads into versioned binary frames:
+fixed-width binary digests, float64 timestamps and length-prefixed strings, so large KEYS listings are cheap to
+encode and decode.
+
+Binary payloads always start with a version byte and JSON payloads never do, so a receiver can tell them apart with
+:func:`detect` whatever codec it negotiated.
+"""
+from binascii import hexlify, unhexlify
+import json
+import struct
+
+class JSONCodec(object):
+    """
+    The original encoding: JSON documents, hex digests and `repr` timestamps, one frame per field.
+    """
+    name = 'json'
+
+    def encodePeers(self, peers):
+        """
+        :param peers: A :class:`dict` mapping peer identities to XREP addresses.
+        :return: A PEERS payload frame.
+        """
+        return json.dumps(peers)
+
+    def decodePeers(self, data):
+        return dict((str(identity), str(addr)) for identity, addr in json.loads(data).items())
+
+    def encodeBuckets(self, prefixes):
+        """
+        :param prefixes: An iterable of bucket prefixes.
+        :return: A BUCKETS payload frame.
+        """
+        return json.dumps(list(prefixes))
+
+    def decodeBuckets(self, data):
+        return [str(prefix) for prefix in json.loads(data)]
+
+    def encodeKeys(self, entries):
+        """
+        :param entries: An iterable of :class:`~zht.table.TableEntry` objects.
+        :return: A KEYS payload frame.
+        """
+        return json.dumps(dict((entry._key, (entry._timestamp, entry._hash)) for entry in entries))
+
+    def decodeKeys(self, data):
+        """
+        :return: A :class:`list` of (key, timestamp, key hash) tuples.
+        """
+        return [(str(key), timestamp, str(keyHash)) for key, (timestamp, keyHash) in json.loads(data).items()]
+
+    def encodeTree(self, levels):
+        """
+        :param levels: A :class:`dict` mapping prefixes to lists of hash tree digests.
+        :return: A TREE payload frame.
+        """
+        return json.dumps(dict((prefix, ["%x" % (digest,) for digest in digests])
+                               for prefix, digests in levels.items()))
+
+    def decodeTree(self, data):
+        return dict((str(prefix), [int(digest, 16) for digest in digests])
+                    for prefix, digests in json.loads(data).items())
+
+    def encodeValues(self, entries):
+        """
+        :param entries: An iterable of :class:`~zht.table.TableEntry` objects.
+        :return: The frames of an MGET reply payload.
+        """
+        frames = []
+        for entry in entries:
+            frames.extend((entry._key, entry._value, repr(entry._timestamp)))
+        return frames
+
+    def decodeValues(self, frames):
+        """
+        :return: A :class:`list` of (key, value, timestamp) tuples.
+        """
+        return [(frames[i], frames[i+1], float(frames[i+2])) for i in range(0, len(frames) - 2, 3)]
+
+    def encodeStores(self, stores):
+        """
+        :param stores: An iterable of (key, key hash, value, timestamp) tuples.
+        :return: The frames of an MPUT request payload.
+        """
+        frames = []
+        for key, keyHash, value, timestamp in stores:
+            frames.extend((key, keyHash, value, repr(timestamp)))
+        return frames
+
+    def decodeStores(self, frames):
+        """
+        :return: A :class:`list` of (key, key hash, value, timestamp) tuples.
+        """
+        return [(frames[i], frames[i+1], frames[i+2], float(frames[i+3])) for i in range(0, len(frames) - 3, 4)]
+
+_byte = struct.Struct('<B')
+_short = struct.Struct('<H')
+_keyHeader = struct.Struct('<dI')
+_valueHeader = struct.Struct('<dII')
+
+class BinaryCodec(object):
+    """
+    Version 1 of the binary encoding. Every payload is a single frame, starting with the version byte.
+    """
+    name = 'bin1'
+    VERSION = '\x01'
+
+    def _packStrings(self, strings, header):
+        return self.VERSION + "".join(header.pack(len(s)) + s for s in strings)
+
+    def _unpackStrings(self, data, header):
+        strings = []
+        offset = 1
+        while offset < len(data):
+            length, = header.unpack_from(data, offset)
+            offset += header.size
+            strings.append(data[offset:offset + length])
+            offset += length
+        return strings
+
+    def encodePeers(self, peers):
+        strings = []
+        for identity, addr in peers.items():
+            strings.extend((identity, addr))
+        return self._packStrings(strings, _short)
+
+    def decodePeers(self, data):
+        strings = self._unpackStrings(data, _short)
+        return dict(zip(strings[::2], strings[1::2]))
+
+    def encodeBuckets(self, prefixes):
+        return self._packStrings(prefixes, _byte)
+
+    def decodeBuckets(self, data):
+        return self._unpackStrings(data, _byte)
+
+    def encodeKeys(self, entries):
+        """
+        The version byte is followed by the digest length, then by a header of the timestamp and key length, the
+        binary digest and the key for each entry.
+        """
+        parts = []
+        digestLength = 0
+        for entry in entries:
+            digestLength = len(entry._digest)
+            parts.append(_keyHeader.pack(entry._timestamp, len(entry._key)) + entry._digest + entry._key)
+        return self.VERSION + _byte.pack(digestLength) + "".join(parts)
+
+    def decodeKeys(self, data):
+        digestLength, = _byte.unpack_from(data, 1)
+        keys = []
+        offset = 2
+        while offset < len(data):
+            timestamp, keyLength = _keyHeader.unpack_from(data, offset)
+            offset += _keyHeader.size
+            digest = data[offset:offset + digestLength]
+            offset += digestLength
+            keys.append((data[offset:offset + keyLength], timestamp, hexlify(digest)))
+            offset += keyLength
+        return keys
+
+    def encodeTree(self, levels):
+        parts = [self.VERSION]
+        for prefix, digests in levels.items():
+            parts.append(_byte.pack(len(prefix)) + prefix + _byte.pack(len(digests)) +
+                         struct.pack('<%dQ' % (len(digests),), *digests))
+        return "".join(parts)
+
+    def decodeTree(self, data):
+        levels = dict()
+        offset = 1
+        while offset < len(data):
+            length, = _byte.unpack_from(data, offset)
+            prefix = data[offset + 1:offset + 1 + length]
+            offset += 1 + length
+            count, = _byte.unpack_from(data, offset)
+            levels[prefix] = list(struct.unpack_from('<%dQ' % (count,), data, offset + 1))
+            offset += 1 + 8 * count
+        return levels
+
+    def encodeValues(self, entries):
+        return [self.VERSION + "".join(_valueHeader.pack(entry._timestamp, len(entry._key), len(entry._value)) +
+                                       entry._key + entry._value for entry in entries)]
+
+    def decodeValues(self, frames):
+        data = frames[0]
+        values = []
+        offset = 1
+        while offset < len(data):
+            timestamp, keyLength, valueLength = _valueHeader.unpack_from(data, offset)
+            offset += _valueHeader.size
+            values.append((data[offset:offset + keyLength], data[offset + keyLength:offset + keyLength + valueLength],
+                           timestamp))
+            offset += keyLength + valueLength
+        return values
+
+    def encodeStores(self, stores):
+        """
+        The version byte is followed by the digest length, then by a header of the timestamp, key length and value
+        length, the binary digest, the key and the value for each store.
+        """
+        parts = []
+        digestLength = 0
+        for key, keyHash, value, timestamp in stores:
+            digest = unhexlify(keyHash)
+            digestLength = len(digest)
+            parts.append(_valueHeader.pack(timestamp, len(key), len(value)) + digest + key + value)
+        return [self.VERSION + _byte.pack(digestLength) + "".join(parts)]
+
+    def decodeStores(self, frames):
+        data = frames[0]
+        digestLength, = _byte.unpack_from(data, 1)
+        stores = []
+        offset = 2
+        while offset < len(data):
+            timestamp, keyLength, valueLength = _valueHeader.unpack_from(data, offset)
+            offset += _valueHeader.size
+            keyHash = hexlify(data[offset:offset + digestLength])
+            offset += digestLength
+            stores.append((data[offset:offset + keyLength], keyHash,
+                           data[offset + keyLength:offset + keyLength + valueLength], timestamp))
+            offset += keyLength + valueLength
+        return stores
+
+# Codecs by name. A Node offers these in the PEER handshake, in its order of preference.
+CODECS = {
+    JSONCodec.name: JSONCodec(),
+    BinaryCodec.name: BinaryCodec(),
+}
+
+def detect(frames):
+    """
+    Return the codec that encoded a payload.
+
+    :param frames: The frames of the payload.
+    :return: A codec from :data:`CODECS`.
+    """
+    if len(frames) == 1 and frames[0][:1] == BinaryCodec.VERSION:
+        return CODECS[BinaryCodec.name]
+    return CODECS[JSONCodec.name]
+
+def negotiate(offered, accepted):
+    """
+    Choose the codec to use with a Peer.
+
+    :param offered: A comma-separated list of codec names offered by the Peer, most preferred first. An empty
+        string means the Peer predates codec negotiation.
+    :param accepted: The names of the codecs this Node is willing to use.
+    :return: The first offered codec that is also accepted, or the JSON codec if there is none.
+    """
+    for name in offered.split(","):
+        if name in accepted and name in CODECS:
+            return CODECS[name]
+    return CODECS[JSONCodec.name]
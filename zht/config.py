@@ -6,6 +6,7 @@ Handle configuring ZHT from the command line and from configuration files
 """
 from argparse import ArgumentParser
 import ConfigParser
+import json
 
 _argParser = ArgumentParser("DHT Node")
 _argParser.add_argument('--bindAddrREP', '-r')
@@ -14,6 +15,82 @@ _argParser.add_argument('--connectAddr', '-c', required=False)
 _argParser.add_argument('--identity', '-i', required=False)
 _argParser.add_argument('--config', '-C', default='.zhtrc', required=False)
 _argParser.add_argument('--loggingConfig', '-l', default='.zhtloggingrc', required=False)
+_argParser.add_argument('--shards', '-s', required=False)
+_argParser.add_argument('--antiEntropyInterval', required=False)
+_argParser.add_argument('--splitEntries', required=False)
+_argParser.add_argument('--splitBytes', required=False)
+_argParser.add_argument('--hashFunction', required=False)
+_argParser.add_argument('--storageDir', required=False)
+_argParser.add_argument('--snapshotDir', required=False)
+_argParser.add_argument('--fsyncPolicy', required=False)
+_argParser.add_argument('--fsyncInterval', required=False)
+_argParser.add_argument('--snapshotInterval', required=False)
+_argParser.add_argument('--updateInterval', required=False)
+_argParser.add_argument('--updateBatchSize', required=False)
+_argParser.add_argument('--forwarding', required=False)
+_argParser.add_argument('--gossipProbability', required=False)
+_argParser.add_argument('--dedupSize', required=False)
+_argParser.add_argument('--nearCacheBytes', required=False)
+_argParser.add_argument('--nearCacheTTL', required=False)
+_argParser.add_argument('--replicas', required=False)
+_argParser.add_argument('--handoffTimeout', required=False)
+_argParser.add_argument('--migrationRate', required=False)
+_argParser.add_argument('--migrationChunkSize', required=False)
+_argParser.add_argument('--hedgePercentile', required=False)
+_argParser.add_argument('--hedgeDelay', required=False)
+_argParser.add_argument('--latencySamples', required=False)
+_argParser.add_argument('--codec', required=False)
+_argParser.add_argument('--requestTimeout', required=False)
+_argParser.add_argument('--requestRetries', required=False)
+_argParser.add_argument('--readTimeout', required=False)
+_argParser.add_argument('--controlTimeout', required=False)
+_argParser.add_argument('--heartbeatInterval', required=False)
+_argParser.add_argument('--suspectPhi', required=False)
+_argParser.add_argument('--deadPhi', required=False)
+_argParser.add_argument('--activeViewSize', required=False)
+_argParser.add_argument('--shuffleInterval', required=False)
+_argParser.add_argument('--shuffleLength', required=False)
+_argParser.add_argument('--admissionLimits', required=False)
+_argParser.add_argument('--tombstoneTTL', required=False)
+
+# Options passed through to the Node constructor, with the type to convert each one to.
+_nodeOptions = {
+    'antiEntropyInterval': float,
+    'splitEntries': int,
+    'splitBytes': int,
+    'hashFunction': str,
+    'storageDir': str,
+    'snapshotDir': str,
+    'fsyncPolicy': str,
+    'fsyncInterval': float,
+    'snapshotInterval': float,
+    'updateInterval': float,
+    'updateBatchSize': int,
+    'forwarding': str,
+    'gossipProbability': float,
+    'dedupSize': int,
+    'nearCacheBytes': int,
+    'nearCacheTTL': float,
+    'replicas': int,
+    'handoffTimeout': float,
+    'migrationRate': float,
+    'migrationChunkSize': int,
+    'hedgePercentile': float,
+    'hedgeDelay': float,
+    'latencySamples': int,
+    'codec': str,
+    'requestTimeout': float,
+    'requestRetries': int,
+    'readTimeout': float,
+    'heartbeatInterval': float,
+    'suspectPhi': float,
+    'deadPhi': float,
+    'activeViewSize': int,
+    'shuffleInterval': float,
+    'shuffleLength': int,
+    'admissionLimits': json.loads,
+    'tombstoneTTL': float,
+}
 
 
 class ZHTConfig(ConfigParser.SafeConfigParser):
@@ -48,3 +125,15 @@ class ZHTConfig(ConfigParser.SafeConfigParser):
         except ConfigParser.NoOptionError:
             return None
 
+    def nodeOptions(self):
+        """
+        Get the optional :class:`~zht.node.Node` settings that have been configured.
+
+        :return: A :class:`dict` of keyword arguments for :class:`~zht.node.Node`, converted to the right types.
+        """
+        options = dict()
+        for option, optionType in _nodeOptions.items():
+            value = self[option]
+            if value is not None:
+                options[option] = optionType(value)
+        return options
@@ -0,0 +1,93 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Partial views for gossip membership.
+
+By default every Node connects to every other Node it hears of, so each Node holds a DEALER socket and a SUB
+connection per Node in the cluster, and receives every Node's heartbeats. With a :class:`PartialView`, a Node only
+connects to a bounded, random set of neighbours, its active view, in the manner of HyParView. New Nodes are
+announced by PEER messages that each Node passes on to its own neighbours the first time it hears of them, so they
+reach the whole cluster epidemically, and neighbours periodically exchange random samples of the Nodes they know of
+(a shuffle) to repair announcements that were missed.
+
+Every Node still knows the identity and address of every other (which costs no sockets), so partition ownership is
+computed the same way everywhere. Besides its neighbours, a Node only connects to the owners of the partitions it
+owns, and to one owner of each other partition to route requests through, so the number of connections it holds is
+bounded by the size of the active view and the number of partitions, not the size of the cluster.
+"""
+from random import sample, shuffle
+
+class PartialView(object):
+    """
+    Construct a new, empty PartialView.
+
+    :param size: The most neighbours to keep in the active view. Gossip messages reach the cluster through them, so
+        this is the fanout of dissemination; a few more than the logarithm of the expected cluster size keeps the
+        overlay connected when Nodes fail.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.active = set()
+
+    def isFull(self):
+        """
+        :return: `True` if no more neighbours can be added.
+        """
+        return len(self.active) >= self.size
+
+    def add(self, identity):
+        """
+        Add a neighbour, if there is room.
+
+        :param identity: The identity string of the Node.
+        :return: `True` if the Node is a neighbour now.
+        """
+        if identity in self.active:
+            return True
+        if self.isFull():
+            return False
+        self.active.add(identity)
+        return True
+
+    def remove(self, identity):
+        """
+        Remove a neighbour, when it fails or leaves.
+
+        :param identity: The identity string of the Node.
+        """
+        self.active.discard(identity)
+
+    def candidates(self, known, exclude=()):
+        """
+        List the Nodes that could replace failed neighbours, in random order.
+
+        :param known: The identities of every Node known of.
+        :param exclude: Identities to leave out, such as this Node's own.
+        :return: A :class:`list` of the known identities that aren't neighbours.
+        """
+        candidates = [identity for identity in known if not identity in self.active and not identity in exclude]
+        shuffle(candidates)
+        return candidates
+
+    def sample(self, known, size):
+        """
+        Choose Nodes to send in a shuffle.
+
+        :param known: A :class:`dict` mapping the identity of every Node known of to its XREP address.
+        :param size: The most Nodes to choose.
+        :return: A :class:`dict` of up to `size` entries of `known`, chosen at random.
+        """
+        return dict(sample(known.items(), min(size, len(known))))
+
+    def stats(self):
+        """
+        :return: A :class:`dict` of the size and limit of the active view, for the STATS control command.
+        """
+        return {'active': len(self.active), 'size': self.size}
+
+    def __contains__(self, identity):
+        return identity in self.active
+
+    def __len__(self):
+        return len(self.active)
@@ -0,0 +1,53 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Latency measurement.
+"""
+from collections import deque
+from math import ceil
+
+class LatencyTracker(object):
+    """
+    Construct a new, empty LatencyTracker.
+
+    A LatencyTracker keeps the most recent `size` request latencies, so percentiles of how long requests usually take
+    can be read off it. A Node uses one to decide how long to wait for a Peer before hedging a read.
+
+    :param size: The number of latencies to keep.
+    """
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        """
+        Record the latency of a request.
+
+        :param seconds: How long the request took.
+        """
+        self._samples.append(seconds)
+
+    def percentile(self, percent):
+        """
+        :param percent: The percentile to return, from 0 to 100.
+        :return: The latency that `percent` percent of the recorded latencies are no longer than, or `None` if none
+            have been recorded.
+        """
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[max(0, int(ceil(len(ordered) * percent / 100.0)) - 1)]
+
+    def stats(self):
+        """
+        :return: A :class:`dict` of the number of latencies recorded and their 50th, 95th and 99th percentiles.
+        """
+        return {
+            'samples': len(self._samples),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+    def __len__(self):
+        return len(self._samples)
@@ -0,0 +1,174 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Failure detection from heartbeats.
+
+Every Node publishes a HEARTBEAT at a regular interval. A :class:`PhiAccrualDetector` per Peer turns the arrival
+times of its heartbeats into a suspicion level, phi, that grows the longer the next heartbeat is overdue compared to
+how regularly they have been arriving. A :class:`Membership` keeps one for each Peer and classifies each Peer as
+alive, suspect or dead by thresholds on phi.
+"""
+from collections import deque
+from math import exp, log10, sqrt
+from time import time
+
+#: The states a Peer can be in, from least to most suspicious. Only alive Peers are routed to.
+MEMBER_STATES = ('alive', 'suspect', 'dead')
+
+# The phi reported for a heartbeat so overdue that its probability of arriving underflows.
+_MAX_PHI = 100.0
+
+class PhiAccrualDetector(object):
+    """
+    Construct a new PhiAccrualDetector.
+
+    The intervals between recent heartbeats are assumed to be normally distributed. Phi is -log10 of the probability
+    that the next heartbeat would be at least as late as it is now, so a phi of 1 means a 10% chance of it still
+    coming, 2 a 1% chance, and so on. Until heartbeats have arrived, the expected interval is assumed.
+
+    :param interval: The expected seconds between heartbeats.
+    :param samples: The number of recent intervals to keep.
+    :param minDeviation: The least standard deviation to assume, in seconds, so perfectly regular heartbeats don't
+        make a slight delay look like a failure. Defaults to a tenth of `interval`.
+    :param now: The time to start waiting for the first heartbeat from.
+    """
+    def __init__(self, interval, samples=200, minDeviation=None, now=None):
+        self._intervals = deque([float(interval)], maxlen=samples)
+        self._minDeviation = minDeviation or interval / 10.0
+        self.last = time() if now is None else now
+
+    def heartbeat(self, now=None):
+        """
+        Record the arrival of a heartbeat.
+
+        :param now: The arrival time. Defaults to the current time.
+        """
+        now = time() if now is None else now
+        self._intervals.append(now - self.last)
+        self.last = now
+
+    def phi(self, now=None):
+        """
+        :param now: The time to compute phi at. Defaults to the current time.
+        :return: The suspicion level that the heartbeats have stopped.
+        """
+        elapsed = (time() if now is None else now) - self.last
+        mean = sum(self._intervals) / len(self._intervals)
+        variance = sum((interval - mean) ** 2 for interval in self._intervals) / len(self._intervals)
+        deviation = max(sqrt(variance), self._minDeviation)
+        # A logistic approximation of the normal distribution's tail.
+        y = (elapsed - mean) / deviation
+        try:
+            e = exp(-y * (1.5976 + 0.070566 * y * y))
+        except OverflowError:
+            return 0.0
+        if elapsed > mean:
+            p = e / (1.0 + e)
+        else:
+            p = 1.0 - 1.0 / (1.0 + e)
+        if p <= 0:
+            return _MAX_PHI
+        return min(_MAX_PHI, -log10(p))
+
+class Membership(object):
+    """
+    Construct a new, empty Membership.
+
+    :param interval: The seconds between heartbeats that each Peer is expected to publish.
+    :param suspectPhi: The phi at which a Peer is suspected of having failed. Suspect Peers are still members, but
+        aren't sent requests.
+    :param deadPhi: The phi at which a Peer is taken to have failed.
+    :param samples: The number of recent heartbeat intervals to keep per Peer.
+    """
+    def __init__(self, interval, suspectPhi=5.0, deadPhi=12.0, samples=200):
+        self._interval = interval
+        self._suspectPhi = suspectPhi
+        self._deadPhi = deadPhi
+        self._samples = samples
+        self._detectors = dict()
+        self._states = dict()
+
+    def add(self, identity, now=None):
+        """
+        Start watching a Peer's heartbeats. It is alive until they are overdue.
+
+        :param identity: The identity string of the Peer.
+        :param now: The time it joined. Defaults to the current time.
+        """
+        self._detectors[identity] = PhiAccrualDetector(self._interval, self._samples, now=now)
+        self._states[identity] = 'alive'
+
+    def remove(self, identity):
+        """
+        Stop watching a Peer.
+
+        :param identity: The identity string of the Peer.
+        """
+        self._detectors.pop(identity, None)
+        self._states.pop(identity, None)
+
+    def heartbeat(self, identity, now=None):
+        """
+        Record a heartbeat from a Peer. Heartbeats from Peers that aren't watched are ignored.
+
+        :param identity: The identity string of the Peer.
+        :param now: The arrival time. Defaults to the current time.
+        """
+        detector = self._detectors.get(identity)
+        if detector is not None:
+            detector.heartbeat(now)
+
+    def isAlive(self, identity):
+        """
+        :return: `True` if a Peer was alive when the states were last updated, or isn't watched.
+        """
+        return self._states.get(identity, 'alive') == 'alive'
+
+    def state(self, identity, now=None):
+        """
+        :param identity: The identity string of a watched Peer.
+        :param now: The time to judge the Peer at. Defaults to the current time.
+        :return: The Peer's state, from :data:`MEMBER_STATES`.
+        """
+        phi = self._detectors[identity].phi(now)
+        if phi >= self._deadPhi:
+            return 'dead'
+        elif phi >= self._suspectPhi:
+            return 'suspect'
+        return 'alive'
+
+    def update(self, now=None):
+        """
+        Judge every watched Peer again.
+
+        :param now: The time to judge the Peers at. Defaults to the current time.
+        :return: A :class:`list` of (identity, old state, new state) tuples for the Peers whose state changed.
+        """
+        now = time() if now is None else now
+        changes = []
+        for identity in list(self._detectors):
+            state = self.state(identity, now)
+            if state != self._states[identity]:
+                changes.append((identity, self._states[identity], state))
+                self._states[identity] = state
+        return changes
+
+    def view(self, now=None):
+        """
+        :param now: The time to judge the Peers at. Defaults to the current time.
+        :return: A :class:`dict` mapping the identity of each watched Peer to a :class:`dict` of its state, phi and
+            the seconds since its last heartbeat, for the MEMBERS control command.
+        """
+        now = time() if now is None else now
+        return dict((identity, {
+            'state': self.state(identity, now),
+            'phi': detector.phi(now),
+            'lastHeartbeat': now - detector.last,
+        }) for identity, detector in self._detectors.items())
+
+    def __contains__(self, identity):
+        return identity in self._detectors
+
+    def __len__(self):
+        return len(self._detectors)
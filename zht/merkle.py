@@ -0,0 +1,71 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Hash trees used to find the differences between two copies of a bucket without comparing every key.
+
+Each entry in a :class:`~zht.table.Bucket` contributes a 64-bit digest of its key hash and timestamp. A tree node's
+digest is the XOR of the digests of every entry whose key hash falls under that node's prefix. XOR makes updates
+incremental (an update just XORs out the old entry digest and XORs in the new one along a single path) and makes the
+digest of any prefix the XOR of the digests of its children, whichever bucket they happen to live in.
+"""
+import hashlib
+
+HEX_DIGITS = "0123456789abcdef"
+
+def entryDigest(keyHash, timestamp):
+    """
+    Return the digest an entry contributes to its :class:`HashTree`.
+
+    :param keyHash: The hex digest of the entry's key.
+    :param timestamp: The entry's timestamp.
+    """
+    return int(hashlib.sha1("%s|%r" % (keyHash, timestamp)).hexdigest()[:16], 16)
+
+class HashTree(object):
+    """
+    Construct a new, empty HashTree.
+
+    :param depth: The number of hex digits below the tree's root that the tree descends. A tree of depth `d` has
+        `16 ** d` leaves.
+    """
+    def __init__(self, depth):
+        self._depth = depth
+        self._levels = [[0] * (16 ** level) for level in range(depth + 1)]
+
+    def update(self, path, oldDigest, newDigest):
+        """
+        Replace an entry's digest in the tree.
+
+        :param path: The hex digits of the entry's key hash below the tree's root.
+        :param oldDigest: The entry's previous digest, or 0 for a new entry.
+        :param newDigest: The entry's new digest, or 0 for a removed entry.
+        """
+        change = oldDigest ^ newDigest
+        if not change:
+            return
+        self._levels[0][0] ^= change
+        index = 0
+        for level in range(1, self._depth + 1):
+            index = index * 16 + int(path[level - 1], 16)
+            self._levels[level][index] ^= change
+
+    def digest(self, path=""):
+        """
+        Return the digest of a node in the tree.
+
+        :param path: The hex digits of the node below the tree's root. Paths longer than the tree's depth are
+            truncated to a leaf.
+        """
+        path = path[:self._depth]
+        return self._levels[len(path)][int(path, 16) if path else 0]
+
+    def children(self, path=""):
+        """
+        Return the digests of the 16 children of a node in the tree.
+
+        :param path: The hex digits of the node below the tree's root. This must be shorter than the tree's depth.
+        :return: A :class:`list` of 16 digests, in hex digit order.
+        """
+        start = int(path, 16) * 16 if path else 0
+        return self._levels[len(path) + 1][start:start + 16]
@@ -0,0 +1,244 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Online migration of partitions between Nodes.
+
+When a change in membership moves a partition of the key space to other Nodes (see
+:meth:`~zht.node.Node._rebalance`), the Node giving it up runs a :class:`Migration`: it streams its entries for the
+partition to the new owners, then the entries written while it was doing so, and finally hands ownership over. The
+new owners don't serve or announce the partition until it has been handed over, and the old owner keeps serving it
+until then, so there is always an announced owner that is up to date.
+
+Every Migration a Node runs draws on one :class:`TokenBucket`, which limits the bandwidth they use so foreground
+requests aren't starved.
+"""
+from gevent import sleep
+from time import time
+from peer import RequestTimeout
+import logging
+log = logging.getLogger('zht.migration')
+
+#: The states a :class:`Migration` goes through, in order. It ends up in one of the last three.
+MIGRATION_STATES = ('waiting', 'streaming', 'catchingUp', 'done', 'aborted', 'failed')
+
+class TokenBucket(object):
+    """
+    Construct a new TokenBucket.
+
+    A TokenBucket limits the rate at which something is used up, such as bytes sent. Units that aren't used
+    accumulate, up to `burst`, so a short burst can go through without waiting after a pause.
+
+    :param rate: The sustained rate, in units per second. `None` or 0 doesn't limit the rate.
+    :param burst: The most units that can accumulate. Defaults to one second's worth.
+    """
+    def __init__(self, rate, burst=None):
+        self._rate = rate
+        self._burst = burst or rate
+        self._tokens = self._burst
+        self._updated = time()
+
+    def take(self, amount):
+        """
+        Use up some units, sleeping until enough have accumulated.
+
+        Greenlets that take units at the same time wait in turn, since each one's debt is added to the next one's.
+
+        :param amount: The number of units to use up.
+        :return: The number of seconds spent waiting.
+        """
+        if not self._rate:
+            return 0.0
+        now = time()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+        wait = -self._tokens / float(self._rate)
+        sleep(wait)
+        return wait
+
+class Migration(object):
+    """
+    Construct a new Migration of a partition this Node no longer owns to the Nodes that now own it.
+
+    :param node: The :class:`~zht.node.Node` giving up the partition. It keeps owning the partition until the
+        Migration finishes (see :meth:`~zht.node.Node._releasePartition`).
+    :param partition: The partition prefix.
+    :param limiter: The :class:`TokenBucket` to take the bytes sent from.
+    :param chunkSize: The most entries to send in one MIGRATE request.
+    :param timeout: Seconds to wait for the new owners to accept the partition. If they don't, the Node keeps it.
+    :param catchUpRounds: The most rounds of entries written during the transfer to send before handing over. Any
+        written after the last round are sent once the partition has been released.
+    :param served: `False` if the Node never caught up with the partition itself (it was still being migrated to
+        the Node). Its entries are still sent, but the new owners aren't told the partition has been handed over,
+        so they catch up from elsewhere.
+    """
+    def __init__(self, node, partition, limiter, chunkSize=500, timeout=30, catchUpRounds=5, served=True):
+        self._node = node
+        self.partition = partition
+        self._limiter = limiter
+        self._chunkSize = chunkSize
+        self._timeout = timeout
+        self._catchUpRounds = catchUpRounds
+        self._served = served
+        self._aborted = False
+        self._marks = dict()
+        self._targets = []
+        self.state = 'waiting'
+        self.entries = 0
+        self.bytes = 0
+        self.rounds = 0
+        self.throttled = 0.0
+        self.started = time()
+        self.finished = None
+
+    def abort(self):
+        """
+        Stop this Migration at the next chunk, because the Node owns the partition again.
+        """
+        self._aborted = True
+
+    def run(self):
+        """
+        Migrate the partition, then release it.
+
+        The new owners are chosen again each time a set of them has been caught up, in case more Nodes came or went
+        in the meantime. Owners that already announce the partition need nothing from this Node.
+        """
+        deadline = time() + self._timeout
+        while not self._aborted:
+            targets = [target for target in self._node._migrationTargets(self.partition)
+                       if not target in self._marks]
+            if not targets:
+                self._release()
+                return
+            # Checked every time round, since targets that accept the partition can still fail to take it over.
+            if time() > deadline:
+                log.warning("Keeping partition '%s': %s haven't taken it over", self.partition, sorted(targets))
+                self._finish('failed')
+                return
+            accepted = [target for target in targets if self._send(target, []) is not None]
+            if len(accepted) < len(targets):
+                sleep(0.1)
+                continue
+            self._stream(targets)
+        self._finish('aborted')
+
+    def _stream(self, targets):
+        """
+        Send every entry of the partition to some of its new owners, then the entries written meanwhile, then hand
+        the partition over to them.
+
+        :param targets: The identities of the new owners.
+        """
+        self.state = 'streaming'
+        self._targets = targets
+        since = None
+        for i in range(self._catchUpRounds + 1):
+            roundStarted = time()
+            entries = self._entries(since)
+            if since is not None and not entries:
+                break
+            targets = self._sendAll(targets, entries)
+            since = roundStarted
+            self.rounds += 1
+            if self._aborted or not targets:
+                break
+            self.state = 'catchingUp'
+        if self._aborted:
+            return
+        for target in targets:
+            peer = self._node._peers.get(target)
+            if peer is not None and (not self._served or self._handOver(peer)):
+                self._marks[target] = since
+
+    def _release(self):
+        """
+        Release the partition, then send the new owners whatever was written since their last catch-up round.
+        """
+        final = [(target, self._entries(since)) for target, since in self._marks.items()]
+        self._node._releasePartition(self.partition)
+        for target, entries in final:
+            if entries:
+                self._sendAll([target], entries)
+        if not self.partition in self._node._table.ownedPartitions():
+            self._node._table.clearPartition(self.partition)
+            # The write log has no record of the clear, so a restart would bring the entries back without a snapshot.
+            self._node._requestSnapshot()
+        log.info("Migrated partition '%s' to %s: %d entries, %d bytes in %.2fs", self.partition,
+                 sorted(self._marks), self.entries, self.bytes, time() - self.started)
+        self._finish('done')
+
+    def _finish(self, state):
+        self.state = state
+        self.finished = time()
+
+    def _entries(self, since=None):
+        """
+        :param since: If given, only list the entries stored at or after this time.
+        :return: A :class:`list` of (key, key hash, value, timestamp) tuples for the partition's entries.
+        """
+        entries = dict()
+        for entry in self._node._table.getEntries(self.partition, since):
+            entries[entry._key] = (entry._key, entry._hash, entry._value, entry._timestamp)
+        return entries.values()
+
+    def _sendAll(self, targets, entries):
+        """
+        Send entries to several new owners in rate limited chunks.
+
+        :param targets: The identities of the new owners.
+        :param entries: A :class:`list` of (key, key hash, value, timestamp) tuples.
+        :return: The targets that accepted every chunk.
+        """
+        for i in range(0, len(entries), self._chunkSize):
+            chunk = entries[i:i + self._chunkSize]
+            size = sum(len(key) + len(value) for key, keyHash, value, timestamp in chunk) * len(targets)
+            self.throttled += self._limiter.take(size)
+            requests = [self._node.spawn(self._send, target, chunk) for target in targets]
+            targets = [target for target, request in zip(targets, requests) if request.get() is not None]
+            self.entries += len(chunk)
+            self.bytes += size
+            if self._aborted or not targets:
+                break
+        return targets
+
+    def _send(self, target, chunk):
+        """
+        :return: The number of entries `target` stored, or `None` if it is gone, refused them or didn't answer.
+        """
+        peer = self._node._peers.get(target)
+        if peer is None:
+            return None
+        try:
+            return peer.migrate(self.partition, chunk)
+        except RequestTimeout:
+            log.warning("Peer %s didn't answer a MIGRATE request for partition '%s'", target, self.partition)
+            return None
+
+    def _handOver(self, peer):
+        """
+        :return: `True` if `peer` took the partition over, `False` if it refused or didn't answer.
+        """
+        try:
+            return peer.migrated(self.partition)
+        except RequestTimeout:
+            log.warning("Peer %s didn't answer a MIGRATED request for partition '%s'", peer._id, self.partition)
+            return False
+
+    def progress(self):
+        """
+        :return: A :class:`dict` describing this Migration, for the MIGRATIONS control command.
+        """
+        return {
+            'partition': self.partition,
+            'state': self.state,
+            'targets': sorted(set(self._targets) | set(self._marks)),
+            'entries': self.entries,
+            'bytes': self.bytes,
+            'rounds': self.rounds,
+            'throttled': self.throttled,
+            'elapsed': (self.finished or time()) - self.started,
+        }
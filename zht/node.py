@@ -6,18 +6,62 @@ Node implementation. A node is the fundamental unit of the collective ZHT system
 """
 from gevent_zeromq import zmq
 from gevent.pool import Pool
-from gevent import sleep
+from gevent import sleep, Timeout
+from gevent.event import AsyncResult, Event
+from gevent.queue import Queue
+from time import time
 from table import Table
-from peer import Peer
+from peer import Peer, RequestTimeout, PeerBusy
+from routing import RoutingTable, rendezvousOwners
+from storage import LogStorage
+from codec import CODECS, detect, negotiate
+from cache import NearCache, RecentSet
+from migration import Migration, TokenBucket
+from latency import LatencyTracker
+from membership import Membership
+from gossip import PartialView
+from admission import WorkQueue, TRAFFIC_CLASSES, DEFAULT_LIMITS
+from collections import deque
+from random import choice, random
+from uuid import uuid4
 import json
 import logging
-from zht.table import hex_hash
 log = logging.getLogger('zht.node')
 pubLog = log.getChild('pub')
 subLog = log.getChild('sub')
 connLog = log.getChild('connect')
 repLog = log.getChild('rep')
 
+# SUB topics every Node subscribes to, whatever it owns.
+CONTROL_TOPICS = ('PEER', 'LEAVE', 'HEARTBEAT', 'BUCKETS')
+
+#: How a Node passes on updates it receives from other Nodes: never, relying on every Node being subscribed to every
+#: other ('mesh'); always ('flood'); or with a fixed probability ('gossip').
+FORWARDING_STRATEGIES = ('mesh', 'flood', 'gossip')
+
+#: How RGET reads keys from the Peers that own them: from one owner ('first'); from one owner, and from another as
+#: well if the first is slower to answer than usual ('hedged'); or from several owners, returning the newest value
+#: ('quorum'). See :meth:`Node._rmget`.
+READ_MODES = ('first', 'hedged', 'quorum')
+
+#: The traffic class (see :data:`~zht.admission.TRAFFIC_CLASSES`) of each REP request. Any other request is a
+#: 'membership' one.
+REQUEST_CLASSES = {
+    'GET': 'client',
+    'MGET': 'client',
+    'MPUT': 'client',
+    'MGET-CLIENT': 'client',
+    'MPUT-CLIENT': 'client',
+    'KEYS': 'sync',
+    'TREE': 'sync',
+    'MGET-SYNC': 'sync',
+    'MIGRATE': 'sync',
+    'MIGRATED': 'sync',
+}
+
+# The number of read latencies to measure before hedging on their percentile rather than the configured delay.
+_MIN_HEDGE_SAMPLES = 20
+
 class Node(object):
     """
     Construct a new :class:`Node`.
@@ -27,10 +71,123 @@ class Node(object):
     :param pubAddr: The ZMQ address to bind the PUB socket to.
     :param ctx: The ZMQ Context object to operate from.
     :param poolSize: The size of the greenlet pool this Node will operate from.
+    :param antiEntropyInterval: Seconds between background synchronizations with every Peer. `None` or 0 disables
+        them.
+    :param splitEntries: The number of entries above which a Bucket is split (see :class:`~zht.table.Table`).
+    :param splitBytes: The size in bytes above which a Bucket is split (see :class:`~zht.table.Table`).
+    :param hashFunction: The name of the key hash function to use (see :data:`~zht.table.HASH_FUNCTIONS`). Every
+        Node in a cluster must use the same one; Peers using a different one are refused when they connect.
+    :param storageDir: The directory to keep this Node's write log in (see :class:`~zht.storage.LogStorage`). The
+        Table is loaded from it on startup. `None` keeps the Table only in memory.
+    :param snapshotDir: The directory to keep snapshots in, if not `storageDir`.
+    :param fsyncPolicy: When the write log is forced to disk (see :data:`~zht.storage.FSYNC_POLICIES`).
+    :param fsyncInterval: Seconds between group commits of the write log under the 'batch' fsync policy.
+    :param snapshotInterval: Seconds between snapshots of the Table, which let the write log be discarded.
+    :param updateInterval: Seconds to buffer accepted writes for before publishing them as batched UPDATE messages.
+        0 publishes every write as soon as it is accepted.
+    :param updateBatchSize: The number of buffered keys at which updates are published without waiting for the
+        interval to pass.
+    :param forwarding: The strategy for passing on updates received from other Nodes, from
+        :data:`FORWARDING_STRATEGIES`.
+    :param gossipProbability: The probability of passing on each update under the 'gossip' strategy.
+    :param dedupSize: The number of recently seen update versions to remember, so repeats are dropped unapplied.
+    :param nearCacheBytes: The size limit of the near cache that holds values fetched for keys this Node doesn't own
+        (see :class:`~zht.cache.NearCache`). 0 disables it.
+    :param nearCacheTTL: Seconds after which a near cache entry is fetched again.
+    :param replicas: The number of Nodes that own each partition of the key space (see :meth:`_rebalance`).
+    :param handoffTimeout: Seconds to wait for the new owners of a partition this Node no longer owns to accept it
+        (see :class:`~zht.migration.Migration`), after which it is kept; and for a partition newly assigned to this
+        Node to be migrated to it, after which it synchronizes the partition with its Peers instead.
+    :param migrationRate: The most bytes of keys and values per second that partition migrations send, altogether.
+        `None` or 0 doesn't limit them.
+    :param migrationChunkSize: The most entries to send in each MIGRATE request.
+    :param hedgePercentile: The percentile of recent read latencies that a Peer must take longer than to answer a
+        hedged read before other owners are asked as well.
+    :param hedgeDelay: Seconds to wait before hedging a read until enough latencies have been measured.
+    :param latencySamples: The number of recent read latencies to keep (see :class:`~zht.latency.LatencyTracker`).
+    :param codec: The name of the codec (see :data:`~zht.codec.CODECS`) to offer Peers for protocol payloads. JSON is
+        always offered as well, for Peers that don't know it.
+    :param requestTimeout: Seconds to wait for a Peer to answer a request, including the handshake when connecting,
+        before giving up on it (see :meth:`~zht.peer.Peer._makeRequest`). `None` or 0 waits forever.
+    :param requestRetries: The number of times a request to a Peer that timed out is sent again.
+    :param readTimeout: Seconds an RGET, or a GET of keys this Node doesn't own, may take altogether, including
+        failing over to other owners.
+    :param heartbeatInterval: Seconds between the HEARTBEAT messages this Node publishes. Every Node in a cluster
+        should use the same interval, since it is also how often heartbeats are expected from Peers.
+    :param suspectPhi: The suspicion level at which a Peer whose heartbeats are overdue is no longer sent requests
+        (see :class:`~zht.membership.Membership`).
+    :param deadPhi: The suspicion level at which a Peer whose heartbeats are overdue is dropped.
+    :param activeViewSize: The most Nodes to connect to as gossip neighbours (see :class:`~zht.gossip.PartialView`),
+        besides those needed to reach the owners of each partition. `None` or 0 connects to every Node, as a full
+        mesh.
+    :param shuffleInterval: Seconds between exchanges of known Nodes with a random neighbour, when the active view is
+        bounded.
+    :param shuffleLength: The most known Nodes to send in each exchange.
+    :param tombstoneTTL: Seconds to remember Nodes that have left or been found dead, refusing to learn of them again
+        from other Nodes' announcements and shuffles in the meantime. Hearing from such a Node directly, by its
+        heartbeats or its connecting, still brings it back.
+    :param admissionLimits: A :class:`dict` mapping traffic classes (see :data:`~zht.admission.TRAFFIC_CLASSES`) to
+        (workers, depth) limits, overriding their :data:`~zht.admission.DEFAULT_LIMITS`. Each class's workers are
+        greenlets of its own, outside the `poolSize` pool.
 
     """
-    def __init__(self, identity, repAddr, pubAddr, ctx=None, poolSize=200):
+    def __init__(self, identity, repAddr, pubAddr, ctx=None, poolSize=200, antiEntropyInterval=60,
+                 splitEntries=None, splitBytes=None, hashFunction='sha1', storageDir=None, snapshotDir=None,
+                 fsyncPolicy='batch', fsyncInterval=0.1, snapshotInterval=300, updateInterval=0.005,
+                 updateBatchSize=1000, forwarding='mesh', gossipProbability=0.5, dedupSize=10000,
+                 nearCacheBytes=16 * 1024 * 1024, nearCacheTTL=60, replicas=3, handoffTimeout=30,
+                 migrationRate=8 * 1024 * 1024, migrationChunkSize=500, hedgePercentile=95, hedgeDelay=0.01,
+                 latencySamples=1000, codec='bin1', requestTimeout=2.0, requestRetries=1, readTimeout=5.0,
+                 heartbeatInterval=30, suspectPhi=5.0, deadPhi=12.0, activeViewSize=None, shuffleInterval=30,
+                 shuffleLength=8, admissionLimits=None, tombstoneTTL=300):
+        if not codec in CODECS:
+            raise ValueError("Unknown codec '%s'" % (codec,))
+        if not forwarding in FORWARDING_STRATEGIES:
+            raise ValueError("Unknown forwarding strategy '%s'" % (forwarding,))
         self._greenletPool = Pool(poolSize)
+        self._antiEntropyInterval = antiEntropyInterval
+        self._codecs = [codec] + (['json'] if codec != 'json' else [])
+        self._updateInterval = updateInterval
+        self._updateBatchSize = updateBatchSize
+        self._pendingUpdates = dict()
+        self._updatesPending = Event()
+        self._forwarding = forwarding
+        self._gossipProbability = gossipProbability
+        self._seenUpdates = RecentSet(dedupSize)
+        self._replicas = replicas
+        self._handoffTimeout = handoffTimeout
+        self._assigned = None
+        self._joined = False
+        self._incoming = set()
+        self._migrations = dict()
+        self._pastMigrations = deque(maxlen=64)
+        self._migrationLimiter = TokenBucket(migrationRate)
+        self._migrationChunkSize = migrationChunkSize
+        self._hedgePercentile = hedgePercentile
+        self._hedgeDelay = hedgeDelay
+        self._readLatency = LatencyTracker(latencySamples)
+        self._hedgedReads = 0
+        self._readRepairs = 0
+        self._requestTimeout = requestTimeout
+        self._requestRetries = requestRetries
+        self._readTimeout = readTimeout
+        self._requestTimeouts = 0
+        self._heartbeatInterval = heartbeatInterval
+        self._membership = Membership(heartbeatInterval, suspectPhi, deadPhi)
+        self._view = PartialView(activeViewSize) if activeViewSize else None
+        self._knownNodes = dict()
+        self._tombstones = dict()
+        self._tombstoneTTL = tombstoneTTL
+        self._shuffleInterval = shuffleInterval
+        self._shuffleLength = shuffleLength
+        limits = dict(DEFAULT_LIMITS)
+        for name, limit in (admissionLimits or {}).items():
+            if not name in TRAFFIC_CLASSES:
+                raise ValueError("Unknown traffic class '%s'" % (name,))
+            limits[name] = tuple(limit)
+        self._workQueues = dict((name, WorkQueue(name, workers, depth, latencySamples))
+                                for name, (workers, depth) in limits.items())
+        self._busyReplies = 0
         self._id = identity
         self._repAddr = repAddr
         self._pubAddr = pubAddr
@@ -43,14 +200,37 @@ class Node(object):
         self._pub.bind(pubAddr)
         self.__peersConnected = set()
         self._sub = self._ctx.socket(zmq.SUB)
-        self._sub.setsockopt(zmq.SUBSCRIBE, "")
+        self._subscriptions = set()
         self.__subConnected = set()
         self._req = self._ctx.socket(zmq.XREQ)
         self._peers = dict()
-        self._table = Table()
-        self._controlSock = self._ctx.socket(zmq.REP)
+        self._incarnation = uuid4().hex[:8]
+        self._syncMarks = dict()
+        self._routes = RoutingTable()
+        self._table = Table(splitEntries=splitEntries, splitBytes=splitBytes, hashFunction=hashFunction)
+        self._cache = NearCache(nearCacheBytes, self._table._prefixLength, nearCacheTTL) if nearCacheBytes else None
+        self._storage = None
+        self._fsyncInterval = fsyncInterval
+        self._snapshotInterval = snapshotInterval
+        self._snapshotWanted = Event()
+        if storageDir:
+            self._storage = LogStorage(storageDir, snapshotDir, fsyncPolicy)
+            self._syncMarks.update(self._storage.load(self._table))
+            self._table._storage = self._storage
+        self._updateSubscriptions()
+        self._controlSock = self._ctx.socket(zmq.XREP)
         self._controlSock.bind('ipc://.zhtnode-control-' + identity)
 
+    def _close(self):
+        """
+        Close this Node's sockets, when it shuts down.
+        """
+        for peer in self._peers.values():
+            peer.close()
+        for sock in (self._rep, self._pub, self._sub, self._req):
+            sock.close(linger=0)
+        self._controlSock.close()
+
     def spawn(self, f, *args, **kwargs):
         """
         Spawn a new greenlet in this Node's pool
@@ -73,15 +253,50 @@ class Node(object):
         self.__subConnected.add(addr)
         self._sub.connect(addr)
 
+    def _updateSubscriptions(self):
+        """
+        Subscribe the SUB socket to the control topics and to updates for every Bucket this Node owns or has keys in
+        its near cache for, and unsubscribe from anything else.
+
+        UPDATE topics are filtered on the prefix of the Table's initial Buckets, which every Node publishes batched
+        updates under (see :meth:`_flushUpdates`). This must be called again whenever the Table's ownership changes.
+        """
+        prefixLength = self._table._prefixLength
+        topics = set(CONTROL_TOPICS)
+        topics.update("UPDATE|" + prefix[:prefixLength] for prefix in self._table.ownedBuckets())
+        if self._cache is not None:
+            topics.update("UPDATE|" + prefix for prefix in self._cache.prefixes())
+        for topic in self._subscriptions - topics:
+            self._sub.setsockopt(zmq.UNSUBSCRIBE, topic)
+        for topic in topics - self._subscriptions:
+            self._sub.setsockopt(zmq.SUBSCRIBE, topic)
+        if topics != self._subscriptions:
+            subLog.debug("Subscribed to %d topics", len(topics))
+        self._subscriptions = topics
+
+    def _subscribe(self, topics):
+        """
+        Subscribe the SUB socket to topics it isn't subscribed to yet, without reconsidering the others as
+        :meth:`_updateSubscriptions` does.
+
+        :param topics: An iterable of topics.
+        """
+        for topic in set(topics) - self._subscriptions:
+            self._sub.setsockopt(zmq.SUBSCRIBE, topic)
+            self._subscriptions.add(topic)
+            subLog.debug("Subscribed to %s", topic)
+
     def _reqConnect(self, addr):
         """
-        Return a new REQ socket connected to the given address.
+        Return a new DEALER socket connected to the given address.
 
-        :param addr" The ZMQ address of the REP socket to connect to.
+        :param addr: The ZMQ address of the REP socket to connect to.
 
         """
-        sock = self._ctx.socket(zmq.REQ)
-        sock.setsockopt(zmq.IDENTITY, str("%s:REQ:%s" % (self._id, addr)))
+        sock = self._ctx.socket(zmq.XREQ)
+        # A restarted Node reuses its identity, so make each connection's identity unique or the XREP side may
+        # route replies to the old, dead connection.
+        sock.setsockopt(zmq.IDENTITY, str("%s:DEALER:%s:%s" % (self._id, addr, uuid4().hex[:8])))
         sock.connect(addr)
         return sock
 
@@ -95,6 +310,17 @@ class Node(object):
         self.spawn(self._handleSub)
         self.spawn(self._handleControl)
         self.spawn(self._heartbeat)
+        self.spawn(self._watchMembers)
+        if self._view is not None and self._shuffleInterval:
+            self.spawn(self._shuffle)
+        if self._antiEntropyInterval:
+            self.spawn(self._antiEntropy)
+        if self._updateInterval:
+            self.spawn(self._publishUpdates)
+        if self._storage is not None:
+            if self._storage._fsyncPolicy == 'batch':
+                self.spawn(self._commitStorage)
+            self.spawn(self._snapshotStorage)
 
     def connect(self, addr):
         """
@@ -103,7 +329,8 @@ class Node(object):
         :param addr: The ZMQ address of the Peer's REP socket.
 
         This will create a new peer and add it to this Node's peer table. A synchronize operation will
-        happen in a spawned greenlet.
+        happen in a spawned greenlet. If the Peer doesn't answer the handshake within the request timeout, the
+        connection is abandoned.
         """
         connLog.debug("start connect:'%s' peersConnected:'%s'", addr, self.__peersConnected)
         if addr in self.__peersConnected:
@@ -112,68 +339,868 @@ class Node(object):
         else:
             self.__peersConnected.add(addr)
         requestSock = self._reqConnect(addr)
-        requestSock.send_multipart(["PEER", self._id, self._repAddr, self._pubAddr])
-        reply = requestSock.recv_multipart()
+        # gevent_zeromq swallows gevent.Timeout while a socket waits, so time out with an exception of our own.
+        try:
+            with Timeout(self._requestTimeout or None, RequestTimeout):
+                # The Peer isn't reading replies yet, so the handshake goes out with a bare REQ-style envelope.
+                requestSock.send_multipart(["", "PEER", self._id, self._repAddr, self._pubAddr,
+                                            self._table._hashFunction, ",".join(self._codecs)])
+                reply = requestSock.recv_multipart()[1:]
+        except RequestTimeout:
+            connLog.error("Connection to '%s' timed out", addr)
+            self._requestTimeouts += 1
+            requestSock.close(linger=0)
+            self.__peersConnected.discard(addr)
+            return
+        if reply[0] != "PEER":
+            connLog.error("Connection to '%s' refused: %s", addr, reply[1:])
+            requestSock.close()
+            self.__peersConnected.discard(addr)
+            return
         if reply[1] != self._id and not reply[1] in self._peers:
-            self._peers[reply[1]] = Peer(self, reply[1], addr, reply[2], requestSock)
-            self._subConnect(reply[2])
-            self._pubPeer(reply[1], addr)
+            codec = negotiate(reply[4] if len(reply) > 4 else "", self._codecs)
+            self._addPeer(reply[1], addr, reply[2], requestSock, codec)
+
+    def _addPeer(self, identity, repAddr, pubAddr, sock, codec):
+        """
+        Start talking to a Node, once one end has connected to the other.
+
+        Both the connecting and the accepting end call this, so each watches the other's heartbeats (see
+        :class:`~zht.membership.Membership`) and drops it when it fails. The Node becomes a gossip neighbour if there
+        is room in the active view. It is announced to this Node's subscribers, so they can connect to it too (or,
+        with a bounded active view, pass the announcement on).
+
+        :param identity: The identity string of the Node.
+        :param repAddr: The ZMQ address of the Node's REP socket.
+        :param pubAddr: The ZMQ address of the Node's PUB socket.
+        :param sock: A DEALER socket connected to `repAddr`.
+        :param codec: The codec negotiated with the Node.
+        """
+        self._subConnect(pubAddr)
+        self._peers[identity] = Peer(self, identity, repAddr, pubAddr, sock, codec)
+        self._membership.add(identity)
+        self._knownNodes[identity] = repAddr
+        self._tombstones.pop(identity, None)
+        if self._view is not None:
+            self._view.add(identity)
+        self._pubPeer(identity, repAddr)
+        self._rebalance()
+
+    def _learnNode(self, identity, addr, direct=False):
+        """
+        Take note of a Node heard of from a Peer.
+
+        Without a bounded active view, this Node connects to it. Otherwise the Node is remembered, and announced to
+        this Node's subscribers the first time it is heard of, so the announcement spreads epidemically; it is only
+        connected to if there is room in the active view, or it owns a partition this Node needs to reach (see
+        :meth:`_linkOwners`). A Node that has recently left or been found dead (see :meth:`_bury`) is ignored, unless
+        it was heard from directly.
+
+        :param identity: The identity string of the Node.
+        :param addr: The ZMQ address of the Node's REP socket.
+        :param direct: `True` if the Node itself was heard from, rather than another Node's announcement of it.
+        """
+        if identity == self._id or identity in self._peers:
+            return
+        if self._tombstoned(identity):
+            if not direct:
+                return
+            log.info("Heard from departed node %s again", identity)
+            del self._tombstones[identity]
+        if self._view is None:
+            self.connect(addr)
+            return
+        if not identity in self._knownNodes:
+            self._knownNodes[identity] = addr
+            self._pubPeer(identity, addr)
+            self._rebalance()
+        if not self._view.isFull():
+            self.connect(addr)
+
+    def _forgetNode(self, identity):
+        """
+        Forget a Node that another Node has found to be dead, unless this Node can still hear from it, and pass the
+        news on.
+
+        :param identity: The identity string of the Node.
+        """
+        if identity in self._peers:
+            if not self._membership.isAlive(identity):
+                self._dropPeer(identity)
+        elif self._knownNodes.pop(identity, None) is not None:
+            log.info("Forgot node %s", identity)
+            self._bury(identity)
+            self._pub.send_multipart(['LEAVE', identity])
+            self._rebalance()
+
+    def _dropPeer(self, identity):
+        """
+        Forget about a Peer that has left.
+
+        The Peer's departure is announced with a LEAVE message, so Nodes that aren't connected to it learn of it
+        too. With a bounded active view, known Nodes are connected to in its place until the view is full again.
+
+        :param identity: The identity string of the Peer.
+        """
+        peer = self._peers.pop(identity, None)
+        self._routes.removePeer(identity)
+        self._membership.remove(identity)
+        self._knownNodes.pop(identity, None)
+        self._bury(identity)
+        if peer is not None:
+            self.__peersConnected.discard(peer._repAddr)
+            peer.close()
+            connLog.info("Dropped peer %s", identity)
+            self._pub.send_multipart(['LEAVE', identity])
+            self._rebalance()
+        if self._view is not None:
+            self._view.remove(identity)
+            self._fillActiveView()
+
+    def _bury(self, identity):
+        """
+        Remember that a Node has left or been found dead for the tombstone TTL, so stale announcements and shuffle
+        samples that still list it don't bring it back.
+
+        :param identity: The identity string of the Node.
+        """
+        self._tombstones[identity] = time() + self._tombstoneTTL
+
+    def _tombstoned(self, identity):
+        """
+        :return: `True` if a Node left or was found dead less than the tombstone TTL ago.
+        """
+        expires = self._tombstones.get(identity)
+        if expires is not None and expires <= time():
+            del self._tombstones[identity]
+            return False
+        return expires is not None
+
+    def _fillActiveView(self):
+        """
+        Replace neighbours that have been dropped with known Nodes chosen at random, while there is room in the
+        active view.
+        """
+        for identity in self._view.candidates(self._knownNodes, [self._id]):
+            if self._view.isFull():
+                return
+            if identity in self._peers:
+                self._view.add(identity)
+            else:
+                self.spawn(self.connect, self._knownNodes[identity])
+                return
+
+    def _memberIds(self):
+        """
+        :return: A :class:`list` of the identities of every Node known to be in the cluster, this one first, leaving
+            out Peers the Membership doesn't report alive.
+        """
+        return [self._id] + [identity for identity in self._knownNodes if self._membership.isAlive(identity)]
+
+    def _linkOwners(self):
+        """
+        With a bounded active view, connect to the Nodes this Node needs to reach besides its neighbours: every
+        other owner of the partitions it owns (or is migrating away), so updates and migrations reach them, and an
+        owner of each other partition, to route requests for it through.
+        """
+        members = self._memberIds()
+        owned = self._table.ownedPartitions()
+        for partition in self._table._generatePrefixes():
+            owners = [owner for owner in rendezvousOwners(partition, members, self._replicas) if owner != self._id]
+            if not partition in owned:
+                if not owners or any(owner in self._peers for owner in owners):
+                    continue
+                owners = [choice(owners)]
+            for owner in owners:
+                if not owner in self._peers:
+                    self.spawn(self.connect, self._knownNodes[owner])
+
+    def _rebalance(self):
+        """
+        Recompute which partitions of the key space this Node owns, after the set of known Nodes has changed.
+
+        Each partition (an initial Bucket prefix) is assigned to the `replicas` Nodes chosen for it by
+        :func:`~zht.routing.rendezvousOwners`. Partitions no longer assigned to this Node are migrated to their new
+        owners (see :meth:`_migrateOut`), and stay owned until that has finished. Newly assigned partitions are owned
+        at once, so they receive updates, but aren't served or announced until they have been migrated to this Node
+        (see :meth:`_migrateIn`). The first time this Node joins other Nodes, the partitions assigned to it that it
+        has no entries for are treated as new as well.
+        """
+        members = self._memberIds()
+        self._assigned = set(partition for partition in self._table._generatePrefixes()
+                             if self._id in rendezvousOwners(partition, members, self._replicas))
+        for partition in self._assigned.intersection(self._migrations):
+            log.info("Partition '%s' is assigned to this node again", partition)
+            self._migrations.pop(partition).abort()
+        leaving = self._table.ownedPartitions() - self._assigned
+        gained = self._table.setOwned(self._assigned | leaving)[0]
+        if self._peers and not self._joined:
+            self._joined = True
+            gained.update(partition for partition in self._assigned if not self._table.partitionEntries(partition))
+        if gained:
+            for peerId, prefix in list(self._syncMarks):
+                if prefix[:self._table._prefixLength] in gained:
+                    del self._syncMarks[(peerId, prefix)]
+            self._incoming.update(gained)
+            self._updateSubscriptions()
+            self._pubBuckets()
+            for partition in gained:
+                self.spawn(self._migrateIn, partition)
+        for partition in leaving.difference(self._migrations):
+            self._migrations[partition] = Migration(self, partition, self._migrationLimiter, self._migrationChunkSize,
+                                                    self._handoffTimeout, served=not partition in self._incoming)
+            self.spawn(self._migrateOut, self._migrations[partition])
+        if gained or leaving:
+            log.info("Rebalanced: %d partitions assigned, %d incoming, %d leaving", len(self._assigned), len(gained),
+                     len(leaving))
+        if self._view is not None:
+            self._linkOwners()
+
+    def _migrateOut(self, migration):
+        """
+        Run a :class:`~zht.migration.Migration` of a partition that is no longer assigned to this Node, then forget
+        about it.
+
+        :param migration: The Migration, already registered in :attr:`_migrations`.
+        """
+        try:
+            migration.run()
+        finally:
+            if self._migrations.get(migration.partition) is migration:
+                del self._migrations[migration.partition]
+            self._pastMigrations.append(migration)
+
+    def _migrateIn(self, partition):
+        """
+        Start serving a partition newly assigned to this Node, once it has been migrated here.
+
+        Nodes giving the partition up stream it here themselves, and finish with a MIGRATED request. If no Node is
+        giving it up (it has only gained an owner), or none has finished within the handoff timeout, this Node
+        synchronizes the partition with the Peers that hold it instead.
+
+        :param partition: The partition prefix.
+        """
+        deadline = time() + self._handoffTimeout
+        while partition in self._incoming and partition in self._assigned:
+            ready = all(peer.isInitialized() for peer in self._peers.values())
+            if (ready and not self._migrationSources(partition)) or time() > deadline:
+                owners = rendezvousOwners(partition, self._memberIds(), self._replicas)
+                for peer in self._peers.values():
+                    if not self._available(peer._id) or not peer.isInitialized():
+                        continue
+                    if peer._id in owners or self._announces(peer._id, partition):
+                        self._syncPartition(peer, partition)
+                if partition in self._incoming and partition in self._assigned:
+                    log.info("Serving partition '%s' after synchronizing it", partition)
+                    self._incoming.discard(partition)
+                    self._pubBuckets()
+                return
+            sleep(0.1)
+
+    def _syncPartition(self, peer, partition):
+        """
+        Synchronize a partition with a Peer, retrying for up to the handoff timeout while the Peer is too busy.
+
+        :param peer: The :class:`~zht.peer.Peer` to synchronize with.
+        :param partition: The partition prefix.
+        """
+        deadline = time() + self._handoffTimeout
+        while True:
+            try:
+                peer.sync([partition])
+                return
+            except PeerBusy:
+                if time() > deadline:
+                    log.warning("Peer %s stayed too busy to synchronize partition '%s'", peer._id, partition)
+                    return
+                sleep(self._requestTimeout or 1)
+            except Exception:
+                log.exception("Synchronizing partition '%s' with peer %s failed", partition, peer._id)
+                return
+
+    def _announces(self, identity, partition):
+        """
+        :return: `True` if the Peer with the given identity has announced that it owns any of a partition.
+        """
+        return any(prefix.startswith(partition) or partition.startswith(prefix)
+                   for prefix in self._routes.peerBuckets(identity))
+
+    def _migrationSources(self, partition):
+        """
+        :return: The identities of the Peers that still announce a partition that isn't assigned to them, and so
+            will migrate it to its new owners.
+        """
+        owners = rendezvousOwners(partition, self._memberIds(), self._replicas)
+        return [identity for identity in self._peers if not identity in owners and self._announces(identity, partition)]
+
+    def _migrationTargets(self, partition):
+        """
+        :return: The identities of the Peers a partition is assigned to that don't announce it yet, and so need it
+            migrated to them.
+        """
+        owners = rendezvousOwners(partition, self._memberIds(), self._replicas)
+        return [owner for owner in owners if owner != self._id and not self._announces(owner, partition)]
+
+    def _releasePartition(self, partition):
+        """
+        Stop owning a partition that has been migrated to its new owners.
+
+        The Table is left holding the partition's entries, for the caller to clear once it is done with them.
+
+        :param partition: The partition prefix.
+        """
+        owned = self._table.ownedPartitions()
+        owned.discard(partition)
+        self._table.setOwned(owned)
+        self._incoming.discard(partition)
+        for peerId, prefix in list(self._syncMarks):
+            if prefix[:self._table._prefixLength] == partition:
+                del self._syncMarks[(peerId, prefix)]
+        self._updateSubscriptions()
+        self._pubBuckets()
+
+    def _announcedBuckets(self):
+        """
+        :return: A :class:`list` of the prefixes of the Buckets this Node owns and serves, leaving out partitions
+            that are still being migrated to it.
+        """
+        return [prefix for prefix in self._table.ownedBuckets()
+                if not prefix[:self._table._prefixLength] in self._incoming]
+
+    def _serves(self, key, keyHash):
+        """
+        :return: `True` if this Node owns a key and has caught up with its partition, so it can serve it.
+        """
+        return self._table.owns(key, keyHash) and not keyHash[:self._table._prefixLength] in self._incoming
+
+    def _available(self, identity):
+        """
+        :return: `True` if `identity` is a Peer that can be sent requests: one that isn't suspected of having failed.
+        """
+        return identity in self._peers and self._membership.isAlive(identity)
+
+    def _pubBuckets(self):
+        """
+        Announce the Buckets this Node owns over the PUB socket.
+        """
+        self._pub.send_multipart(["BUCKETS", self._id] + self._announcedBuckets())
 
     def _handleControl(self):
         """
         Handle commands given over the control socket.
+
+        The control socket is an XREP socket, so each command is handled in a greenlet of its own and answered with
+        its envelope whenever it is done: a slow command doesn't hold up the others, even from the same client.
         """
         while True:
             m = self._controlSock.recv_multipart()
-            if m[0] == 'EOF':
-                self._greenletPool.kill()
-                self._controlSock.send('OK')
+            if not "" in m:
+                log.warning("Dropping control command without an envelope delimiter: %s", m)
+                continue
+            i = m.index("")
+            self.spawn(self._handleControlCommand, m[:i+1], m[i+1:])
+
+    def _handleControlCommand(self, envelope, msg):
+        """
+        Handle an individual command given over the control socket.
+
+        A command that fails unexpectedly is answered with an ERROR | Internal error, so a client waiting for its
+        answer isn't left waiting forever.
+
+        :param envelope: The command's envelope, to send the answer back with.
+        :param msg: The command.
+        """
+        replied = []
+        def reply(answer):
+            replied.append(True)
+            self._controlSock.send_multipart(envelope + answer)
+        try:
+            self._runControlCommand(msg, reply)
+        except Exception as e:
+            log.exception("Control command %s failed", msg[:1])
+            if not replied:
+                reply(['ERROR', 'Internal', msg[0], str(e)])
+
+    def _runControlCommand(self, msg, reply):
+        """
+        Carry out a command given over the control socket.
+
+        :param msg: The command.
+        :param reply: A function to send the answer with.
+        """
+        if not msg:
+            reply(['ERR', 'UNKNOWN COMMAND'])
+        elif msg[0] == 'EOF':
+            if self._storage is not None:
+                self._storage.close()
+            reply(['OK'])
+            self._close()
+            for queue in self._workQueues.values():
+                queue.kill()
+            self._greenletPool.kill()
+            return
+        elif msg[0] == 'CONNECT':
+            self._greenletPool.map(self.connect, msg[1:])
+            reply(['OK'])
+        elif msg[0] == 'GET':
+            keyHashes = dict((key, self._table.keyHash(key)) for key in msg[1:])
+            try:
+                remote = self._cachedGet([key for key in msg[1:] if not self._serves(key, keyHashes[key])],
+                                         keyHashes)
+            except PeerBusy as e:
+                reply(['ERROR', 'Busy', str(e)])
                 return
-            elif m[0] == 'CONNECT':
-                self._greenletPool.map(self.connect, m[1:])
-                self._controlSock.send('OK')
-            elif m[0] == 'GET':
-                r = []
-                for key in m[1:]:
+            except RequestTimeout as e:
+                reply(['ERROR', 'Timeout', str(e)])
+                return
+            r = []
+            for key in msg[1:]:
+                if key in remote:
+                    r.append(remote[key][0])
+                else:
                     try:
-                        r.append(self._table[key])
-                    except KeyError:
-                        if self._table.owns(key):
-                            r.append('KeyError')
-                        else:
-                            r.append(self._rget(key))
-                self._controlSock.send_multipart(r)
-            elif m[0] == 'RGET':
-                r = []
-                for key in m[1:]:
-                    r.append(self._rget(key))
-                self._controlSock.send_multipart(r)
-            elif m[0] == 'PUT':
-                self._table[m[1]] = m[2]
-                self._controlSock.send_multipart(['OK', m[1], m[2]])
-                self._pubUpdate(m[1])
-            elif m[0] == 'PEERS':
-                self._controlSock.send_multipart(['PEERS'] + list(self._peers.keys()))
+                        r.append(self._table.getValue(key, keyHashes[key])._value)
+                    except (KeyError, NotImplementedError):
+                        r.append('KeyError')
+            reply(r)
+        elif msg[0] == 'RGET-QUORUM' and (len(msg) < 2 or not msg[1].isdigit() or int(msg[1]) < 1):
+            reply(['ERROR', 'BadArgument', 'RGET-QUORUM', 'Expected a positive quorum'])
+        elif msg[0] in ('RGET', 'RGET-HEDGED', 'RGET-QUORUM'):
+            try:
+                if msg[0] == 'RGET-QUORUM':
+                    keys = msg[2:]
+                    remote = self._rmget(keys, mode='quorum', quorum=int(msg[1]))
+                else:
+                    keys = msg[1:]
+                    remote = self._rmget(keys, mode='hedged' if msg[0] == 'RGET-HEDGED' else 'first')
+            except PeerBusy as e:
+                reply(['ERROR', 'Busy', str(e)])
+                return
+            except RequestTimeout as e:
+                reply(['ERROR', 'Timeout', str(e)])
+                return
+            reply([remote[key][0] if key in remote else 'KeyError' for key in keys])
+        elif msg[0] == 'PUT':
+            if self._put([(msg[1], self._table.keyHash(msg[1]), msg[2], time())]):
+                reply(['OK', msg[1], msg[2]])
+            else:
+                reply(['ERROR', 'NoOwner', msg[1]])
+        elif msg[0] == 'MPUT':
+            if len(msg) % 2 != 1:
+                reply(['ERROR', 'BadArgument', 'MPUT', 'Expected key/value pairs'])
+                return
+            now = time()
+            stored = self._put([(key, self._table.keyHash(key), value, now)
+                                for key, value in zip(msg[1::2], msg[2::2])])
+            reply(['OK', str(stored)])
+        elif msg[0] == 'PEERS':
+            reply(['PEERS'] + list(self._peers.keys()))
+        elif msg[0] == 'STATS':
+            reply(['STATS', json.dumps(self._stats())])
+        elif msg[0] == 'MIGRATIONS':
+            reply(['MIGRATIONS', json.dumps(self._migrationProgress())])
+        elif msg[0] == 'MEMBERS':
+            reply(['MEMBERS', json.dumps(self._membership.view())])
+        else:
+            reply(['ERR', 'UNKNOWN COMMAND'] + msg)
+
+    def _put(self, entries):
+        """
+        Store entries written through this Node on the Nodes that own them.
+
+        Entries in partitions this Node serves are stored locally and published. The rest are grouped by owning
+        Peer and sent with one MPUT request per Peer; the owners publish them. Entries in partitions still being
+        migrated to this Node are only stored locally if no Peer announces them. Owners that don't answer within the
+        request timeout are skipped.
+
+        :param entries: A list of (key, key hash, value, timestamp) tuples.
+        :return: The number of entries that were stored on at least one owner.
+        """
+        stored = 0
+        local = []
+        remote = []
+        byPeer = dict()
+        for entry in entries:
+            key, keyHash, value, timestamp = entry
+            owners = []
+            if not self._serves(key, keyHash):
+                owners = [owner for owner in self._routes.lookup(keyHash) if self._available(owner)]
+            if not owners and self._table.owns(key, keyHash):
+                self._table.putValue(key, value, timestamp, keyHash)
+                local.append(entry)
+                stored += 1
+            elif owners:
+                if self._cache is not None:
+                    self._cache.update(key, value, timestamp)
+                for owner in owners:
+                    byPeer.setdefault(owner, []).append(entry)
+                remote.append(owners)
             else:
-                self._controlSock.send(['ERR', 'UNKNOWN COMMAND'] + m)
+                log.warning("No owner known for key '%s'", key)
+        requests = dict((owner, self.spawn(self._peers[owner].mput, ownerEntries))
+                        for owner, ownerEntries in byPeer.items())
+        for key, keyHash, value, timestamp in local:
+            self._pubUpdate(key, keyHash)
+        failed = set()
+        for owner, request in requests.items():
+            try:
+                request.get()
+            except RequestTimeout:
+                log.warning("Peer %s didn't store %d entries in time", owner, len(byPeer[owner]))
+                failed.add(owner)
+        return stored + sum(1 for owners in remote if not failed.issuperset(owners))
 
     def _rget(self, key):
-        h = hex_hash(key)
-        for pName in self._peers.keys():
-            peer = self._peers[pName]
-            for b in peer._ownedBuckets:
-                if h.startswith(b):
-                    return peer._makeRequest(["GET", str(key)])[2] 
+        """
+        Look up a key on one of the Peers that owns it.
+
+        :param key: The key to look up.
+        :return: The value stored for `key`, or 'KeyError' if no known Peer has a value for it.
+        """
+        remote = self._rmget([key])
+        if key in remote:
+            return remote[key][0]
+        return 'KeyError'
+
+    def _cachedGet(self, keys, keyHashes):
+        """
+        Look up keys this Node doesn't own, serving what it can from the near cache.
+
+        Keys missing from the cache are fetched with :meth:`_rmget` and cached, and the SUB socket is subscribed to
+        their updates so the cache stays current. Only the fetched keys' topics are added here, so a miss costs no
+        more than the keys it fetched; topics of evicted entries are dropped the next time ownership changes.
+
+        :param keys: The keys to look up.
+        :param keyHashes: A :class:`dict` mapping each key to its hex digest.
+        :return: A :class:`dict` mapping each key found to a (value, timestamp) tuple.
+        """
+        if self._cache is None:
+            return self._rmget(keys, keyHashes)
+        found = dict()
+        for key in keys:
+            hit = self._cache.get(key)
+            if hit is not None:
+                found[key] = hit
+        remote = self._rmget([key for key in keys if not key in found], keyHashes)
+        for key, (value, timestamp) in remote.items():
+            self._cache.put(key, keyHashes[key], value, timestamp)
+        self._subscribe("UPDATE|" + keyHashes[key][:self._table._prefixLength] for key in remote)
+        found.update(remote)
+        return found
+
+    def _stats(self):
+        """
+        :return: A :class:`dict` of statistics about this Node, for the STATS control command.
+        """
+        return {
+            'id': self._id,
+            'peers': len(self._peers),
+            'nearCache': self._cache.stats() if self._cache is not None else None,
+            'migrations': len(self._migrations),
+            'incomingPartitions': len(self._incoming),
+            'requestTimeouts': self._requestTimeouts,
+            'suspectPeers': sum(1 for identity in self._peers if not self._membership.isAlive(identity)),
+            'knownNodes': len(self._knownNodes),
+            'tombstones': len(self._tombstones),
+            'activeView': self._view.stats() if self._view is not None else None,
+            'busyReplies': self._busyReplies,
+            'admission': dict((name, queue.stats()) for name, queue in self._workQueues.items()),
+            'reads': {
+                'latency': self._readLatency.stats(),
+                'hedged': self._hedgedReads,
+                'repairs': self._readRepairs,
+            },
+        }
+
+    def _migrationProgress(self):
+        """
+        :return: A :class:`dict` of the progress of this Node's partition migrations, for the MIGRATIONS control
+            command: the active and recently finished migrations to other Nodes (see
+            :meth:`~zht.migration.Migration.progress`), and the partitions waiting to be migrated to this Node.
+        """
+        return {
+            'outgoing': [migration.progress() for migration in self._migrations.values()],
+            'finished': [migration.progress() for migration in self._pastMigrations],
+            'incoming': sorted(self._incoming),
+        }
+
+    def _rmget(self, keys, keyHashes=None, mode='first', quorum=2, deadline=None):
+        """
+        Look up several keys on the Peers that own them.
+
+        Keys are grouped by owning Peer, so this makes one MGET request per Peer no matter how many keys there are.
+        The requests to different Peers are made concurrently. How slow or stale owners are dealt with depends on
+        `mode`:
+
+         - 'first': each group of keys is requested from one owner, and its answer is used. If the owner doesn't
+           answer within the request timeout, the keys are requested from the other owners (see
+           :meth:`_failoverMget`).
+         - 'hedged': as 'first', but if an owner takes longer to answer than the hedge percentile of recent reads,
+           its keys are requested from other owners as well and the first answer is used (see :meth:`_hedgedMget`).
+         - 'quorum': each key is requested from every known owner, and the newest value returned by the first
+           `quorum` of them is used (see :meth:`_quorumMget`).
+
+        :param keys: The keys to look up.
+        :param keyHashes: A :class:`dict` of the hex digests of `keys`, if already known.
+        :param mode: The read mode, from :data:`READ_MODES`.
+        :param quorum: The number of owners that must answer for each key, in 'quorum' mode.
+        :param deadline: The time by which every answer must have arrived. Defaults to the read timeout from now.
+        :return: A :class:`dict` mapping each key that was found to a (value, timestamp) tuple.
+        :raise: :class:`~zht.peer.RequestTimeout` if some keys couldn't be read from any of their owners in time.
+        """
+        if not mode in READ_MODES:
+            raise ValueError("Unknown read mode '%s'" % (mode,))
+        keyHashes = keyHashes or dict((key, self._table.keyHash(key)) for key in keys)
+        if deadline is None:
+            deadline = time() + self._readTimeout
+        if mode == 'quorum':
+            return self._quorumMget(keys, keyHashes, quorum, deadline)
+        byPeer = self._groupByOwner([(key, keyHashes[key]) for key in keys])
+        if mode == 'hedged':
+            requests = [self.spawn(self._hedgedMget, pName, pKeys, deadline) for pName, pKeys in byPeer.items()]
+        else:
+            requests = [self.spawn(self._failoverMget, pName, pKeys, deadline) for pName, pKeys in byPeer.items()]
+        found = dict()
+        for request in requests:
+            found.update(request.get())
+        return found
+
+    def _groupByOwner(self, keys, exclude=()):
+        """
+        Group keys by a Peer that owns them, using as few Peers as possible.
+
+        :param keys: An iterable of (key, key hash) tuples.
+        :param exclude: The identities of Peers not to use.
+        :return: A :class:`dict` mapping Peer identities to lists of (key, key hash) tuples. Keys with no known owner
+            are left out.
+        """
+        byPeer = dict()
+        for key, keyHash in keys:
+            owners = set(owner for owner in self._routes.lookup(keyHash)
+                         if not owner in exclude and self._available(owner))
+            if owners:
+                batched = owners.intersection(byPeer)
+                byPeer.setdefault(next(iter(batched or owners)), []).append((key, keyHash))
+        return byPeer
+
+    def _failoverMget(self, peerId, keys, deadline, tried=()):
+        """
+        Look up keys on a Peer that owns them, or on the other owners if it doesn't answer in time or is too busy.
+
+        Each owner gets one attempt of up to the request timeout; a Peer that times out is more likely down than
+        slow, so the next owner is asked rather than the same one again.
+
+        :param peerId: The identity of the Peer to ask first.
+        :param keys: A :class:`list` of (key, key hash) tuples.
+        :param deadline: The time by which every answer must have arrived.
+        :param tried: The identities of owners that have already timed out.
+        :return: A :class:`dict` mapping each key that was found to a (value, timestamp) tuple.
+        :raise: :class:`~zht.peer.RequestTimeout` if no owner of some of the keys answered in time.
+        """
+        tried = set(tried)
+        tried.add(peerId)
+        try:
+            return self._peers[peerId].mget(keys, deadline, retries=0)
+        except RequestTimeout:
+            byPeer = self._groupByOwner(keys, exclude=tried)
+            if sum(len(pKeys) for pKeys in byPeer.values()) < len(keys):
+                raise
+            log.info("Failing over read of %d keys from peer %s", len(keys), peerId)
+        requests = [self.spawn(self._failoverMget, pName, pKeys, deadline, tried) for pName, pKeys in byPeer.items()]
+        found = dict()
+        for request in requests:
+            found.update(request.get())
+        return found
+
+    def _hedgedMget(self, peerId, keys, deadline=None):
+        """
+        Look up keys on a Peer that owns them, and on other owners as well if it is slow to answer.
+
+        If the Peer hasn't answered within the hedge delay, the keys are requested from other owners too, and
+        whichever answer comes first is used. Keys are only hedged if every one of them has another known owner.
+        Once both answers are in, any owner that answered with an older version is repaired (see
+        :meth:`_readRepair`).
+
+        :param peerId: The identity of the Peer to ask first.
+        :param keys: A :class:`list` of (key, key hash) tuples.
+        :param deadline: The time by which every answer must have arrived, or `None`.
+        :return: A :class:`dict` mapping each key that was found to a (value, timestamp) tuple.
+        :raise: :class:`~zht.peer.RequestTimeout` if no owner answered in time.
+        """
+        primary = self.spawn(self._peers[peerId].mget, keys, deadline, 0)
+        primary.join(self._hedgeAfter())
+        if primary.ready():
+            return primary.get()
+        byPeer = self._groupByOwner(keys, exclude=[peerId])
+        if sum(len(pKeys) for pKeys in byPeer.values()) < len(keys):
+            return primary.get()
+        self._hedgedReads += 1
+        backup = self.spawn(self._mgetAll, byPeer, deadline)
+        result = AsyncResult()
+        def answered(request):
+            if result.ready():
+                return
+            if request.successful():
+                result.set(request.value)
+            elif primary.ready() and backup.ready():
+                result.set_exception(request.exception)
+        primary.link(answered)
+        backup.link(answered)
+        self.spawn(self._repairHedged, peerId, keys, primary, byPeer, backup)
+        return result.get()
+
+    def _repairHedged(self, peerId, keys, primary, byPeer, backup):
+        """
+        Wait for both answers to a hedged read, then repair the owners that answered with older versions.
+        """
+        primary.join()
+        backup.join()
+        replies = dict()
+        if primary.successful():
+            replies[peerId] = (keys, primary.value)
+        if backup.successful():
+            for pName, pKeys in byPeer.items():
+                replies[pName] = (pKeys, backup.value)
+        self._readRepair(replies)
+
+    def _hedgeAfter(self):
+        """
+        :return: The seconds to wait for a Peer to answer a read before hedging it: the hedge percentile of recent
+            read latencies, or the configured hedge delay until enough have been measured.
+        """
+        if len(self._readLatency) < _MIN_HEDGE_SAMPLES:
+            return self._hedgeDelay
+        return self._readLatency.percentile(self._hedgePercentile)
+
+    def _mgetAll(self, byPeer, deadline=None):
+        """
+        Look up keys on several Peers at once.
+
+        :param byPeer: A :class:`dict` mapping Peer identities to lists of (key, key hash) tuples to request.
+        :param deadline: The time by which every answer must have arrived, or `None`.
+        :return: A :class:`dict` mapping each key that was found to a (value, timestamp) tuple.
+        """
+        requests = [self.spawn(self._peers[pName].mget, pKeys, deadline, 0) for pName, pKeys in byPeer.items()]
+        found = dict()
+        for request in requests:
+            found.update(request.get())
+        return found
+
+    def _quorumMget(self, keys, keyHashes, quorum, deadline=None):
+        """
+        Look up keys on several of the Peers that own each of them, using the newest values found.
+
+        Every key is requested from each known owner, with one MGET request per Peer. Answers are taken as they come,
+        until `quorum` owners of every key (or all of them, if fewer are known) have answered; slower answers are
+        not waited for. Once every answer is in, the owners that answered with older versions are repaired in the
+        background (see :meth:`_readRepair`).
+
+        :param keys: The keys to look up.
+        :param keyHashes: A :class:`dict` mapping each key to its hex digest.
+        :param quorum: The number of owners that must answer for each key.
+        :param deadline: The time by which every answer must have arrived, or `None`.
+        :return: A :class:`dict` mapping each key that was found to a (value, timestamp) tuple.
+        :raise: :class:`~zht.peer.RequestTimeout` if too few owners of some key answered in time.
+        """
+        byPeer = dict()
+        needed = dict()
+        for key in keys:
+            owners = [owner for owner in self._routes.lookup(keyHashes[key]) if self._available(owner)]
+            for owner in owners:
+                byPeer.setdefault(owner, []).append((key, keyHashes[key]))
+            if owners:
+                needed[key] = min(quorum, len(owners))
+        answers = Queue()
+        for pName, pKeys in byPeer.items():
+            self.spawn(self._peers[pName].mget, pKeys, deadline).link(
+                lambda request, pName=pName: answers.put((pName, request)))
+        found = dict()
+        replies = dict()
+        taken = 0
+        timedOut = False
+        while needed and taken < len(byPeer):
+            pName, request = answers.get()
+            taken += 1
+            if not request.successful():
+                timedOut = timedOut or isinstance(request.exception, RequestTimeout)
+                continue
+            replies[pName] = (byPeer[pName], request.value)
+            for key, keyHash in byPeer[pName]:
+                if key in request.value:
+                    value, timestamp = request.value[key]
+                    if not key in found or found[key][1] < timestamp:
+                        found[key] = (value, timestamp)
+                if key in needed:
+                    needed[key] -= 1
+                    if not needed[key]:
+                        del needed[key]
+        self.spawn(self._repairQuorum, byPeer, answers, len(byPeer) - taken, replies)
+        if needed and timedOut:
+            raise RequestTimeout("Too few owners of %d keys answered in time" % (len(needed),))
+        return found
+
+    def _repairQuorum(self, byPeer, answers, waiting, replies):
+        """
+        Collect the answers to a quorum read that weren't waited for, then repair the owners that answered with older
+        versions.
+
+        :param byPeer: A :class:`dict` mapping Peer identities to the (key, key hash) tuples requested from them.
+        :param answers: The :class:`~gevent.queue.Queue` the answers are put on.
+        :param waiting: The number of answers still to come.
+        :param replies: The answers taken so far, as for :meth:`_readRepair`.
+        """
+        for i in range(waiting):
+            pName, request = answers.get()
+            if request.successful():
+                replies[pName] = (byPeer[pName], request.value)
+        self._readRepair(replies)
+
+    def _readRepair(self, replies):
+        """
+        Push the newest version of each key read from several owners back to the owners that answered with an older
+        version, or with none.
+
+        The newest version is sent with an MPUT request, so each owner applies it under the usual last-write-wins
+        rules and publishes it. Every entry an owner accepts is counted as a repair in the STATS control command.
+
+        :param replies: A :class:`dict` mapping Peer identities to tuples of the (key, key hash) tuples requested
+            from the Peer and the :class:`dict` of (value, timestamp) tuples it answered with.
+        """
+        newest = dict()
+        for keys, answer in replies.values():
+            for key, keyHash in keys:
+                if key in answer and (not key in newest or newest[key][1] < answer[key][1]):
+                    newest[key] = answer[key]
+        requests = []
+        for pName, (keys, answer) in replies.items():
+            stale = [(key, keyHash) + newest[key] for key, keyHash in keys
+                     if key in newest and (not key in answer or answer[key][1] < newest[key][1])]
+            if stale and self._available(pName):
+                log.debug("Repairing %d keys on peer %s", len(stale), pName)
+                requests.append(self.spawn(self._peers[pName].mput, stale))
+        for request in requests:
+            try:
+                self._readRepairs += request.get()
+            except Exception:
+                log.exception("Read repair failed")
 
     def _handleRep(self):
         """
         Handle requests recieved over the REP socket.
 
-        Each request is handled in a spawned greenlet.
+        Each request is queued for the work queue of its traffic class (see :data:`REQUEST_CLASSES`). If the queue is
+        full, the request is answered with a BUSY error straight away instead.
         """
         while True:
             m = self._rep.recv_multipart()
-            self.spawn(self._handleRepMessage, m)
+            if not "" in m:
+                repLog.warning("Dropping request without an envelope delimiter: %s", m)
+                continue
+            i = m.index("")
+            verb = m[i+1] if len(m) > i + 1 else ""
+            if not self._workQueues[REQUEST_CLASSES.get(verb, 'membership')].submit(self._handleRepMessage, m):
+                repLog.debug("Shedding %s request, its work queue is full", verb)
+                self._rep.send_multipart(m[:i+1] + ["ERROR", "Busy", verb])
 
     def _handleRepMessage(self, m):
         """
@@ -187,46 +1214,279 @@ class Node(object):
             i += 1
         envelope = m[:i+1]
         msg = m[i+1:]
+        codec = self._peerCodec(envelope)
         reply = None
         if msg[0] == "PEER":
             peerInfo = (msg[1], msg[2], msg[3])
             repLog.debug("Recieved PEER request: identity:%s  REP:%s  PUB:%s", *peerInfo)
-            reply = envelope + ["PEER", self._id, self._pubAddr]
-            if not peerInfo[0] in self._peers.keys():
-                self._subConnect(peerInfo[2])
-                self._peers[peerInfo[0]] = Peer(self, peerInfo[0], peerInfo[1], peerInfo[2], self._reqConnect(peerInfo[1]))
-                self._pubPeer(peerInfo[0], peerInfo[1])
+            hashFunction = msg[4] if len(msg) > 4 else 'sha1'
+            codec = negotiate(msg[5] if len(msg) > 5 else "", self._codecs)
+            reply = envelope + ["PEER", self._id, self._pubAddr, self._table._hashFunction, codec.name]
+            if hashFunction != self._table._hashFunction:
+                repLog.error("Refused peer %s: hash function '%s' doesn't match '%s'", peerInfo[0], hashFunction,
+                             self._table._hashFunction)
+                reply = envelope + ["ERROR", "HashMismatch", "PEER", self._table._hashFunction]
+            elif not peerInfo[0] in self._peers.keys():
+                self._addPeer(peerInfo[0], peerInfo[1], peerInfo[2], self._reqConnect(peerInfo[1]), codec)
         elif msg[0] == "PEERS":
             repLog.debug("Recieved PEERS request")
             reply = envelope
             reply.append("PEERS")
-            reply.append(json.dumps(dict(((ident, peer._repAddr) for ident, peer in self._peers.items()))))
+            reply.append(codec.encodePeers(self._knownNodes))
+        elif msg[0] == "SHUFFLE":
+            received = detect(msg[1:]).decodePeers(msg[1])
+            repLog.debug("Recieved SHUFFLE request with %d nodes", len(received))
+            reply = envelope + ["SHUFFLE", codec.encodePeers(self._shuffleSample())]
+            for identity, addr in received.items():
+                self._learnNode(identity, addr)
         elif msg[0] == "BUCKETS":
             repLog.debug("Recieved BUCKETS request")
-            reply = envelope + ["BUCKETS", json.dumps(self._table.ownedBuckets())]
+            reply = envelope + ["BUCKETS", codec.encodeBuckets(self._announcedBuckets())]
         elif msg[0] == "KEYS":
-            repLog.debug("Recieved KEYS request for bucket '%s'" % (msg[1],))
-            reply = envelope + ["KEYS", msg[1], json.dumps(self._table.getKeySet(msg[1], includeTimestamp=True))]
+            repLog.debug("Recieved KEYS request for bucket '%s' since %s", msg[1], msg[2:])
+            since = self._parseSyncMark(msg[2]) if len(msg) > 2 else True
+            if since is None:
+                reply = envelope + ["ERROR", "StaleMark", "KEYS", msg[1]]
+            else:
+                mark = self._syncMark()
+                reply = envelope + ["KEYS", msg[1], codec.encodeKeys(self._table.getEntries(msg[1], since)), mark]
+        elif msg[0] == "TREE":
+            repLog.debug("Recieved TREE request for %s", msg[1:])
+            levels = dict()
+            for prefix in msg[1:]:
+                digests = [self._table.treeDigest(prefix)]
+                if len(prefix) < self._table._treeDepth:
+                    digests.extend(self._table.treeChildren(prefix))
+                levels[prefix] = digests
+            reply = envelope + ["TREE", codec.encodeTree(levels), self._syncMark()]
         elif msg[0] == "GET":
             repLog.debug("Recieved GET request for key '%s'", msg[1])
             try:
-                entry = self._table.getValue(msg[1])
+                entry = self._table.getValue(msg[1], msg[2] if len(msg) > 2 else None)
                 reply = envelope + ["GET", msg[1], entry._value, repr(entry._timestamp)]
-            except KeyError:
-                reply = ["ERROR", "KeyError", "GET", msg[1]]
+            except (KeyError, NotImplementedError):
+                reply = envelope + ["ERROR", "KeyError", "GET", msg[1]]
+        elif msg[0] in ("MGET", "MGET-SYNC"):
+            repLog.debug("Recieved %s request for %d keys", msg[0], (len(msg) - 1) / 2)
+            entries = []
+            for i in range(1, len(msg) - 1, 2):
+                try:
+                    entries.append(self._table.getValue(msg[i], msg[i+1]))
+                except (KeyError, NotImplementedError):
+                    pass
+            reply = envelope + ["MGET"] + codec.encodeValues(entries)
+        elif msg[0] == "MGET-CLIENT":
+            keys = zip(msg[1::2], msg[2::2])
+            repLog.debug("Recieved MGET-CLIENT request for %d keys", len(keys))
+            misrouted = [key for key, keyHash in keys if not self._serves(key, keyHash)]
+            if not self._checkKeyHashes(keys):
+                reply = envelope + ["ERROR", "HashMismatch", "MGET-CLIENT", self._table._hashFunction]
+            elif misrouted:
+                reply = envelope + ["ERROR", "NotOwner", "MGET-CLIENT"] + misrouted
+            else:
+                entries = []
+                for key, keyHash in keys:
+                    try:
+                        entries.append(self._table.getValue(key, keyHash))
+                    except KeyError:
+                        pass
+                reply = envelope + ["MGET"] + codec.encodeValues(entries)
+        elif msg[0] == "MPUT-CLIENT":
+            now = time()
+            entries = [(msg[i], msg[i+1], msg[i+2], now) for i in range(1, len(msg) - 2, 3)]
+            repLog.debug("Recieved MPUT-CLIENT request for %d keys", len(entries))
+            misrouted = [key for key, keyHash, value, timestamp in entries if not self._table.owns(key, keyHash)]
+            if not self._checkKeyHashes((key, keyHash) for key, keyHash, value, timestamp in entries):
+                reply = envelope + ["ERROR", "HashMismatch", "MPUT-CLIENT", self._table._hashFunction]
+            elif misrouted:
+                reply = envelope + ["ERROR", "NotOwner", "MPUT-CLIENT"] + misrouted
+            else:
+                reply = envelope + ["MPUT", str(self._put(entries))]
+        elif msg[0] == "MPUT":
+            stores = detect(msg[1:]).decodeStores(msg[1:])
+            repLog.debug("Recieved MPUT request for %d keys", len(stores))
+            accepted = 0
+            origin = envelope[0].partition(":DEALER:")[0]
+            for key, keyHash, value, timestamp in stores:
+                if self._table.owns(key, keyHash) and self._table.putValue(key, value, timestamp, keyHash):
+                    accepted += 1
+                    self._pubUpdate(key, keyHash, origin)
+            reply = envelope + ["MPUT", str(accepted)]
+        elif msg[0] == "MIGRATE":
+            partition = msg[1]
+            if not partition in self._table.ownedPartitions():
+                reply = envelope + ["ERROR", "NotOwner", "MIGRATE", partition]
+            else:
+                stores = detect(msg[2:]).decodeStores(msg[2:])
+                repLog.debug("Recieved MIGRATE request for partition '%s': %d keys", partition, len(stores))
+                accepted = 0
+                for key, keyHash, value, timestamp in stores:
+                    if keyHash.startswith(partition) and self._table.putValue(key, value, timestamp, keyHash):
+                        accepted += 1
+                reply = envelope + ["MIGRATE", partition, str(accepted)]
+        elif msg[0] == "MIGRATED":
+            partition = msg[1]
+            repLog.debug("Recieved MIGRATED request for partition '%s'", partition)
+            if not partition in self._table.ownedPartitions():
+                reply = envelope + ["ERROR", "NotOwner", "MIGRATED", partition]
+            else:
+                if partition in self._incoming:
+                    log.info("Serving partition '%s' after it was migrated here", partition)
+                    self._incoming.discard(partition)
+                    self._pubBuckets()
+                reply = envelope + ["MIGRATED", partition]
         else:
             reply = envelope + ["ECHO"] + msg
         repLog.debug("REPLY: %s", reply)
         self._rep.send_multipart(reply)
 
-    def _pubUpdate(self, key):
+    def _checkKeyHashes(self, keys):
+        """
+        Check the key hashes a client sent against this Node's hash function, so a client configured with a different
+        one can't read or write keys under the wrong hashes.
+
+        :param keys: An iterable of (key, key hash) tuples.
+        :return: `True` if every key hash is right.
+        """
+        return all(self._table.keyHash(key) == keyHash for key, keyHash in keys)
+
+    def _peerCodec(self, envelope):
+        """
+        Return the codec negotiated with the Node a request came from.
+
+        :param envelope: The request's envelope. Its first frame is the identity of the sending DEALER socket (see
+            :meth:`_reqConnect`), which starts with the sending Node's identity.
+        :return: The Peer's codec, or the JSON codec if the request doesn't come from a known Peer.
+        """
+        peer = self._peers.get(envelope[0].partition(":DEALER:")[0])
+        return peer._codec if peer is not None else CODECS['json']
+
+    def _syncMark(self):
+        """
+        Return a mark for the current point in this Node's modification history.
+
+        A Peer that has synchronized up to a mark can later ask for only the keys modified since. Marks name this
+        Node's incarnation, so marks handed out before a restart are recognized as stale.
         """
-        Send an update message over the PUB socket for the given key.
+        return "%s:%r" % (self._incarnation, time())
+
+    def _parseSyncMark(self, mark):
+        """
+        Return the modification time of a mark from :meth:`_syncMark`.
+
+        :param mark: The mark to parse.
+        :return: The time as a :class:`float`, or `None` if the mark was handed out by an earlier incarnation.
+        """
+        incarnation, _, markTime = mark.partition(":")
+        if incarnation != self._incarnation:
+            return None
+        return float(markTime)
+
+    def _pubUpdate(self, key, keyHash=None, origin=None):
+        """
+        Queue an update message over the PUB socket for the given key.
+
+        Updates are buffered for up to the update interval, and only the latest version of each key is sent (see
+        :meth:`_flushUpdates`).
 
         :param key: The key to give an update for.
+        :param keyHash: The hex digest of `key`, if already known.
+        :param origin: The identity of the Node the update was first written on. Defaults to this Node.
+        """
+        self._pendingUpdates[key] = (keyHash or self._table.keyHash(key), origin or self._id)
+        if not self._updateInterval or len(self._pendingUpdates) >= self._updateBatchSize:
+            self._flushUpdates()
+        else:
+            self._updatesPending.set()
+
+    def _publishUpdates(self):
+        """
+        Publish buffered updates once they have waited for the update interval.
         """
-        entry = self._table.getValue(key)
-        self._pub.send_multipart(["UPDATE|" + entry._hash, key, entry._value, repr(entry._timestamp)])
+        while True:
+            self._updatesPending.wait()
+            sleep(self._updateInterval)
+            self._updatesPending.clear()
+            self._flushUpdates()
+
+    def _flushUpdates(self):
+        """
+        Publish every buffered update now.
+
+        Updates are grouped by origin and by the key hash prefix of the Table's initial buckets, and each group is
+        sent as one UPDATE message whose topic is that prefix, so subscribers apply a whole group at once.
+        """
+        pending, self._pendingUpdates = self._pendingUpdates, dict()
+        batches = dict()
+        for key, (keyHash, origin) in pending.items():
+            try:
+                entry = self._table.getValue(key, keyHash)
+            except (KeyError, NotImplementedError):
+                # The key's partition has been released since the update was buffered.
+                continue
+            batches.setdefault((keyHash[:self._table._prefixLength], origin), []).extend(
+                (keyHash, key, entry._value, repr(entry._timestamp)))
+        for (prefix, origin), frames in batches.items():
+            pubLog.debug("UPDATE|%s from %s: %d keys", prefix, origin, len(frames) / 4)
+            self._pub.send_multipart(["UPDATE|" + prefix, origin] + frames)
+
+    def _forwardUpdate(self, key, keyHash, origin):
+        """
+        Pass on an update received from another Node, if the forwarding strategy says to.
+
+        :param key: The key that was updated.
+        :param keyHash: The hex digest of `key`.
+        :param origin: The identity of the Node the update was first written on.
+        """
+        if self._forwarding == 'flood' or (self._forwarding == 'gossip' and random() < self._gossipProbability):
+            self._pubUpdate(key, keyHash, origin)
+
+    def _applyUpdate(self, key, keyHash, value, timestamp, origin):
+        """
+        Store an update received over the SUB socket, unless its version has been seen recently.
+
+        A version is the key hash, timestamp and origin of an update, so the same write reaching this Node by
+        several paths is only applied (and forwarded) once.
+
+        :return: `True` if the update was stored.
+        """
+        if origin == self._id or not self._seenUpdates.add((keyHash, timestamp, origin)):
+            return False
+        if not self._table.owns(key, keyHash):
+            if self._cache is not None:
+                self._cache.update(key, value, timestamp)
+            return False
+        if self._table.putValue(key, value, timestamp, keyHash):
+            self._forwardUpdate(key, keyHash, origin)
+            return True
+        return False
+
+    def _shuffle(self):
+        """
+        Periodically exchange a random sample of known Nodes with a random neighbour, so announcements of Nodes that
+        were missed are made up for.
+        """
+        while True:
+            sleep(self._shuffleInterval)
+            neighbours = [identity for identity in self._view.active if self._available(identity)]
+            if not neighbours:
+                continue
+            peer = self._peers[choice(neighbours)]
+            try:
+                received = peer.shuffle(self._shuffleSample())
+            except RequestTimeout:
+                continue
+            for identity, addr in received.items():
+                self._learnNode(identity, addr)
+
+    def _shuffleSample(self):
+        """
+        :return: A :class:`dict` of this Node and a random sample of the Nodes it knows of, mapping identities to
+            XREP addresses, for a SHUFFLE exchange.
+        """
+        nodes = self._view.sample(self._knownNodes, self._shuffleLength) if self._view is not None else dict()
+        nodes[self._id] = self._repAddr
+        return nodes
 
     def _pubPeer(self, id, addr):
         self._pub.send_multipart(["PEER", str(id), str(addr)])
@@ -235,16 +1495,92 @@ class Node(object):
         """
         Handle messages recieved over the SUB socket.
 
-        Each message is handled in a spawned greenlet.
+        Each message is queued for the 'updates' or 'membership' work queue. Messages that arrive when their queue is
+        full are dropped; missed updates are repaired by anti-entropy, and heartbeats are published again.
         """
         while True:
             m = self._sub.recv_multipart()
-            self.spawn(self._handleSubMessage, m)
+            name = 'updates' if m[0][:7] == 'UPDATE|' else 'membership'
+            if not self._workQueues[name].submit(self._handleSubMessage, m):
+                subLog.debug("Dropping %s message, its work queue is full", m[0])
 
     def _heartbeat(self):
+        """
+        Periodically announce that this Node is alive, along with the Buckets it owns, so Peers that missed an
+        ownership change catch up.
+        """
+        while True:
+            self._pub.send_multipart(['HEARTBEAT', self._id, self._repAddr])
+            self._pubBuckets()
+            sleep(self._heartbeatInterval)
+
+    def _watchMembers(self):
+        """
+        Periodically judge each Peer by its heartbeats (see :class:`~zht.membership.Membership`).
+
+        Suspect Peers stay Peers, but aren't counted as owners of partitions (see :meth:`_memberIds`), routed to,
+        synchronized with or repaired until their heartbeats resume. Dead Peers are dropped; if one is only
+        partitioned away, its next heartbeat reconnects it. The partitions are rebalanced whenever a Peer changes
+        state.
+        """
         while True:
-            self._pub.send_multipart(['HEARTBEAT', self._id])
-            sleep(30)
+            sleep(self._heartbeatInterval / 2.0)
+            changed = False
+            for identity, old, new in self._membership.update():
+                if new == 'dead':
+                    log.warning("Peer %s is dead", identity)
+                    self._dropPeer(identity)
+                elif new == 'suspect':
+                    log.warning("Peer %s is suspected of having failed", identity)
+                    changed = True
+                else:
+                    log.info("Peer %s is alive again", identity)
+                    changed = True
+            if changed:
+                self._rebalance()
+
+    def _antiEntropy(self):
+        """
+        Periodically synchronize shared Buckets with every Peer, to repair any updates that were missed.
+        """
+        while True:
+            sleep(self._antiEntropyInterval)
+            deadline = time() + self._antiEntropyInterval
+            for peer in self._peers.values():
+                if peer.isInitialized() and self._available(peer._id):
+                    try:
+                        peer.sync(deadline=deadline)
+                    except Exception:
+                        log.exception("Anti-entropy round with peer %s failed", peer._id)
+
+    def _commitStorage(self):
+        """
+        Periodically force the write log to disk, committing every store made since as a group.
+        """
+        while True:
+            sleep(self._fsyncInterval)
+            self._storage.commit()
+
+    def _snapshotStorage(self):
+        """
+        Periodically snapshot the Table, along with the current sync marks, and whenever one is asked for with
+        :meth:`_requestSnapshot`.
+        """
+        while True:
+            self._snapshotWanted.wait(self._snapshotInterval or None)
+            self._snapshotWanted.clear()
+            try:
+                self._storage.snapshot(self._table, self._syncMarks)
+            except Exception:
+                log.exception("Snapshot failed")
+
+    def _requestSnapshot(self):
+        """
+        Ask for a snapshot of the Table to be taken soon, such as after a partition's entries have been cleared, which
+        the write log has no record of. Requests made before the snapshot starts are served by the same one.
+        """
+        if self._storage is not None:
+            self._snapshotWanted.set()
 
     def _handleSubMessage(self, m):
         """
@@ -253,17 +1589,33 @@ class Node(object):
         :param m: The message to handle.
         """
         subLog.debug("SUB: Recieved %s", m)
-        if m[0][:7] == 'UPDATE|':
+        if m[0][:7] == 'UPDATE|' and len(m) == 4:
             subLog.debug("UPDATE key:%s value:%s timestamp:%s", m[1], m[2], m[3])
-            if self._table.putValue(m[1], m[2], float(m[3])):
-                self._pubUpdate(m[1])
+            self._applyUpdate(m[1], m[0][7:], m[2], float(m[3]), "")
+        elif m[0][:7] == 'UPDATE|':
+            subLog.debug("UPDATE batch for '%s' from %s: %d keys", m[0][7:], m[1], (len(m) - 2) / 4)
+            for i in range(2, len(m) - 3, 4):
+                self._applyUpdate(m[i+1], m[i], m[i+2], float(m[i+3]), m[1])
+        elif m[0] == 'BUCKETS':
+            peer = self._peers.get(m[1])
+            subLog.debug("BUCKETS: id:'%s' %d buckets", m[1], len(m) - 2)
+            if peer is not None:
+                peer._ownedBuckets = set(m[2:])
+                self._routes.setPeerBuckets(m[1], peer._ownedBuckets)
         elif m[0] == 'HEARTBEAT':
             id = m[1]
             subLog.debug("HEARTBEAT: id:'%s'", id)
+            if id in self._peers:
+                self._membership.heartbeat(id)
+            elif len(m) > 2:
+                self._learnNode(id, m[2], direct=True)
         elif m[0] == 'PEER':
             id = m[1]
             addr = m[2]
             subLog.debug("PEER: id:'%s', addr:'%s'", id, addr)
-            if not id in self._peers.keys() and id != self._id:
-                self.connect(addr)
+            self._learnNode(id, addr)
+        elif m[0] == 'LEAVE':
+            subLog.debug("LEAVE: id:'%s'", m[1])
+            if m[1] != self._id:
+                self._forgetNode(m[1])
 
@@ -4,10 +4,29 @@
 """
 Peers are the outside entities that each Node communicates with.
 """
-import json
+from gevent import Timeout, sleep
+from gevent.event import AsyncResult
+from itertools import count
+from time import time
+from zht.merkle import HEX_DIGITS
+from zht.codec import CODECS, detect
 import logging
 log = logging.getLogger('zht.peer')
 
+class RequestTimeout(Exception):
+    """
+    Raised when a Peer doesn't answer a request in time.
+    """
+
+class PeerBusy(RequestTimeout):
+    """
+    Raised when a Peer is still too busy to handle a request after it has been retried (see
+    :mod:`zht.admission`). It is a :class:`RequestTimeout`, so callers fail over the same way.
+    """
+
+# Seconds to back off for before resending a request that a Peer was too busy for; doubled on every retry.
+_BUSY_BACKOFF = 0.01
+
 class Peer(object):
     """
     Construct a new Peer instance.
@@ -18,61 +37,290 @@ class Peer(object):
     :param identity: The identity string of the remote Peer.
     :param repAddr: The ZMQ address of the remote Peer's REP socket.
     :param pubAddr: The ZMQ address of the remote Peer's PUB socket.
-    :param sock: A ZMQ REQ socket connected to the remote Peer's REP socket.
+    :param sock: A ZMQ DEALER socket connected to the remote Peer's REP socket.
+    :param codec: The codec negotiated with the remote Peer (see :mod:`zht.codec`), used to encode MPUT requests.
+        Defaults to JSON. Replies are decoded in whichever codec they were sent in.
      
+    Requests are tagged with a request ID in the message envelope, so any number of greenlets can have requests
+    outstanding to the same Peer at once. Replies are matched up to their request by a reader greenlet. Every request
+    times out after the Node's request timeout, and may be given an overall deadline (see :meth:`_makeRequest`).
     """
-    def __init__(self, node, identity, repAddr, pubAddr, sock):
+    def __init__(self, node, identity, repAddr, pubAddr, sock, codec=None):
         self._node = node
         self._id = identity
         self._repAddr = repAddr
         self._pubAddr = pubAddr
         self._sock = sock
+        self._codec = codec or CODECS['json']
+        self._pending = dict()
+        self._requestIds = count()
         self._partitions = set()
         self.__initialized = False
+        self._reader = self._node.spawn(self._handleReplies)
         self._node.spawn(self._initState)
 
     def _initState(self):
         """
         Initialize the internal state of this Peer object.
 
-        Any Bucket synchronization that needs to happen will occur during this initialization process. 
+        Any Bucket synchronization that needs to happen will occur during this initialization process. If the Peer
+        is too busy, it is tried again after a while; if it doesn't answer, it is dropped.
+        """
+        while True:
+            try:
+                self._fetchState()
+                break
+            except PeerBusy:
+                log.info("Peer %s is too busy to initialize, retrying", self._id)
+                sleep(self._node._requestTimeout or 1)
+            except RequestTimeout:
+                log.warning("Peer %s didn't answer while initializing, dropping it", self._id)
+                self._node._dropPeer(self._id)
+                return
+        log.info("Peer %s initialized", self._id)
+        self.__initialized = True
+
+    def _fetchState(self):
+        """
+        Learn this Peer's peers and Buckets, and synchronize the Buckets shared with it.
         """
         reply = self._makeRequest(["PEERS"])
         if reply[0] == "PEERS":
-            peerDict = json.loads(reply[1])
+            peerDict = detect(reply[1:]).decodePeers(reply[1])
             for id, addr in peerDict.items():
                 log.debug("Peer %s: ID:%s repAddr:%s", self._id, id, addr)
-                if id != self._node._id and not id in self._node._peers:
-                    log.debug("Autopeering: connect to ID:'%s', addr:'%s'", id, addr)
-                    self._node.connect(addr)
+                self._node._learnNode(id, addr)
         reply = self._makeRequest(["BUCKETS"])
-        self._ownedBuckets = set(json.loads(reply[1]))
-        for prefix in self._ownedBuckets:
-            if prefix in self._node._table.ownedBuckets():
-                keysReply = self._makeRequest(["KEYS", str(prefix)])
-                log.debug(str(keysReply))
-                keysDict = json.loads(keysReply[2])
-                for key, timestamp in keysDict.items():
-                    try:
-                        entry = self._node._table.getValue(str(key))
-                        if entry._timestamp < float(timestamp):
-                            getReply = self._makeRequest(["GET", str(key)])
-                            if entry.putValue(msg[2], float(msg[3])):
-                                self._node._pubUpdate(str(key))
-                    except KeyError:
-                        getReply = self._makeRequest(["GET", str(key)])
-                        if self._node._table.putValue(str(key), getReply[2], float(getReply[3])):
-                            self._node._pubUpdate(str(key))
-        log.info("Peer %s initialized", self._id)
-        self.__initialized = True
-    
-    def _makeRequest(self, req):
+        self._ownedBuckets = set(detect(reply[1:]).decodeBuckets(reply[1]))
+        self._node._routes.setPeerBuckets(self._id, self._ownedBuckets)
+        self.sync()
+
+    def isInitialized(self):
+        """
+        :return: `True` once this Peer's initial synchronization has finished.
+        """
+        return self.__initialized
+
+    def sync(self, partitions=None, deadline=None):
+        """
+        Bring every Bucket shared with this Peer up to date, by comparing hash trees (see :meth:`_syncTrees`).
+
+        :param partitions: If given, synchronize these partitions instead, whether or not the Peer announces them.
+        :param deadline: The time by which the sync must have finished, or `None`. Each request it makes is also
+            subject to the Node's request timeout.
+        :raise: :class:`RequestTimeout` if the Peer doesn't answer in time.
+        """
+        if partitions is None:
+            prefixes = self._node._table.sharedPrefixes(self._ownedBuckets)
+        else:
+            prefixes = partitions
+        self._syncTrees(sorted(prefixes), deadline)
+
+    def _syncTrees(self, prefixes, deadline=None):
+        """
+        Synchronize Buckets by comparing hash trees.
+
+        The hash trees of both copies are compared level by level with TREE requests, descending only into subtrees
+        whose digests differ. Keys are only exchanged for the differing leaves, so the cost of a sync scales with the
+        size of the difference rather than the size of the Buckets. A Bucket that has been synchronized with this
+        Peer before only lists the keys of its differing leaves that the Peer has modified since the last sync's
+        mark.
+
+        :param prefixes: The prefixes of the Buckets to synchronize.
+        :param deadline: The time by which the sync must have finished, or `None`.
+        """
+        table = self._node._table
+        marks = self._node._syncMarks
+        frontier = [(prefix, prefix) for prefix in prefixes]
+        leaves = []
+        mark = None
+        while frontier:
+            reply = self._makeRequest(["TREE"] + [prefix for prefix, root in frontier], deadline)
+            levels = detect(reply[1:2]).decodeTree(reply[1])
+            mark = mark or reply[2]
+            deeper = []
+            for prefix, root in frontier:
+                digests = levels[prefix]
+                if digests[0] == table.treeDigest(prefix):
+                    continue
+                elif len(digests) == 1:
+                    leaves.append((prefix, root))
+                    continue
+                for digit, local, remote in zip(HEX_DIGITS, table.treeChildren(prefix), digests[1:]):
+                    if local != remote:
+                        (deeper if len(prefix) + 1 < table._treeDepth else leaves).append((prefix + digit, root))
+            frontier = deeper
+        log.debug("Peer %s: %d differing hash tree leaves", self._id, len(leaves))
+        for prefix, root in leaves:
+            since = marks.get((self._id, root))
+            if since is None or not self._syncKeys(prefix, since, deadline):
+                self._syncKeys(prefix, deadline=deadline)
+        for prefix in prefixes:
+            marks[(self._id, prefix)] = mark
+
+    def _syncKeys(self, prefix, mark=None, deadline=None):
+        """
+        Fetch every key under a prefix that this Peer has a newer value for.
+
+        :param prefix: The key hash prefix to synchronize.
+        :param mark: If given, only consider keys the Peer has modified since this mark from an earlier sync.
+        :param deadline: The time by which the sync must have finished, or `None`.
+        :return: `False` if `mark` is stale (the Peer has restarted since), `True` otherwise.
+        """
+        keysReply = self._makeRequest(["KEYS", prefix] + ([mark] if mark else []), deadline)
+        log.debug(str(keysReply))
+        if keysReply[0] != "KEYS":
+            return False
+        stale = dict()
+        for key, timestamp, keyHash in detect(keysReply[2:3]).decodeKeys(keysReply[2]):
+            try:
+                if self._node._table.getValue(key, keyHash)._timestamp < timestamp:
+                    stale[key] = keyHash
+            except KeyError:
+                stale[key] = keyHash
+            except NotImplementedError:
+                # The partition has been migrated away since the sync began.
+                pass
+        if stale:
+            for key, (value, timestamp) in self.mget(stale.items(), deadline, sync=True).items():
+                if (self._node._table.owns(key, stale[key]) and
+                    self._node._table.putValue(key, value, timestamp, stale[key])):
+                    self._node._forwardUpdate(key, stale[key], self._id)
+        return True
+
+    def mget(self, keys, deadline=None, retries=None, sync=False):
+        """
+        Look up several keys on this Peer with a single MGET request. Its latency is recorded for hedging reads (see
+        :meth:`~zht.node.Node._hedgedMget`).
+
+        :param keys: An iterable of (key, key hash) tuples to look up.
+        :param deadline: The time by which the Peer must have answered, or `None`.
+        :param retries: How many times to resend the request if it times out, as for :meth:`_makeRequest`.
+        :param sync: If `True`, send an MGET-SYNC request instead, which the Peer handles as synchronization traffic
+            rather than as a client read (see :mod:`zht.admission`). Its latency isn't recorded.
+        :return: A :class:`dict` mapping each key the Peer has a value for to a (value, timestamp) tuple.
+        """
+        req = ["MGET-SYNC" if sync else "MGET"]
+        for key, keyHash in keys:
+            req.extend((key, keyHash))
+        started = time()
+        reply = self._makeRequest(req, deadline, retries)
+        if not sync:
+            self._node._readLatency.add(time() - started)
+        return dict((key, (value, timestamp)) for key, value, timestamp in detect(reply[1:]).decodeValues(reply[1:]))
+
+    def mput(self, entries, deadline=None):
+        """
+        Store several entries on this Peer with a single MPUT request.
+
+        :param entries: An iterable of (key, key hash, value, timestamp) tuples.
+        :param deadline: The time by which the Peer must have answered, or `None`.
+        :return: The number of entries the Peer accepted.
+        """
+        return int(self._makeRequest(["MPUT"] + self._codec.encodeStores(entries), deadline)[1])
+
+    def shuffle(self, nodes):
+        """
+        Exchange samples of known Nodes with this Peer, with a SHUFFLE request.
+
+        :param nodes: A :class:`dict` mapping the identities of Nodes to their XREP addresses.
+        :return: The Peer's sample, in the same form.
+        """
+        reply = self._makeRequest(["SHUFFLE", self._codec.encodePeers(nodes)])
+        return detect(reply[1:]).decodePeers(reply[1])
+
+    def migrate(self, partition, entries):
+        """
+        Send this Peer entries of a partition that is being migrated to it, with a MIGRATE request.
+
+        :param partition: The partition prefix.
+        :param entries: An iterable of (key, key hash, value, timestamp) tuples. An empty one just checks that the
+            Peer is ready to take the partition over.
+        :return: The number of entries the Peer accepted, or `None` if it doesn't own the partition.
+        """
+        reply = self._makeRequest(["MIGRATE", partition] + self._codec.encodeStores(entries))
+        if reply[0] != "MIGRATE":
+            return None
+        return int(reply[2])
+
+    def migrated(self, partition):
+        """
+        Tell this Peer that a partition has been migrated to it, so it can start serving it.
+
+        :param partition: The partition prefix.
+        :return: `True` if the Peer took the partition over.
+        """
+        return self._makeRequest(["MIGRATED", partition])[0] == "MIGRATED"
+
+    def _handleReplies(self):
+        """
+        Read replies from this Peer and wake up the greenlet waiting on each one.
+        """
+        while True:
+            m = self._sock.recv_multipart()
+            result = self._pending.pop(m[0], None)
+            if result is None:
+                log.debug("Peer %s: reply to unknown or timed out request '%s' dropped", self._id, m[0])
+            else:
+                result.set(m[2:])
+
+    def _makeRequest(self, req, deadline=None, retries=None):
         """
         Make a request to this Peer.
 
+        Only the calling greenlet blocks while waiting for the reply; other requests may be sent in the meantime.
+        Each attempt waits for the Node's request timeout at most. A request that times out is resent with a new
+        request ID (every request in the protocol is safe to repeat), and a late reply to the old one is dropped. A
+        request that the Peer answers with a BUSY error is resent the same way, after backing off.
+
         :param req: The request to send.
+        :param deadline: The time by which the reply must have arrived, or `None`. No attempt waits past it.
+        :param retries: How many times to resend the request if it times out. Defaults to the Node's request retries.
         :return: The response to the request.
+        :raise: :class:`RequestTimeout` if there is no reply in time, or :class:`PeerBusy` if the last reply was a
+            BUSY error.
         """
-        self._sock.send_multipart(req)
-        return self._sock.recv_multipart()
+        if retries is None:
+            retries = self._node._requestRetries
+        busy = False
+        for attempt in range(retries + 1):
+            if busy:
+                backoff = _BUSY_BACKOFF * 2 ** (attempt - 1)
+                if deadline is not None:
+                    backoff = min(backoff, deadline - time())
+                sleep(max(backoff, 0))
+            timeout = self._node._requestTimeout or None
+            if deadline is not None:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                timeout = min(timeout, remaining) if timeout else remaining
+            requestId = str(next(self._requestIds))
+            result = AsyncResult()
+            self._pending[requestId] = result
+            self._sock.send_multipart([requestId, ""] + req)
+            try:
+                reply = result.get(timeout=timeout)
+            except Timeout:
+                self._pending.pop(requestId, None)
+                self._node._requestTimeouts += 1
+                busy = False
+                log.warning("Peer %s: %s request timed out after %.3fs", self._id, req[0], timeout)
+                continue
+            if reply[:2] != ["ERROR", "Busy"]:
+                return reply
+            self._node._busyReplies += 1
+            busy = True
+            log.debug("Peer %s: too busy for a %s request", self._id, req[0])
+        if busy:
+            raise PeerBusy("Peer %s was too busy for a %s request" % (self._id, req[0]))
+        raise RequestTimeout("Peer %s didn't answer a %s request in time" % (self._id, req[0]))
 
+    def close(self):
+        """
+        Stop reading replies from this Peer and close the socket to it.
+
+        Requests still waiting for a reply will time out.
+        """
+        self._reader.kill()
+        self._sock.close(linger=0)
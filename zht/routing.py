@@ -0,0 +1,158 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Routing index used to find which peers own the bucket a key hash falls in.
+"""
+import hashlib
+import logging
+log = logging.getLogger('zht.routing')
+
+#: Separates the identity of a host from the index of a worker process in the identities of sharded Nodes (see
+#: :mod:`zht.shard`).
+SHARD_SEPARATOR = '#'
+
+def hostIdentity(identity):
+    """
+    :param identity: The identity string of a Node.
+    :return: The identity of the host the Node runs on: the part before :data:`SHARD_SEPARATOR`, or the whole
+        identity for a Node that isn't one of several worker processes on its host.
+    """
+    return identity.partition(SHARD_SEPARATOR)[0]
+
+def rendezvousOwners(partition, identities, replicas):
+    """
+    Choose the Nodes that own a partition, by rendezvous (highest random weight) hashing.
+
+    Each Node's weight for a partition is a hash of the two together, and the `replicas` heaviest Nodes own it. Every
+    Node that knows the same set of identities makes the same choice, and adding or removing a Node only moves the
+    partitions that Node gains or loses.
+
+    Nodes on the same host (see :func:`hostIdentity`) only share a partition if there are fewer hosts than replicas,
+    so the worker processes of a host own disjoint sets of partitions, and no partition depends on a single host.
+
+    :param partition: The partition prefix.
+    :param identities: The identities of every Node to choose from.
+    :param replicas: The number of owners to choose.
+    :return: A :class:`list` of up to `replicas` identities, heaviest first among those on distinct hosts.
+    """
+    ranked = sorted(identities, key=lambda identity: hashlib.sha1("%s|%s" % (identity, partition)).digest(),
+                    reverse=True)
+    owners = []
+    hosts = set()
+    sameHost = []
+    for identity in ranked:
+        host = hostIdentity(identity)
+        if host in hosts:
+            sameHost.append(identity)
+            continue
+        owners.append(identity)
+        hosts.add(host)
+        if len(owners) == replicas:
+            return owners
+    return owners + sameHost[:replicas - len(owners)]
+
+class _TrieNode(object):
+    """
+    A single node in a :class:`RoutingTable` prefix trie.
+    """
+    __slots__ = ('children', 'owners')
+
+    def __init__(self):
+        self.children = dict()
+        self.owners = frozenset()
+
+class RoutingTable(object):
+    """
+    Construct a new, empty RoutingTable.
+
+    The RoutingTable is a hex-prefix trie. Each bucket prefix a peer advertises is a path in the trie, and the
+    identity of the peer is recorded at the end of that path. Finding the owners of a key hash only walks the
+    hash's digits down the trie, so the cost of a lookup depends on the longest bucket prefix and not on the number
+    of peers or buckets.
+    """
+    def __init__(self):
+        self._root = _TrieNode()
+        self._peerPrefixes = dict()
+
+    def setPeerBuckets(self, identity, prefixes):
+        """
+        Record the set of buckets owned by a peer, replacing anything previously known about it.
+
+        :param identity: The identity string of the peer.
+        :param prefixes: An iterable of the bucket prefixes the peer owns.
+        """
+        self.removePeer(identity)
+        prefixes = frozenset(prefixes)
+        for prefix in prefixes:
+            node = self._root
+            for digit in prefix:
+                node = node.children.setdefault(digit, _TrieNode())
+            node.owners = node.owners | frozenset((identity,))
+        self._peerPrefixes[identity] = prefixes
+        log.debug("Peer %s owns %d buckets", identity, len(prefixes))
+
+    def removePeer(self, identity):
+        """
+        Forget every bucket owned by a peer.
+
+        :param identity: The identity string of the peer.
+        """
+        for prefix in self._peerPrefixes.pop(identity, ()):
+            self._remove(self._root, prefix, identity)
+
+    def _remove(self, node, prefix, identity):
+        """
+        Remove `identity` from the owners of `prefix` below `node`, pruning trie nodes that become empty.
+
+        :return: `True` if `node` no longer holds any owners or children.
+        """
+        if prefix:
+            child = node.children.get(prefix[0])
+            if child is not None and self._remove(child, prefix[1:], identity):
+                del node.children[prefix[0]]
+        else:
+            node.owners = node.owners - frozenset((identity,))
+        return not node.owners and not node.children
+
+    def peerBuckets(self, identity):
+        """
+        :return: The :class:`frozenset` of bucket prefixes known to be owned by a peer.
+        """
+        return self._peerPrefixes.get(identity, frozenset())
+
+    def peers(self):
+        """
+        :return: A :class:`list` of the identities of every peer in this RoutingTable.
+        """
+        return list(self._peerPrefixes)
+
+    def lookup(self, keyHash):
+        """
+        Find the peers that own the bucket a key hash falls in.
+
+        :param keyHash: The hex digest of the key.
+        :return: A :class:`frozenset` of peer identities. It is empty if no known peer owns the key.
+        """
+        found = []
+        node = self._root
+        if node.owners:
+            found.append(node.owners)
+        for digit in keyHash:
+            node = node.children.get(digit)
+            if node is None:
+                break
+            if node.owners:
+                found.append(node.owners)
+        if not found:
+            return frozenset()
+        elif len(found) == 1:
+            return found[0]
+        else:
+            return frozenset().union(*found)
+
+    def __len__(self):
+        """
+        :return: The number of peers in this RoutingTable.
+        """
+        return len(self._peerPrefixes)
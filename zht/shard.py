@@ -0,0 +1,287 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Run several worker processes per host.
+
+A :class:`~zht.node.Node` is a single gevent process, so it uses one core. :func:`startShards` runs `count` Nodes on
+a host instead, each in a process of its own, with identities of the form ``host#index`` and addresses derived from
+the configured ones (see :func:`shardAddr`). To the rest of the cluster they are ordinary Nodes, except that
+partition ownership keeps the replicas of a partition on distinct hosts (see
+:func:`~zht.routing.rendezvousOwners`), so the workers of a host own disjoint sets of partitions.
+
+To clients, the host is a single Node: a :class:`Frontend` binds the control socket for the host's identity, and
+sends each command on to the workers that own its keys, splitting batched commands between them and merging their
+answers.
+"""
+from gevent_zeromq import zmq
+from gevent.pool import Pool
+from gevent.event import AsyncResult
+from binascii import hexlify
+from itertools import count
+from multiprocessing import Process
+from routing import RoutingTable, SHARD_SEPARATOR
+from table import HASH_FUNCTIONS
+import json
+import logging
+log = logging.getLogger('zht.shard')
+
+# Commands whose arguments are all keys, answered with one frame per key.
+_KEY_COMMANDS = ('GET', 'RGET', 'RGET-HEDGED')
+
+def shardIdentity(identity, index):
+    """
+    :param identity: The identity string of the host.
+    :param index: The index of a worker process on the host.
+    :return: The identity of the worker's Node.
+    """
+    return "%s%s%d" % (identity, SHARD_SEPARATOR, index)
+
+def shardAddr(addr, index):
+    """
+    Derive the address a worker process binds from the one configured for its host.
+
+    :param addr: A ZMQ address. The port of a TCP address is offset by `index`; any other address is suffixed with
+        it.
+    :param index: The index of the worker process.
+    :return: The worker's address.
+    """
+    transport, sep, rest = addr.partition('://')
+    if transport == 'tcp':
+        host, colon, port = rest.rpartition(':')
+        return "tcp://%s:%d" % (host, int(port) + index)
+    return "%s-%d" % (addr, index)
+
+class Frontend(object):
+    """
+    Construct a new Frontend.
+
+    Commands are read from an XREP socket bound to the host's control address, and sent on to the workers' control
+    sockets over DEALER sockets, so any number can be outstanding at once. Each key is sent to a worker that owns it,
+    as announced in the BUCKETS messages the workers publish, or to a worker chosen by its hash until one has been
+    announced; any worker can answer for any key, so that only costs an extra hop.
+
+    :param identity: The identity string of the host.
+    :param shards: A list of (identity, PUB address) tuples of the host's workers.
+    :param hashFunction: The name of the key hash function the workers use (see :data:`~zht.table.HASH_FUNCTIONS`).
+    :param ctx: The ZMQ Context object to operate from.
+    """
+    def __init__(self, identity, shards, hashFunction='sha1', ctx=None):
+        self._id = identity
+        self._digest = HASH_FUNCTIONS[hashFunction]
+        self._shardIds = [shardId for shardId, pubAddr in shards]
+        self._greenletPool = Pool()
+        self._routes = RoutingTable()
+        self._pending = dict()
+        self._requestIds = count()
+        self._ctx = ctx or zmq.Context.instance()
+        self._router = self._ctx.socket(zmq.XREP)
+        self._router.bind('ipc://.zhtnode-control-' + identity)
+        self._dealers = dict()
+        for shardId in self._shardIds:
+            sock = self._ctx.socket(zmq.XREQ)
+            sock.connect('ipc://.zhtnode-control-' + shardId)
+            self._dealers[shardId] = sock
+        self._sub = self._ctx.socket(zmq.SUB)
+        self._sub.setsockopt(zmq.SUBSCRIBE, 'BUCKETS')
+        for shardId, pubAddr in shards:
+            self._sub.connect(pubAddr)
+
+    def spawn(self, f, *args, **kwargs):
+        """
+        Spawn a new greenlet in this Frontend's pool.
+        """
+        return self._greenletPool.spawn(f, *args, **kwargs)
+
+    def start(self):
+        """
+        Start handling commands.
+        """
+        self.spawn(self._handleCommands)
+        self.spawn(self._handleBuckets)
+        for shardId, sock in self._dealers.items():
+            self.spawn(self._handleReplies, sock)
+
+    def _close(self):
+        """
+        Close this Frontend's sockets, when it shuts down.
+        """
+        for sock in [self._router, self._sub] + self._dealers.values():
+            sock.close(linger=0)
+
+    def _handleBuckets(self):
+        """
+        Keep track of the Buckets each worker owns.
+        """
+        while True:
+            m = self._sub.recv_multipart()
+            if m[1] in self._dealers:
+                self._routes.setPeerBuckets(m[1], m[2:])
+
+    def _handleReplies(self, sock):
+        """
+        Read replies from a worker and wake up the greenlet waiting on each one.
+
+        :param sock: The DEALER socket connected to the worker.
+        """
+        while True:
+            m = sock.recv_multipart()
+            result = self._pending.pop(m[0], None)
+            if result is not None:
+                result.set(m[2:])
+
+    def _request(self, shardId, msg):
+        """
+        Send a command to a worker.
+
+        :param shardId: The identity of the worker.
+        :param msg: The command.
+        :return: An :class:`~gevent.event.AsyncResult` for the worker's answer.
+        """
+        requestId = str(next(self._requestIds))
+        result = AsyncResult()
+        self._pending[requestId] = result
+        self._dealers[shardId].send_multipart([requestId, ""] + msg)
+        return result
+
+    def _shardFor(self, key):
+        """
+        :param key: A key.
+        :return: The identity of the worker to send commands for `key` to.
+        """
+        keyHash = hexlify(self._digest(key))
+        owners = self._routes.lookup(keyHash)
+        for shardId in self._shardIds:
+            if shardId in owners:
+                return shardId
+        return self._shardIds[int(keyHash[:8], 16) % len(self._shardIds)]
+
+    def _split(self, keys):
+        """
+        Group keys by the worker to send them to.
+
+        :param keys: A list of keys.
+        :return: A :class:`dict` mapping worker identities to lists of the indexes in `keys` they were given.
+        """
+        byShard = dict()
+        for i, key in enumerate(keys):
+            byShard.setdefault(self._shardFor(key), []).append(i)
+        return byShard
+
+    def _handleCommands(self):
+        """
+        Handle commands recieved over the control socket, each in a spawned greenlet.
+        """
+        while True:
+            m = self._router.recv_multipart()
+            self.spawn(self._handleCommand, m)
+
+    def _handleCommand(self, m):
+        """
+        Handle an individual command. A command that fails unexpectedly is answered with an ERROR | Internal error.
+
+        :param m: The command, with its envelope.
+        """
+        i = m.index("")
+        envelope = m[:i+1]
+        msg = m[i+1:]
+        try:
+            if not msg:
+                reply = ['ERR', 'UNKNOWN COMMAND']
+            elif msg[0] in _KEY_COMMANDS or msg[0] == 'RGET-QUORUM':
+                args = 2 if msg[0] == 'RGET-QUORUM' else 1
+                reply = self._keyCommand(msg[:args], msg[args:])
+            elif msg[0] == 'PUT':
+                reply = self._request(self._shardFor(msg[1]), msg).get()
+            elif msg[0] == 'MPUT' and len(msg) % 2 != 1:
+                reply = ['ERROR', 'BadArgument', 'MPUT', 'Expected key/value pairs']
+            elif msg[0] == 'MPUT':
+                pairs = zip(msg[1::2], msg[2::2])
+                requests = []
+                for shardId, indexes in self._split([key for key, value in pairs]).items():
+                    shardMsg = ['MPUT']
+                    for index in indexes:
+                        shardMsg.extend(pairs[index])
+                    requests.append(self._request(shardId, shardMsg))
+                reply = ['OK', str(sum(int(request.get()[1]) for request in requests))]
+            elif msg[0] == 'STATS':
+                requests = [(shardId, self._request(shardId, msg)) for shardId in self._shardIds]
+                stats = {
+                    'id': self._id,
+                    'shards': dict((shardId, json.loads(request.get()[1])) for shardId, request in requests),
+                }
+                reply = ['STATS', json.dumps(stats)]
+            elif msg[0] == 'EOF':
+                for request in [self._request(shardId, msg) for shardId in self._shardIds]:
+                    request.get()
+                self._router.send_multipart(envelope + ['OK'])
+                self._close()
+                self._greenletPool.kill()
+                return
+            else:
+                reply = self._request(self._shardIds[0], msg).get()
+        except Exception as e:
+            log.exception("Command %s failed", msg[:1])
+            reply = ['ERROR', 'Internal', msg[0], str(e)]
+        self._router.send_multipart(envelope + reply)
+
+    def _keyCommand(self, command, keys):
+        """
+        Split a command that answers with a frame per key between the workers, and merge their answers.
+
+        :param command: The command name, and any arguments before the keys.
+        :param keys: The keys.
+        :return: The merged answer, or the first error a worker answered with.
+        """
+        byShard = self._split(keys)
+        requests = [(indexes, self._request(shardId, command + [keys[i] for i in indexes]))
+                    for shardId, indexes in byShard.items()]
+        reply = [None] * len(keys)
+        for indexes, request in requests:
+            shardReply = request.get()
+            if len(shardReply) != len(indexes):
+                return shardReply
+            for index, value in zip(indexes, shardReply):
+                reply[index] = value
+        return reply
+
+def runFrontend(identity, shards, hashFunction='sha1'):
+    """
+    Run a :class:`Frontend` until it is shut down.
+
+    :param identity: The identity string of the host.
+    :param shards: A list of (identity, PUB address) tuples of the host's workers.
+    :param hashFunction: The name of the key hash function the workers use.
+    """
+    frontend = Frontend(identity, shards, hashFunction)
+    frontend.start()
+    frontend._greenletPool.join()
+
+def startShards(identity, count, bindAddrREP, bindAddrPUB, connectAddr=None, **nodeOptions):
+    """
+    Start `count` worker processes and a :class:`Frontend` for them, each in a process of its own.
+
+    The first worker connects to `connectAddr`, and the others to the first, so they all join the same cluster.
+
+    :param identity: The identity string of the host.
+    :param count: The number of worker processes.
+    :param bindAddrREP: The address to derive the workers' REP addresses from (see :func:`shardAddr`).
+    :param bindAddrPUB: The address to derive the workers' PUB addresses from.
+    :param connectAddr: The address of a :class:`~zht.node.Node` to connect to.
+    :param nodeOptions: Any other keyword arguments for the workers' Nodes.
+    :return: A list of the started :class:`~multiprocessing.Process` objects.
+    """
+    from shell import runNode
+    processes = []
+    shards = []
+    for index in range(count):
+        shardId = shardIdentity(identity, index)
+        repAddr = shardAddr(bindAddrREP, index)
+        pubAddr = shardAddr(bindAddrPUB, index)
+        connect = connectAddr if index == 0 else shardAddr(bindAddrREP, 0)
+        processes.append(Process(target=runNode, args=(shardId, repAddr, pubAddr, connect), kwargs=nodeOptions))
+        shards.append((shardId, pubAddr))
+    processes.append(Process(target=runFrontend, args=(identity, shards, nodeOptions.get('hashFunction', 'sha1'))))
+    for process in processes:
+        process.start()
+    return processes
@@ -9,37 +9,101 @@ Implement a Command-Line interface to ZHT.
 :class:`ZHTCmd` implements a basic command shell interface for controlling a ZHT node.
 """
 from config import ZHTConfig
+import json
 import logging
 from cmd import Cmd
+from gevent import sleep
+from time import time
+from itertools import count
 import zmq
 
+#: Seconds the command shell waits for the node to answer each command, unless `controlTimeout` is configured.
+CONTROL_TIMEOUT = 30.0
+
+class ControlTimeout(Exception):
+    """
+    Raised when a :class:`Node` doesn't answer a control command in time.
+    """
+
 class ZHTControl(object):
     """
     Construct a new ZHTControl.
 
+    Commands are sent over a DEALER socket, tagged with request IDs, so several can be outstanding at once: send them
+    all with :meth:`send` and collect the answers with :meth:`recv`, in any order. The Node handles each command in a
+    greenlet of its own, so slow commands don't hold up the others.
+
     :param ctx: The ZMQ context to communicate over.
     :param identity: The identity string of the node to control.
+    :param timeout: Seconds to wait for the node to answer each command, or `None` to wait forever.
     """
-    def __init__(self, ctx, identity):
-        self._sock = ctx.socket(zmq.REQ)
-        self._sock.connect('ipc://.zhtnode-control-' + identity)
+    def __init__(self, ctx, identity, timeout=None):
+        self._ctx = ctx
         self.identity = identity
-    
-    def __send(self, msg):
-        self._sock.send_multipart(msg)
+        self.timeout = timeout
+        self._requestIds = count()
+        self._outstanding = set()
+        self._replies = dict()
+        self._sock = self._ctx.socket(zmq.XREQ)
+        self._sock.connect('ipc://.zhtnode-control-' + self.identity)
+
+    def send(self, msg):
+        """
+        Send a command without waiting for the answer.
+
+        :param msg: The command, as a list of frames.
+        :return: The command's request ID, to pass to :meth:`recv`.
+        """
+        requestId = str(next(self._requestIds))
+        self._outstanding.add(requestId)
+        self._sock.send_multipart([requestId, ""] + msg)
+        return requestId
+
+    def __recvReply(self):
+        """
+        Receive the next answer, keeping it for :meth:`recv` if its command is still outstanding.
+        """
+        m = self._sock.recv_multipart()
+        if m[0] in self._outstanding:
+            self._replies[m[0]] = m[2:]
+
+    def recv(self, requestId):
+        """
+        Wait for the answer to a command sent with :meth:`send`. Answers to other commands that arrive first are kept
+        until they are asked for.
+
+        :param requestId: The command's request ID.
+        :return: The answer.
+        :raise: :class:`ControlTimeout` if the node doesn't answer within the timeout. A late answer is dropped.
+        """
+        deadline = time() + self.timeout if self.timeout is not None else None
+        while not requestId in self._replies:
+            if deadline is None:
+                self.__recvReply()
+            # Poll without blocking, so a Node running in the same process can answer in the meantime.
+            elif self._sock.poll(0):
+                self.__recvReply()
+            elif time() > deadline:
+                self._outstanding.discard(requestId)
+                raise ControlTimeout("%s didn't answer within %ss" % (self.identity, self.timeout))
+            else:
+                sleep(0.001)
+        self._outstanding.discard(requestId)
+        return self._replies.pop(requestId)
 
-    def __recv(self):
-        return self._sock.recv_multipart()
-    
     def __req(self, msg):
-        self.__send(msg)
-        return self.__recv()
+        """
+        Send a command and wait for the answer.
+
+        :raise: :class:`ControlTimeout` if the node doesn't answer within the timeout.
+        """
+        return self.recv(self.send(msg))
 
     def EOF(self):
         """
         Send a shutdown command to the :class:`Node`.
         """
-        self.__send(['EOF'])
+        self._outstanding.discard(self.send(['EOF']))
     
     def connect(self, addrs):
         """
@@ -53,10 +117,19 @@ class ZHTControl(object):
         """
         return self.__req(['GET'] + keys)
 
-    def rget(self, keys):
+    def rget(self, keys, mode='first', quorum=2):
         """
         Send a rget command to the :class:`Node`.
+
+        :param keys: The keys to look up on the Peers that own them.
+        :param mode: How to read from the owners, from :data:`~zht.node.READ_MODES`: 'first', 'hedged' or
+            'quorum'.
+        :param quorum: The number of owners that must answer for each key, in 'quorum' mode.
         """
+        if mode == 'hedged':
+            return self.__req(['RGET-HEDGED'] + keys)
+        elif mode == 'quorum':
+            return self.__req(['RGET-QUORUM', str(quorum)] + keys)
         return self.__req(['RGET'] + keys)
 
     def put(self, key, value):
@@ -65,21 +138,60 @@ class ZHTControl(object):
         """
         return self.__req(['PUT', key, value])
     
+    def mput(self, items):
+        """
+        Send a batched put command to the :class:`Node`
+
+        :param items: A :class:`dict` or list of (key, value) pairs to store.
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        msg = ['MPUT']
+        for key, value in items:
+            msg.extend((key, value))
+        return self.__req(msg)
+
     def peers(self):
         """
         Send a peer command to the :class:`Node`
         """
         return self.__req(['PEERS'])
 
+    def stats(self):
+        """
+        Send a stats command to the :class:`Node`
+
+        :return: A :class:`dict` of the Node's statistics.
+        """
+        return json.loads(self.__req(['STATS'])[1])
+
+    def migrations(self):
+        """
+        Send a migrations command to the :class:`Node`
+
+        :return: A :class:`dict` of the progress of the Node's partition migrations.
+        """
+        return json.loads(self.__req(['MIGRATIONS'])[1])
+
+    def members(self):
+        """
+        Send a members command to the :class:`Node`
+
+        :return: A :class:`dict` mapping the identity of each Peer to its state (see
+            :meth:`~zht.membership.Membership.view`).
+        """
+        return json.loads(self.__req(['MEMBERS'])[1])
+
 class ZHTCmd(Cmd):
     """
     Construct a new ZHT Command Shell.
 
     :param ctx: The ZMQ context to communicate with.
     :param identity: The identity string of the :class:`Node`
+    :param timeout: Seconds to wait for the node to answer each command.
     """
-    def __init__(self, ctx, identity):
-        self._control = ZHTControl(ctx, identity)
+    def __init__(self, ctx, identity, timeout=CONTROL_TIMEOUT):
+        self._control = ZHTControl(ctx, identity, timeout)
         self.identity = identity
         Cmd.__init__(self)
         self._setPrompt()
@@ -120,9 +232,15 @@ class ZHTCmd(Cmd):
         """
         Handle a command line rget.
 
-        :param line: The command arguments.
+        :param line: The command arguments: the keys, optionally preceded by --hedged or --quorum=R.
         """
-        print self._control.rget(line.split())
+        args = line.split()
+        if args and args[0] == '--hedged':
+            print self._control.rget(args[1:], 'hedged')
+        elif args and args[0].startswith('--quorum='):
+            print self._control.rget(args[1:], 'quorum', int(args[0][len('--quorum='):]))
+        else:
+            print self._control.rget(args)
 
     def do_put(self, line):
         """
@@ -132,6 +250,15 @@ class ZHTCmd(Cmd):
         """
         print self._control.put(*line.split(None, 1))
 
+    def do_mput(self, line):
+        """
+        Handle a command line mput.
+
+        :param line: The command arguments, as alternating keys and values.
+        """
+        args = line.split()
+        print self._control.mput(zip(args[0::2], args[1::2]))
+
     def do_peers(self, line):
         """
         Handle a command line peers.
@@ -140,13 +267,48 @@ class ZHTCmd(Cmd):
         """
         print self._control.peers()
 
+    def do_stats(self, line):
+        """
+        Handle a command line stats.
+
+        :param line: The command arguments.
+        """
+        print json.dumps(self._control.stats(), indent=2, sort_keys=True)
+
+    def do_migrations(self, line):
+        """
+        Handle a command line migrations.
+
+        :param line: The command arguments.
+        """
+        print json.dumps(self._control.migrations(), indent=2, sort_keys=True)
+
+    def do_members(self, line):
+        """
+        Handle a command line members.
+
+        :param line: The command arguments.
+        """
+        print json.dumps(self._control.members(), indent=2, sort_keys=True)
+
+    def onecmd(self, line):
+        """
+        Handle a command line, reporting a node that doesn't answer in time instead of exiting.
+
+        :param line: The command line.
+        """
+        try:
+            return Cmd.onecmd(self, line)
+        except ControlTimeout as e:
+            print e
+
     def emptyline(self):
         """
         Handle an empty line.
         """
         pass
 
-def runNode(identity, bindAddrREP, bindAddrPUB, connectAddr):
+def runNode(identity, bindAddrREP, bindAddrPUB, connectAddr, **nodeOptions):
     """
     Start a ZHT Node.
 
@@ -154,9 +316,10 @@ def runNode(identity, bindAddrREP, bindAddrPUB, connectAddr):
     :param bindAddrREP: The address to bind the :class:`Node`'s REP socket to.
     :param bindAddrPUB: The address to binf the :class:`Node`'s PUB socket to.
     :param connectAddr: The address of a :class:`Node` to connect to.
+    :param nodeOptions: Any other keyword arguments for the :class:`Node`.
     """
     from node import Node
-    n = Node(identity, bindAddrREP, bindAddrPUB)
+    n = Node(identity, bindAddrREP, bindAddrPUB, **nodeOptions)
     n.start()
     if connectAddr != "" and not connectAddr is None:
         n.spawn(n.connect, connectAddr)
@@ -175,9 +338,18 @@ if __name__ == "__main__":
     log.info("ID: %(identity)s, REP: %(bindAddrREP)s, PUB: %(bindAddrPUB)s, CONN: %(connectAddr)s" % config)
     
     from multiprocessing import Process
-    p = Process(target=runNode, args=(config.identity, config.bindAddrREP, config.bindAddrPUB, config.connectAddr))
-    p.start()
+    shards = int(config.shards or 1)
+    if shards > 1:
+        from shard import startShards
+        processes = startShards(config.identity, shards, config.bindAddrREP, config.bindAddrPUB, config.connectAddr,
+                                **config.nodeOptions())
+    else:
+        p = Process(target=runNode, args=(config.identity, config.bindAddrREP, config.bindAddrPUB, config.connectAddr),
+                    kwargs=config.nodeOptions())
+        p.start()
+        processes = [p]
     
-    ZHTCmd(zmq.Context.instance(), config.identity).cmdloop()
-    p.join()
+    ZHTCmd(zmq.Context.instance(), config.identity, float(config.controlTimeout or CONTROL_TIMEOUT)).cmdloop()
+    for p in processes:
+        p.join()
 
@@ -0,0 +1,224 @@
+#
+# Copyright 2011 Michael Larsen <mike.gh.larsen@gmail.com>
+#
+"""
+Durable storage for a :class:`~zht.table.Table`: an append-only write log plus periodic snapshots.
+
+Storage is kept in numbered generations. Every accepted store is appended to the current generation's
+log, `log-<generation>`. Taking a snapshot starts a new generation: the log is switched first, then every bucket is
+written to `snapshot-<generation>/bucket-<prefix>.snap`, and only once the snapshot is complete are older logs and
+snapshots removed. Loading reads the newest complete snapshot and then replays every log from that generation on.
+Stores are last-write-wins, so replaying a store that is already in the snapshot does no harm.
+
+Logs and snapshots share a record format: a little-endian header of the timestamp (float64), key length (uint32),
+digest length (uint8) and value length (uint32), followed by the key, its binary hash digest and the value.
+"""
+from binascii import hexlify, unhexlify
+from gevent import sleep
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+log = logging.getLogger('zht.storage')
+
+RECORD = struct.Struct('<dIBI')
+
+#: When appended records are forced to disk: after every store, in groups by :meth:`LogStorage.commit`, or never
+#: (leaving it to the operating system).
+FSYNC_POLICIES = ('always', 'batch', 'never')
+
+class LogStorage(object):
+    """
+    Construct a new LogStorage.
+
+    :param path: The directory to keep logs in. It is created if it doesn't exist.
+    :param snapshotPath: The directory to keep snapshots in, if not `path`.
+    :param fsyncPolicy: One of :data:`FSYNC_POLICIES`.
+    """
+    def __init__(self, path, snapshotPath=None, fsyncPolicy='batch'):
+        if not fsyncPolicy in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy '%s'" % (fsyncPolicy,))
+        self._path = path
+        self._snapshotDir = snapshotPath or path
+        self._fsyncPolicy = fsyncPolicy
+        self._log = None
+        self._dirty = False
+        for directory in (self._path, self._snapshotDir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._generation = max(self._generations(self._path, 'log-') +
+                               self._generations(self._snapshotDir, 'snapshot-') + [0])
+
+    def _generations(self, directory, prefix):
+        """
+        Return the generation numbers of the files in a directory named `prefix` + number.
+        """
+        return [int(name[len(prefix):]) for name in os.listdir(directory)
+                if name.startswith(prefix) and name[len(prefix):].isdigit()]
+
+    def _logPath(self, generation):
+        return os.path.join(self._path, "log-%d" % (generation,))
+
+    def _snapshotPath(self, generation):
+        return os.path.join(self._snapshotDir, "snapshot-%d" % (generation,))
+
+    def load(self, table):
+        """
+        Load the newest snapshot and replay the logs written since into a Table, then start a new log.
+
+        The Table must not have this LogStorage attached yet, or every loaded entry would be logged again.
+
+        :param table: The :class:`~zht.table.Table` to load into.
+        :return: The sync marks saved with the snapshot, as a :class:`dict` like :attr:`Node._syncMarks`.
+        """
+        metaPath = os.path.join(self._path, 'meta.json')
+        keepHashes = True
+        if os.path.exists(metaPath):
+            with open(metaPath) as f:
+                keepHashes = json.load(f)['hashFunction'] == table._hashFunction
+        snapshots = self._generations(self._snapshotDir, 'snapshot-')
+        snapshot = max(snapshots) if snapshots else 0
+        marks = dict()
+        if snapshots:
+            path = self._snapshotPath(snapshot)
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.snap'):
+                    self._replay(os.path.join(path, name), table, keepHashes)
+            with open(os.path.join(path, 'marks.json')) as f:
+                marks = dict(((peer, prefix), mark) for peer, prefix, mark in json.load(f))
+        for generation in sorted(self._generations(self._path, 'log-')):
+            if generation >= snapshot:
+                self._replay(self._logPath(generation), table, keepHashes)
+        self._openLog(self._generation + 1)
+        if not keepHashes:
+            log.info("Hash function changed to '%s', rewriting storage", table._hashFunction)
+            self.snapshot(table, marks)
+        with open(metaPath, 'w') as f:
+            json.dump({'hashFunction': table._hashFunction}, f)
+        return marks
+
+    def _replay(self, path, table, keepHashes):
+        """
+        Store every record in a log or snapshot file into a Table.
+
+        A truncated record at the end of the file (from a crash in the middle of a write) is ignored.
+
+        :param path: The file to read.
+        :param table: The :class:`~zht.table.Table` to store into.
+        :param keepHashes: `False` if the storage was written with a different hash function than the Table's,
+            in which case every key is hashed again.
+        :return: The number of records read.
+        """
+        size = os.path.getsize(path)
+        if size == 0:
+            return 0
+        count = 0
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset + RECORD.size <= size:
+                    timestamp, keyLength, digestLength, valueLength = RECORD.unpack_from(data, offset)
+                    start = offset + RECORD.size
+                    end = start + keyLength + digestLength + valueLength
+                    if end > size:
+                        break
+                    key = data[start:start + keyLength]
+                    digest = data[start + keyLength:start + keyLength + digestLength]
+                    value = data[start + keyLength + digestLength:end]
+                    table.putValue(key, value, timestamp, hexlify(digest) if keepHashes else None)
+                    offset = end
+                    count += 1
+                if offset != size:
+                    log.warning("Ignoring %d trailing bytes of '%s'", size - offset, path)
+            finally:
+                data.close()
+        log.info("Loaded %d records from '%s'", count, path)
+        return count
+
+    def _openLog(self, generation):
+        """
+        Switch appends to the log of a new generation.
+        """
+        if self._log is not None:
+            self.commit()
+            self._log.close()
+        self._generation = generation
+        self._log = open(self._logPath(generation), 'ab')
+
+    def append(self, key, keyHash, value, timestamp):
+        """
+        Append an accepted store to the log.
+
+        :param key: The key that was stored.
+        :param keyHash: The hex digest of `key`.
+        :param value: The value that was stored.
+        :param timestamp: The timestamp of the store.
+        """
+        digest = unhexlify(keyHash)
+        self._log.write(RECORD.pack(timestamp, len(key), len(digest), len(value)) + key + digest + value)
+        self._dirty = True
+        if self._fsyncPolicy == 'always':
+            self.commit()
+
+    def commit(self):
+        """
+        Force everything appended so far to disk, unless the fsync policy is 'never'.
+        """
+        if self._dirty and self._log is not None:
+            self._log.flush()
+            if self._fsyncPolicy != 'never':
+                os.fsync(self._log.fileno())
+            self._dirty = False
+
+    def snapshot(self, table, marks):
+        """
+        Write a compacted snapshot of a Table, then remove the logs and snapshots it replaces.
+
+        Yields to other greenlets between buckets. Stores made meanwhile go to the new generation's log.
+
+        :param table: The :class:`~zht.table.Table` to snapshot.
+        :param marks: The sync marks to save with the snapshot, as in :attr:`Node._syncMarks`. They are copied
+            before anything else is written, so every store they cover is in the snapshot.
+        """
+        marks = marks.items()
+        generation = self._generation + 1
+        self._openLog(generation)
+        path = self._snapshotPath(generation)
+        tmpPath = path + '.tmp'
+        if os.path.isdir(tmpPath):
+            shutil.rmtree(tmpPath)
+        os.mkdir(tmpPath)
+        count = 0
+        for prefix, bucket in list(table._buckets.items()):
+            with open(os.path.join(tmpPath, "bucket-%s.snap" % (prefix,)), 'wb') as f:
+                for entry in bucket._entries.values():
+                    f.write(RECORD.pack(entry._timestamp, len(entry._key), len(entry._digest), len(entry._value)) +
+                            entry._key + entry._digest + entry._value)
+                    count += 1
+                f.flush()
+                os.fsync(f.fileno())
+            sleep(0)
+        with open(os.path.join(tmpPath, 'marks.json'), 'w') as f:
+            json.dump([(peer, prefix, mark) for (peer, prefix), mark in marks], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpPath, path)
+        for old in self._generations(self._snapshotDir, 'snapshot-'):
+            if old < generation:
+                shutil.rmtree(self._snapshotPath(old))
+        for old in self._generations(self._path, 'log-'):
+            if old < generation:
+                os.remove(self._logPath(old))
+        log.info("Snapshot %d written: %d entries", generation, count)
+
+    def close(self):
+        """
+        Commit and close the log.
+        """
+        if self._log is not None:
+            self.commit()
+            self._log.close()
+            self._log = None
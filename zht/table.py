@@ -6,10 +6,23 @@ The Table is responsible for actually storing values.
 """
 from functools import total_ordering
 from time import time
+from bisect import bisect_left
+from operator import attrgetter
+from binascii import hexlify, unhexlify
 import collections
+from merkle import HashTree, entryDigest, HEX_DIGITS
 import hashlib
 import logging
+import struct
+import zlib
 log = logging.getLogger('zht.table')
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
 
 def hex_hash(value):
     """
@@ -19,18 +32,59 @@ def hex_hash(value):
     """
     return hashlib.sha1(value).hexdigest()
 
+def binary_hash(value):
+    """
+    Return a SHA1 binary digest.
+
+    :param value: The value to hash.
+    """
+    return hashlib.sha1(value).digest()
+
+# Key hash functions a Table can be configured with, by name. Each returns a binary digest.
+HASH_FUNCTIONS = {
+    'sha1': binary_hash,
+    'md5': lambda value: hashlib.md5(value).digest(),
+    'crc32': lambda value: struct.pack('>I', zlib.crc32(value) & 0xffffffff),
+}
+if blake2b is not None:
+    HASH_FUNCTIONS['blake2b'] = lambda value: blake2b(value, digest_size=20).digest()
+
 class Table(object):
     """
     Construct a new Table.
 
+    Buckets start out with a prefix of `prefixLength` digits. When a Bucket grows past `splitEntries` entries or
+    `splitBytes` bytes of keys and values, it is split into 16 Buckets with a prefix one digit longer, so a Table
+    may hold Buckets with prefixes of several different lengths.
+
     :param prefixLength: The initial hash prefix length to use.
+    :param treeDepth: The key hash prefix length that the hash trees used for synchronization descend to.
+    :param splitEntries: The number of entries above which a Bucket is split. `None` disables the limit.
+    :param splitBytes: The size of keys and values above which a Bucket is split. `None` disables the limit.
+    :param hashFunction: The name of the key hash function to use, from :data:`HASH_FUNCTIONS`.
+
+    A Table is kept only in memory unless a :class:`~zht.storage.LogStorage` is attached to :attr:`_storage`, after
+    which every accepted store is also appended to its log.
+
+    Methods that take a `keyHash` argument accept the key's hex digest (see :meth:`keyHash`) if the caller already
+    has it, so a key only needs to be hashed once on its way through a Node.
     """
-    def __init__(self, prefixLength = 1):
+    def __init__(self, prefixLength = 1, treeDepth = 3, splitEntries = None, splitBytes = None,
+                 hashFunction = 'sha1'):
+        if not hashFunction in HASH_FUNCTIONS:
+            raise ValueError("Unknown hash function '%s'" % (hashFunction,))
+        self._hashFunction = hashFunction
+        self._digest = HASH_FUNCTIONS[hashFunction]
         self._prefixLength = prefixLength
+        self._maxPrefixLength = prefixLength
+        self._treeDepth = treeDepth
+        self._splitEntries = splitEntries
+        self._splitBytes = splitBytes
         self._buckets = dict()
         self._owned = set()
+        self._storage = None
         for prefix in self._generatePrefixes():
-            self._buckets[prefix] = Bucket(prefix, True)
+            self._buckets[prefix] = Bucket(prefix, True, treeDepth, self._digest)
             self._owned.add(prefix)
     
     def _generatePrefixes(self, prefixLength = None):
@@ -49,16 +103,70 @@ class Table(object):
         :param prefixLength: The prefix length to generate. If `None`, defaults to the Table's current prefix length.
         :return: The hex digest of the key, truncated to `prefixLength` digits.
         """
-        return hex_hash(key)[:prefixLength or self._prefixLength]
+        return self.keyHash(key)[:prefixLength or self._prefixLength]
+
+    def keyHash(self, key):
+        """
+        Return the hex digest of a key, using this Table's hash function.
+
+        :param key: The key to hash.
+        """
+        return hexlify(self._digest(key))
 
-    def _getKeyBucket(self, key):
+    def _getKeyBucket(self, key, keyHash=None):
         """
         Get the bucket that the given key would be stored in.
 
         :param key: The key to search for.
+        :param keyHash: The hex digest of `key`, if already known.
         :return: The :class:`Bucket` that the key would be stored in.
         """
-        return self._buckets[self._getKeyHashPrefix(key)]
+        return self._getHashBucket(keyHash or self.keyHash(key))
+
+    def _getHashBucket(self, keyHash):
+        """
+        Get the bucket that a key with the given hash would be stored in.
+
+        :param keyHash: The hex digest of the key.
+        :return: The :class:`Bucket` whose prefix `keyHash` starts with.
+        """
+        for length in range(self._prefixLength, self._maxPrefixLength + 1):
+            bucket = self._buckets.get(keyHash[:length])
+            if bucket is not None:
+                return bucket
+        raise KeyError(keyHash)
+
+    def _getPrefixBuckets(self, prefix):
+        """
+        Get the buckets holding keys whose hash starts with the given prefix.
+
+        :param prefix: The key hash prefix.
+        :return: A :class:`list` holding either the single :class:`Bucket` whose prefix `prefix` starts with, or every
+            :class:`Bucket` whose prefix starts with `prefix`.
+        """
+        for length in range(min(len(prefix), self._maxPrefixLength), self._prefixLength - 1, -1):
+            bucket = self._buckets.get(prefix[:length])
+            if bucket is not None:
+                return [bucket]
+        return [bucket for bucketPrefix, bucket in self._buckets.items() if bucketPrefix.startswith(prefix)]
+
+    def _maybeSplit(self, bucket):
+        """
+        Split a bucket into 16 smaller buckets if it has grown past this Table's limits.
+
+        :param bucket: The :class:`Bucket` to check.
+        """
+        if ((self._splitEntries and len(bucket._entries) > self._splitEntries) or
+            (self._splitBytes and bucket._bytes > self._splitBytes)):
+            log.info("Splitting bucket '%s' (%d entries, %d bytes)", bucket._prefix, len(bucket._entries),
+                     bucket._bytes)
+            del self._buckets[bucket._prefix]
+            for prefix, child in bucket.split().items():
+                self._buckets[prefix] = child
+                if bucket._prefix in self._owned:
+                    self._owned.add(prefix)
+            self._owned.discard(bucket._prefix)
+            self._maxPrefixLength = max(self._maxPrefixLength, len(bucket._prefix) + 1)
 
     def __getitem__(self, key):
         """
@@ -66,7 +174,7 @@ class Table(object):
 
         :param key: The key to search for.
         :return: The value stored for `key`
-        :raise: :class:`NotImplemented` if this key's bucket isn't owned by the table.
+        :raise: :class:`NotImplementedError` if this key's bucket isn't owned by the table.
         :raise: :class:`KeyError` if this key's bucket is owned by the table, but the key hasn't had a value stored.
         """
         return self._getKeyBucket(key)[key]
@@ -77,11 +185,11 @@ class Table(object):
 
         :param key: The key to store under.
         :param value: The value to store for `key`
-        :raise: :class:`NotImplemented` if this key's bucket isn't owned by the table.
+        :raise: :class:`NotImplementedError` if this key's bucket isn't owned by the table.
         """
-        self._getKeyBucket(key)[key] = value
+        self.putValue(key, value, time())
 
-    def putValue(self, key, value, timestamp):
+    def putValue(self, key, value, timestamp, keyHash=None):
         """
         Store the given value under the given key, with timestamp.
 
@@ -89,37 +197,89 @@ class Table(object):
         :param value: The value to store.
         :param timestamp: The time associated with this store. If a store with a later timestamp has already
             occurred, this store will be ignored.
-        """
-        return self._getKeyBucket(key).putValue(key, value, timestamp)
+        :param keyHash: The hex digest of `key`, if already known.
+        :return: `True` if the store was accepted, `False` otherwise.
+        """
+        if keyHash is None:
+            keyHash = self.keyHash(key)
+        bucket = self._getHashBucket(keyHash)
+        if bucket.putValue(key, value, timestamp, keyHash):
+            if self._storage is not None:
+                self._storage.append(key, keyHash, value, timestamp)
+            self._maybeSplit(bucket)
+            return True
+        return False
 
-    def getValue(self, key):
+    def getValue(self, key, keyHash=None):
         """
         Get the value stored for the given key.
 
         :param key: The key to search for.
+        :param keyHash: The hex digest of `key`, if already known.
         :return: The value stored for `key`
-        :raise: :class:`NotImplemented` if this key's bucket isn't owned by the table.
+        :raise: :class:`NotImplementedError` if this key's bucket isn't owned by the table.
         :raise: :class:`KeyError` if this key's bucket is owned by the table, but the key hasn't had a value stored.
         """
-        return self._getKeyBucket(key).getValue(key)
+        return self._getKeyBucket(key, keyHash).getValue(key)
 
-    def getKeySet(self, prefix, includeTimestamp):
+    def getKeySet(self, prefix, includeTimestamp=None):
         """
         Get the set of keys for a given prefix.
 
-        **CAVEAT**: This method's implementation is incomplete. If too short of a prefix is given, it will return
-        nothing. includeTimestamp is also currently ignored.
-
-        :param prefix: The prefix to look under. Currently, this will be truncated to the current prefix length.
-        :param includeTimestamp: **Currently Unused** Return only keys modified after this timestamp.
+        :param prefix: The key hash prefix to look under. It may be shorter or longer than the prefixes of the Table's
+            buckets.
+        :param includeTimestamp: Return only keys modified (stored into this Table) at or after this time. `None`,
+            or `True` for compatibility with older callers, returns every key.
         :return: a :class:`dict` containing all keys stored under the given prefix, with their timestamps.
         """
-        if len(prefix) > self._prefixLength:
-            prefix = prefix[:self._prefixLength]
-        if prefix in self._buckets:
-            return dict((key, entry._timestamp) for key, entry in self._buckets[prefix]._entries.items())
+        return dict((entry._key, entry._timestamp) for entry in self.getEntries(prefix, includeTimestamp))
+
+    def getEntries(self, prefix, includeTimestamp=None):
+        """
+        Get the entries stored under a given prefix.
+
+        :param prefix: The key hash prefix to look under, as for :meth:`getKeySet`.
+        :param includeTimestamp: Return only entries modified at or after this time, as for :meth:`getKeySet`.
+        :return: A generator of :class:`TableEntry` objects. An entry may be returned more than once if it was
+            modified several times at the same instant.
+        """
+        for bucket in self._getPrefixBuckets(prefix):
+            if includeTimestamp is None or includeTimestamp is True:
+                entries = bucket._entries.itervalues()
+            else:
+                entries = bucket.modifiedSince(includeTimestamp)
+            if len(prefix) > len(bucket._prefix):
+                for entry in entries:
+                    if entry._hash.startswith(prefix):
+                        yield entry
+            else:
+                for entry in entries:
+                    yield entry
+
+    def treeDigest(self, prefix):
+        """
+        Get the hash tree digest of every entry whose key hash starts with the given prefix.
+
+        :param prefix: The key hash prefix. This must be no longer than the Table's tree depth.
+        :return: The digest, as an :class:`int`.
+        """
+        digest = 0
+        for bucket in self._getPrefixBuckets(prefix):
+            digest ^= bucket._tree.digest(prefix[len(bucket._prefix):])
+        return digest
+
+    def treeChildren(self, prefix):
+        """
+        Get the hash tree digests of the 16 prefixes that are 1 digit longer than the given prefix.
+
+        :param prefix: The key hash prefix. This must be shorter than the Table's tree depth.
+        :return: A :class:`list` of 16 digests, in hex digit order.
+        """
+        buckets = self._getPrefixBuckets(prefix)
+        if len(buckets) == 1 and len(buckets[0]._prefix) <= len(prefix):
+            return buckets[0]._tree.children(prefix[len(buckets[0]._prefix):])
         else:
-            return dict()
+            return [self.treeDigest(prefix + digit) for digit in HEX_DIGITS]
 
     def ownedBuckets(self):
         """
@@ -128,9 +288,74 @@ class Table(object):
         """
         return list(self._owned)
 
-    def owns(self, key):
+    def setOwned(self, partitions):
+        """
+        Set which partitions of the key space this Table owns.
+
+        A partition is a prefix of the Table's initial prefix length, so it covers one initial Bucket or all of the
+        Buckets it has been split into. Buckets that are no longer owned keep their entries until they are cleared
+        (see :meth:`Bucket.clear`).
+
+        :param partitions: The partition prefixes to own.
+        :return: A tuple of the :class:`set` of partitions newly owned and the :class:`set` of partitions no longer
+            owned.
+        """
+        partitions = set(partitions)
+        before = set(prefix[:self._prefixLength] for prefix in self._owned)
+        self._owned = set()
+        for prefix, bucket in self._buckets.items():
+            bucket._owned = prefix[:self._prefixLength] in partitions
+            if bucket._owned:
+                self._owned.add(prefix)
+        return partitions - before, before - partitions
+
+    def ownedPartitions(self):
+        """
+        :return: The :class:`set` of partition prefixes (see :meth:`setOwned`) this Table owns.
+        """
+        return set(prefix[:self._prefixLength] for prefix in self._owned)
+
+    def partitionEntries(self, partition):
+        """
+        Get every entry stored under a partition, whether or not it is owned.
+
+        :param partition: The partition prefix.
+        :return: A :class:`list` of :class:`TableEntry` objects.
+        """
+        return [entry for prefix, bucket in self._buckets.items() if prefix.startswith(partition)
+                for entry in bucket._entries.itervalues()]
+
+    def clearPartition(self, partition):
+        """
+        Drop every entry stored under a partition.
+
+        :param partition: The partition prefix.
+        """
+        for prefix, bucket in self._buckets.items():
+            if prefix.startswith(partition):
+                bucket.clear()
+
+    def sharedPrefixes(self, prefixes):
+        """
+        Get the key hash prefixes covered both by this Table's owned buckets and by another set of bucket prefixes.
+
+        Either side may have split its buckets further than the other, so each shared prefix is the longer of a pair
+        of overlapping bucket prefixes, truncated to this Table's tree depth.
+
+        :param prefixes: The other set of bucket prefixes.
+        :return: A :class:`set` of prefixes.
+        """
+        prefixes = set(prefixes)
+        shared = set()
+        for a, b in ((self._owned, prefixes), (prefixes, self._owned)):
+            for prefix in a:
+                if any(prefix[:length] in b for length in range(1, len(prefix) + 1)):
+                    shared.add(prefix[:self._treeDepth])
+        return shared
+
+    def owns(self, key, keyHash=None):
         try:
-            b = self._getKeyBucket(key)
+            b = self._getKeyBucket(key, keyHash)
             if b is None:
                 return False
             return b._owned
@@ -143,11 +368,19 @@ class Bucket(object):
 
     :param prefix: The prefix of this Bucket.
     :param owned: `True` if this Bucket is actually owned by this table, `False` otherwise.
+    :param treeDepth: The key hash prefix length that this Bucket's :class:`~zht.merkle.HashTree` descends to.
+    :param digest: The key hash function, returning a binary digest.
     """
-    def __init__(self, prefix, owned):
+    def __init__(self, prefix, owned, treeDepth = 3, digest = binary_hash):
         self._prefix = prefix
+        self._digest = digest
         self._owned = owned
         self._entries = dict()
+        self._treeDepth = treeDepth
+        self._tree = HashTree(max(0, treeDepth - len(prefix)))
+        self._modTimes = []
+        self._modKeys = []
+        self._bytes = 0
 
     def __getitem__(self, key):
         """
@@ -169,6 +402,16 @@ class Bucket(object):
         """
         self.putValue(key, value, time())
 
+    def clear(self):
+        """
+        Drop every entry in this Bucket.
+        """
+        self._entries = dict()
+        self._tree = HashTree(self._tree._depth)
+        self._modTimes = []
+        self._modKeys = []
+        self._bytes = 0
+
     def getValue(self, key):
         """
         Return the :class:`TableEntry` stored under the given key.
@@ -178,9 +421,9 @@ class Bucket(object):
         """
         if self._owned or key in self._entries:
             return self._entries[key]
-        raise NotImplemented("Uncached Lookup not implemented.")
+        raise NotImplementedError("Lookup in an unowned bucket")
 
-    def putValue(self, key, value, timestamp):
+    def putValue(self, key, value, timestamp, keyHash=None):
         """
         Set the value stored under the given key.
 
@@ -188,15 +431,83 @@ class Bucket(object):
         :param key: The key to store under.
         :param value: The value to store.
         :param timestamp: The time of this store.
+        :param keyHash: The hex digest of `key`, if already known.
         """
         if self._owned:
             if key in self._entries:
-                return self._entries[key].putValue(value, timestamp)
+                entry = self._entries[key]
+                oldTimestamp = entry._timestamp
+                oldSize = len(entry._value)
+                if entry.putValue(value, timestamp):
+                    self._bytes += len(value) - oldSize
+                    self._updateTree(entry, oldTimestamp)
+                    self._recordModification(entry)
+                    return True
+                return False
             else:
-                self._entries[key] = TableEntry(key, value, timestamp)
+                digest = unhexlify(keyHash) if keyHash else self._digest(key)
+                self._addEntry(TableEntry(key, value, timestamp, digest))
                 return True
         else:
-            raise NotImplemented("Unowned put not implemented.")
+            raise NotImplementedError("Store in an unowned bucket")
+
+    def _recordModification(self, entry, modified=None):
+        """
+        Add an entry to this Bucket's modification index.
+
+        The index is a list of (modification time, key) pairs sorted by time. Earlier records for the same key are
+        left in place and skipped over when reading, until they make up more than half of the index.
+
+        :param entry: The :class:`TableEntry` that was stored.
+        :param modified: The time the entry was stored. Defaults to the current time.
+        """
+        entry._modified = time() if modified is None else modified
+        if not self._modTimes or self._modTimes[-1] <= entry._modified:
+            self._modTimes.append(entry._modified)
+            self._modKeys.append(entry._key)
+        else:
+            i = bisect_left(self._modTimes, entry._modified)
+            self._modTimes.insert(i, entry._modified)
+            self._modKeys.insert(i, entry._key)
+        if len(self._modTimes) > 2 * len(self._entries):
+            index = sorted((e._modified, e._key) for e in self._entries.itervalues())
+            self._modTimes = [t for t, key in index]
+            self._modKeys = [key for t, key in index]
+
+    def modifiedSince(self, since):
+        """
+        Return the entries stored into this Bucket at or after a given time.
+
+        :param since: The earliest modification time to return.
+        :return: A generator of :class:`TableEntry` objects, in modification order.
+        """
+        i = bisect_left(self._modTimes, since)
+        for modified, key in zip(self._modTimes[i:], self._modKeys[i:]):
+            entry = self._entries.get(key)
+            if entry is not None and entry._modified == modified:
+                yield entry
+
+    def _addEntry(self, entry, modified=None):
+        """
+        Add a new entry to this Bucket.
+
+        :param entry: The :class:`TableEntry` to add. There must not already be an entry with the same key.
+        :param modified: The time the entry was stored. Defaults to the current time.
+        """
+        self._entries[entry._key] = entry
+        self._bytes += len(entry._key) + len(entry._value)
+        self._updateTree(entry, None)
+        self._recordModification(entry, modified)
+
+    def _updateTree(self, entry, oldTimestamp):
+        """
+        Update this Bucket's hash tree after an entry has been stored.
+
+        :param entry: The :class:`TableEntry` that was stored.
+        :param oldTimestamp: The entry's timestamp before the store, or `None` if it is a new entry.
+        """
+        oldDigest = 0 if oldTimestamp is None else entryDigest(entry._hash, oldTimestamp)
+        self._tree.update(entry._hash[len(self._prefix):], oldDigest, entryDigest(entry._hash, entry._timestamp))
     
     def split(self):
         """
@@ -204,10 +515,9 @@ class Bucket(object):
         """
         newBuckets = dict()
         for newPrefix in self._generateSplitPrefixes():
-            newBuckets[newPrefix] = Bucket(newPrefix, self._owned)
-        for key in self._entries.keys():
-            entry = self._entries[key]
-            newBuckets[entry._hash[:len(self._prefix)+1]]._putValue(entry._key, entry._value, entry._timestamp)
+            newBuckets[newPrefix] = Bucket(newPrefix, self._owned, self._treeDepth, self._digest)
+        for entry in sorted(self._entries.itervalues(), key=attrgetter('_modified')):
+            newBuckets[entry._hash[:len(self._prefix)+1]]._addEntry(entry, entry._modified)
         return newBuckets
 
     def _generateSplitPrefixes(self):
@@ -224,12 +534,26 @@ class TableEntry(object):
     :param key: The key for this TableEntry.
     :param value: The initial value for this TableEntry.
     :param timestamp: The initial timestamp for this TableEntry.
+    :param digest: The binary digest of `key`. Defaults to its SHA1 digest.
+
+    There is one TableEntry per key in a :class:`Table`, so they are kept small: attributes live in slots rather
+    than a per-instance `__dict__`, and the key's hash is stored as a binary digest, half the size of the hex digest.
     """
-    def __init__(self, key, value=None, timestamp=None):
+    __slots__ = ('_key', '_digest', '_value', '_timestamp', '_modified')
+
+    def __init__(self, key, value=None, timestamp=None, digest=None):
         self._key = key
-        self._hash = hex_hash(key)
+        self._digest = digest or binary_hash(key)
         self._value = value
         self._timestamp = timestamp
+        self._modified = None
+
+    @property
+    def _hash(self):
+        """
+        The hex digest of this TableEntry's key.
+        """
+        return hexlify(self._digest)
 
     def __eq__(self, other):
         """
@@ -4,12 +4,20 @@
 import zmq
 import gevent
 import os
-from zht.shell import ZHTControl
+import shutil
+import tempfile
+from time import time
+from zht.shell import ZHTControl, ZHTCmd, ControlTimeout
 from zht.node import Node
+from zht.peer import PeerBusy
+from zht.admission import WorkQueue
+from zht.shard import Frontend, shardIdentity, shardAddr
+from zht.client import ZHTClient, HashMismatch
+from zht.migration import Migration, TokenBucket
 from unittest import TestCase
 
-def initNode(identity, connectAddr):
-    node = Node(identity, 'ipc://testSock%sREP' % identity, 'ipc://testSock%sPUB' % identity, "")
+def initNode(identity, connectAddr, **nodeOptions):
+    node = Node(identity, 'ipc://testSock%sREP' % identity, 'ipc://testSock%sPUB' % identity, "", **nodeOptions)
     node.start()
     if connectAddr != "" and not connectAddr is None:
         node.spawn(n.connect, connect)
@@ -19,8 +27,26 @@ def initNode(identity, connectAddr):
 def closeNode(node, control):
     control.EOF()
     node._greenletPool.join()
-    os.remove('testSock%sREP' % node._id)
-    os.remove('testSock%sPUB' % node._id)
+    # Closing the Node's sockets removes their ipc files; wait for that, so it can't happen after the next Node to
+    # use the same addresses has bound them.
+    for path in ('testSock%sREP' % node._id, 'testSock%sPUB' % node._id):
+        for i in range(100):
+            if not os.path.exists(path):
+                break
+            gevent.sleep(0.01)
+        else:
+            os.remove(path)
+
+def crashNode(node, control):
+    """
+    Stop a Node without warning its Peers. Its control socket is closed as well, so it can't deliver a command to a
+    later Node with the same identity.
+    """
+    for queue in node._workQueues.values():
+        queue.kill()
+    node._greenletPool.kill()
+    node._close()
+    control._sock.close(linger=0)
 
 def clearWaitingGreenlets(n=10):
     """
@@ -30,6 +56,13 @@ def clearWaitingGreenlets(n=10):
     for i in range(2**n):
         gevent.sleep(0)
 
+def waitForUpdates(interval=0.005):
+    """
+    Wait for updates buffered by each Node's update interval to be published and applied.
+    """
+    gevent.sleep(interval * 2)
+    clearWaitingGreenlets()
+
 class Test2NodeZHT(TestCase):
     def setUp(self):
         self.aNode, self.aControl = initNode('a', None)
@@ -50,6 +83,15 @@ class Test2NodeZHT(TestCase):
         self.assertEqual(self.aControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.bControl.get(['asdf']), ['KeyError'])
 
+    def testOddMput(self):
+        self.assertEqual(self.aControl.recv(self.aControl.send(['MPUT', 'asdf', 'qwer', 'zxcv'])),
+                         ['ERROR', 'BadArgument', 'MPUT', 'Expected key/value pairs'])
+        self.assertEqual(self.aControl.get(['asdf', 'zxcv']), ['KeyError', 'KeyError'])
+
+    def testControlErrors(self):
+        self.assertEqual(self.aControl.recv(self.aControl.send(['PUT', 'asdf']))[:3], ['ERROR', 'Internal', 'PUT'])
+        self.assertEqual(self.aControl.peers(), ['PEERS'])
+
     def testSync(self):
         self.assertEqual(self.aControl.get(['asdf']), ['KeyError'])
         self.assertEqual(self.aControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
@@ -60,6 +102,7 @@ class Test2NodeZHT(TestCase):
         self.assertEqual(self.aControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.bControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.bControl.put('zxcv', 'poiu'), ['OK', 'zxcv', 'poiu'])
+        waitForUpdates()
         self.assertEqual(self.aControl.get(['zxcv']), ['poiu'])
         self.assertEqual(self.bControl.get(['zxcv']), ['poiu'])
 
@@ -73,11 +116,212 @@ class Test2NodeZHT(TestCase):
         self.assertEqual(self.aControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.bControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.bControl.put('zxcv', 'poiu'), ['OK', 'zxcv', 'poiu'])
+        waitForUpdates()
         self.assertEqual(self.aControl.get(['zxcv']), ['poiu'])
         self.assertEqual(self.bControl.get(['zxcv']), ['poiu'])
         self.assertEqual(self.aControl.rget(['asdf', 'zxcv']), ['qwer', 'poiu'])
         self.assertEqual(self.bControl.rget(['asdf', 'zxcv']), ['qwer', 'poiu'])
 
+    def testPipelinedRequests(self):
+        for i in range(20):
+            self.assertEqual(self.aControl.put('key%d' % i, 'value%d' % i), ['OK', 'key%d' % i, 'value%d' % i])
+        self.assertEqual(self.bControl.connect(['ipc://testSockaREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        peer = self.bNode._peers['a']
+        greenlets = [gevent.spawn(peer._makeRequest, ['GET', 'key%d' % i]) for i in range(20)]
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value[2] for g in greenlets], ['value%d' % i for i in range(20)])
+        self.assertEqual(peer._pending, {})
+
+    def testBatchedRGet(self):
+        keys = ['key%d' % i for i in range(100)]
+        self.assertEqual(self.aControl.mput(dict((key, key.upper()) for key in keys)), ['OK', '100'])
+        self.assertEqual(self.aControl.get(keys), [key.upper() for key in keys])
+        self.assertEqual(self.bControl.connect(['ipc://testSockaREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        peer = self.bNode._peers['a']
+        requests = []
+        makeRequest = peer._makeRequest
+        def countingRequest(req, *args):
+            requests.append(req[0])
+            return makeRequest(req, *args)
+        peer._makeRequest = countingRequest
+        self.assertEqual(self.bControl.rget(keys + ['missing']), [key.upper() for key in keys] + ['KeyError'])
+        self.assertEqual(requests, ['MGET'])
+
+    def testBatchedUpdates(self):
+        self.assertEqual(self.bControl.connect(['ipc://testSockaREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        updates = []
+        handleSubMessage = self.bNode._handleSubMessage
+        def countingHandler(m):
+            if m[0].startswith('UPDATE|'):
+                updates.append(m)
+            return handleSubMessage(m)
+        self.bNode._handleSubMessage = countingHandler
+        keys = ['key%d' % i for i in range(100)]
+        self.assertEqual(self.aControl.mput(dict((key, 'old') for key in keys)), ['OK', '100'])
+        self.assertEqual(self.aControl.mput(dict((key, key.upper()) for key in keys)), ['OK', '100'])
+        waitForUpdates()
+        self.assertEqual(self.bControl.get(keys), [key.upper() for key in keys])
+        self.assertTrue(len(updates) <= 16)
+        self.assertEqual(sum((len(m) - 1) / 4 for m in updates), 100)
+
+    def testSubscriptions(self):
+        self.assertEqual(self.aNode._subscriptions,
+                         set(['PEER', 'LEAVE', 'HEARTBEAT', 'BUCKETS'] + ['UPDATE|%x' % i for i in range(16)]))
+        self.assertEqual(self.bControl.connect(['ipc://testSockaREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        keyHash = self.aNode._table.keyHash('asdf')
+        self.aNode._table._owned.discard(keyHash[0])
+        self.aNode._updateSubscriptions()
+        self.assertFalse('UPDATE|' + keyHash[0] in self.aNode._subscriptions)
+        updates = []
+        handleSubMessage = self.aNode._handleSubMessage
+        def countingHandler(m):
+            if m[0].startswith('UPDATE|'):
+                updates.append(m[0])
+            return handleSubMessage(m)
+        self.aNode._handleSubMessage = countingHandler
+        self.assertEqual(self.bControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        self.assertEqual(self.bControl.put('zxcv', 'poiu'), ['OK', 'zxcv', 'poiu'])
+        waitForUpdates()
+        self.assertEqual(updates, ['UPDATE|' + self.aNode._table.keyHash('zxcv')[0]])
+
+    def testReleasedPendingUpdate(self):
+        table = self.aNode._table
+        prefix = table.keyHash('asdf')[0]
+        other = [key for key in ('key%d' % i for i in range(100)) if table.keyHash(key)[0] != prefix][0]
+        table['asdf'] = 'qwer'
+        self.aNode._pubUpdate('asdf')
+        table.setOwned(table.ownedPartitions() - set([prefix]))
+        table.clearPartition(prefix)
+        waitForUpdates()
+        self.assertEqual(self.aNode._pendingUpdates, {})
+        self.assertEqual(self.aControl.put(other, 'value'), ['OK', other, 'value'])
+        waitForUpdates()
+        self.assertEqual(self.aNode._pendingUpdates, {})
+
+    def testNearCache(self):
+        prefix = self.aNode._table.keyHash('asdf')[0]
+        self.assertEqual(self.aControl.connect(['ipc://testSockbREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        self.aNode._table.setOwned(set('%x' % i for i in range(16)) - set([prefix]))
+        self.aNode._table.clearPartition(prefix)
+        self.aNode._updateSubscriptions()
+        self.assertEqual(self.bControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        waitForUpdates()
+        self.assertFalse('UPDATE|' + prefix in self.aNode._subscriptions)
+        subscriptions = set(self.aNode._subscriptions)
+        updates = []
+        updateSubscriptions = self.aNode._updateSubscriptions
+        def countingUpdate():
+            updates.append(True)
+            return updateSubscriptions()
+        self.aNode._updateSubscriptions = countingUpdate
+        self.assertEqual(self.aControl.get(['asdf']), ['qwer'])
+        self.assertEqual(self.aNode._subscriptions, subscriptions | set(['UPDATE|' + prefix]))
+        self.assertEqual(updates, [])
+        self.assertEqual(self.aControl.get(['asdf']), ['qwer'])
+        stats = self.aControl.stats()['nearCache']
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+        self.assertEqual(self.bControl.put('asdf', 'zxcv'), ['OK', 'asdf', 'zxcv'])
+        waitForUpdates()
+        self.assertEqual(self.aControl.get(['asdf']), ['zxcv'])
+        self.assertEqual(self.aControl.stats()['nearCache']['hits'], 2)
+
+    def testAntiEntropy(self):
+        self.assertEqual(self.bControl.connect(['ipc://testSockaREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        self.aNode._table['missed'] = 'update'
+        self.assertEqual(self.bControl.get(['missed']), ['KeyError'])
+        peer = self.bNode._peers['a']
+        requests = []
+        makeRequest = peer._makeRequest
+        def countingRequest(req, *args):
+            requests.append(req[0])
+            return makeRequest(req, *args)
+        peer._makeRequest = countingRequest
+        peer.sync()
+        self.assertEqual(self.bControl.get(['missed']), ['update'])
+        self.assertEqual(requests, ['TREE', 'TREE', 'KEYS', 'MGET-SYNC'])
+        del requests[:]
+        peer.sync()
+        self.assertEqual(requests, ['TREE'])
+        del requests[:]
+        self.aNode._table['missed'] = 'later'
+        peer.sync()
+        self.assertEqual(self.bControl.get(['missed']), ['later'])
+        self.assertEqual(requests, ['TREE', 'TREE', 'KEYS', 'MGET-SYNC'])
+        del requests[:]
+        self.aNode._incarnation = 'restarted'
+        self.aNode._table['missed'] = 'again'
+        peer.sync()
+        self.assertEqual(self.bControl.get(['missed']), ['again'])
+        self.assertEqual(requests, ['TREE', 'TREE', 'KEYS', 'KEYS', 'MGET-SYNC'])
+
+    def testHashFunction(self):
+        cNode, cControl = initNode('c', None, hashFunction='md5')
+        try:
+            self.assertEqual(cControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+            self.assertEqual(cNode._table.getValue('asdf')._hash, cNode._table.keyHash('asdf'))
+            self.assertNotEqual(cNode._table.keyHash('asdf'), self.aNode._table.keyHash('asdf'))
+            self.assertEqual(cControl.connect(['ipc://testSockaREP']), ['OK'])
+            clearWaitingGreenlets(12)
+            self.assertEqual(cControl.peers(), ['PEERS'])
+            self.assertEqual(self.aControl.peers(), ['PEERS'])
+        finally:
+            closeNode(cNode, cControl)
+
+    def testCodecNegotiation(self):
+        cNode, cControl = initNode('c', None, codec='json')
+        try:
+            self.assertEqual(self.aControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+            self.assertEqual(self.bControl.connect(['ipc://testSockaREP']), ['OK'])
+            self.assertEqual(cControl.connect(['ipc://testSockaREP']), ['OK'])
+            clearWaitingGreenlets(12)
+            self.assertEqual(self.aNode._peers['b']._codec.name, 'bin1')
+            self.assertEqual(self.bNode._peers['a']._codec.name, 'bin1')
+            self.assertEqual(self.aNode._peers['c']._codec.name, 'json')
+            self.assertEqual(cNode._peers['a']._codec.name, 'json')
+            self.assertEqual(self.bControl.get(['asdf']), ['qwer'])
+            self.assertEqual(cControl.get(['asdf']), ['qwer'])
+        finally:
+            closeNode(cNode, cControl)
+
+    def testReleasedPartitionRestart(self):
+        storageDir = tempfile.mkdtemp()
+        try:
+            cNode, cControl = initNode('c', None, storageDir=storageDir)
+            self.assertEqual(cControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+            prefix = cNode._table.keyHash('asdf')[0]
+            cNode._replicas = 0
+            Migration(cNode, prefix, TokenBucket(None)).run()
+            self.assertFalse(prefix in cNode._table.ownedPartitions())
+            for i in range(100):
+                if not cNode._snapshotWanted.is_set():
+                    break
+                gevent.sleep(0.01)
+            gevent.sleep(0.1)
+            closeNode(cNode, cControl)
+            cNode, cControl = initNode('c', None, storageDir=storageDir)
+            self.assertEqual(cControl.get(['asdf']), ['KeyError'])
+            closeNode(cNode, cControl)
+        finally:
+            shutil.rmtree(storageDir)
+
+    def testRestart(self):
+        storageDir = tempfile.mkdtemp()
+        try:
+            cNode, cControl = initNode('c', None, storageDir=storageDir)
+            self.assertEqual(cControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+            closeNode(cNode, cControl)
+            cNode, cControl = initNode('c', None, storageDir=storageDir)
+            self.assertEqual(cControl.get(['asdf']), ['qwer'])
+            closeNode(cNode, cControl)
+        finally:
+            shutil.rmtree(storageDir)
+
 class Test3NodeZHT(TestCase):
     def setUp(self):
         self.aNode, self.aControl = initNode('a', None)
@@ -114,6 +358,7 @@ class Test3NodeZHT(TestCase):
         self.assertEqual(self.bControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.cControl.get(['asdf']), ['KeyError'])
         self.assertEqual(self.bControl.put('zxcv', 'poiu'), ['OK', 'zxcv', 'poiu'])
+        waitForUpdates()
         self.assertEqual(self.aControl.get(['zxcv']), ['poiu'])
         self.assertEqual(self.bControl.get(['zxcv']), ['poiu'])
         self.assertEqual(self.cControl.get(['asdf']), ['KeyError'])
@@ -124,6 +369,29 @@ class Test3NodeZHT(TestCase):
         self.assertEqual(self.cControl.get(['asdf']), ['qwer'])
         self.assertEqual(self.cControl.get(['zxcv']), ['poiu'])
 
+    def testForwarding(self):
+        self.assertEqual(self.aControl.connect(['ipc://testSockbREP', 'ipc://testSockcREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        received = dict()
+        for node in (self.aNode, self.bNode, self.cNode):
+            def countingHandler(m, node=node, handleSubMessage=node._handleSubMessage):
+                if m[0].startswith('UPDATE|'):
+                    received[node._id] = received.get(node._id, 0) + 1
+                return handleSubMessage(m)
+            node._handleSubMessage = countingHandler
+        self.assertEqual(self.aControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        waitForUpdates()
+        self.assertEqual(received, {'b': 1, 'c': 1})
+        for node in (self.aNode, self.bNode, self.cNode):
+            node._forwarding = 'flood'
+        received.clear()
+        self.assertEqual(self.aControl.put('asdf', 'zxcv'), ['OK', 'asdf', 'zxcv'])
+        waitForUpdates()
+        waitForUpdates()
+        self.assertEqual(received, {'a': 2, 'b': 2, 'c': 2})
+        self.assertEqual(self.bControl.get(['asdf']), ['zxcv'])
+        self.assertEqual(self.cControl.get(['asdf']), ['zxcv'])
+
     def testAutopeer(self):
         self.assertEqual(self.aControl.connect(['ipc://testSockbREP']), ['OK'])
         clearWaitingGreenlets(12)
@@ -136,3 +404,430 @@ class Test3NodeZHT(TestCase):
         self.assertItemsEqual(self.bControl.peers()[1:], ['a', 'c'])
         self.assertItemsEqual(self.cControl.peers()[1:], ['a', 'b'])
 
+
+class TestPartitioning(TestCase):
+    def setUp(self):
+        self.nodes = [initNode(identity, None, replicas=2, antiEntropyInterval=None) for identity in 'abcd']
+
+    def tearDown(self):
+        for node, control in self.nodes:
+            closeNode(node, control)
+        self.nodes = None
+
+    def testPartitioning(self):
+        (aNode, aControl) = self.nodes[0]
+        keys = ['key%d' % i for i in range(50)]
+        self.assertEqual(aControl.mput(dict((key, key.upper()) for key in keys)), ['OK', '50'])
+        self.assertEqual(aControl.connect(['ipc://testSock%sREP' % identity for identity in 'bcd']), ['OK'])
+        clearWaitingGreenlets(13)
+        waitForUpdates(0.5)
+        owners = dict()
+        for node, control in self.nodes:
+            self.assertEqual(len(node._peers), 3)
+            for partition in node._table.ownedPartitions():
+                owners.setdefault(partition, []).append(node._id)
+        self.assertEqual(sorted(owners), ['%x' % i for i in range(16)])
+        self.assertTrue(all(len(partitionOwners) == 2 for partitionOwners in owners.values()))
+        for node, control in self.nodes:
+            self.assertEqual(control.get(keys), [key.upper() for key in keys])
+            stored = sum(len(bucket._entries) for bucket in node._table._buckets.values())
+            self.assertEqual(stored, sum(1 for key in keys if node._table.owns(key)))
+        (dNode, dControl) = self.nodes[3]
+        self.assertEqual(dControl.put('key0', 'new'), ['OK', 'key0', 'new'])
+        self.assertEqual(dControl.mput([('key1', 'new'), ('key2', 'new')]), ['OK', '2'])
+        waitForUpdates()
+        for node, control in self.nodes:
+            self.assertEqual(control.get(['key0', 'key1', 'key2']), ['new'] * 3)
+
+    def testMigration(self):
+        (aNode, aControl) = self.nodes[0]
+        keys = ['key%d' % i for i in range(200)]
+        self.assertEqual(aControl.mput(dict((key, key.upper()) for key in keys)), ['OK', '200'])
+        aNode._migrationLimiter = TokenBucket(1000)
+        self.assertEqual(aControl.connect(['ipc://testSock%sREP' % identity for identity in 'bcd']), ['OK'])
+        self.assertTrue(aControl.migrations()['outgoing'])
+        self.assertEqual(aControl.mput(dict((key, 'new') for key in keys)), ['OK', '200'])
+        for i in range(100):
+            if not any(node._migrations or node._incoming for node, control in self.nodes):
+                break
+            gevent.sleep(0.1)
+        waitForUpdates()
+        for node, control in self.nodes:
+            self.assertEqual(control.get(keys), ['new'] * len(keys))
+            stored = sum(len(bucket._entries) for bucket in node._table._buckets.values())
+            self.assertEqual(stored, sum(1 for key in keys if node._table.owns(key)))
+        progress = aControl.migrations()
+        self.assertEqual(progress['outgoing'], [])
+        self.assertEqual(progress['incoming'], [])
+        done = [migration for migration in progress['finished'] if migration['state'] == 'done']
+        self.assertEqual(set(migration['partition'] for migration in done),
+                         set('%x' % i for i in range(16)) - aNode._table.ownedPartitions())
+        self.assertTrue(sum(migration['throttled'] for migration in done) > 0)
+
+class TestReplicatedReads(TestCase):
+    def setUp(self):
+        self.nodes = [initNode(identity, None, antiEntropyInterval=None) for identity in 'abc']
+        (aNode, aControl) = self.nodes[0]
+        self.assertEqual(aControl.connect(['ipc://testSockbREP', 'ipc://testSockcREP']), ['OK'])
+        clearWaitingGreenlets(12)
+        self.assertEqual(aControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        waitForUpdates()
+
+    def tearDown(self):
+        for node, control in self.nodes:
+            closeNode(node, control)
+        self.nodes = None
+
+    def _firstOwner(self, key):
+        (aNode, aControl) = self.nodes[0]
+        keyHash = aNode._table.keyHash(key)
+        owner = aNode._groupByOwner([(key, keyHash)]).keys()[0]
+        return [node for node, control in self.nodes if node._id == owner][0]
+
+    def testHedged(self):
+        (aNode, aControl) = self.nodes[0]
+        slowNode = self._firstOwner('asdf')
+        handleRepMessage = slowNode._handleRepMessage
+        def slowHandler(m):
+            if 'MGET' in m:
+                gevent.sleep(1)
+            return handleRepMessage(m)
+        slowNode._handleRepMessage = slowHandler
+        aNode._hedgeDelay = 0.05
+        started = time()
+        self.assertEqual(aControl.rget(['asdf', 'missing'], 'hedged'), ['qwer', 'KeyError'])
+        self.assertTrue(time() - started < 0.5)
+        self.assertEqual(aControl.stats()['reads']['hedged'], 1)
+        started = time()
+        self.assertEqual(aControl.rget(['asdf']), ['qwer'])
+        self.assertTrue(time() - started >= 1)
+
+    def testQuorum(self):
+        (aNode, aControl) = self.nodes[0]
+        staleNode = self._firstOwner('asdf')
+        newNode = [node for node, control in self.nodes[1:] if node is not staleNode][0]
+        newNode._table.putValue('asdf', 'newer', time())
+        self.assertEqual(aControl.rget(['asdf']), ['qwer'])
+        self.assertEqual(aControl.rget(['asdf', 'missing'], 'quorum', 2), ['newer', 'KeyError'])
+        self.assertEqual(aControl.rget(['asdf'], 'quorum', 'two'),
+                         ['ERROR', 'BadArgument', 'RGET-QUORUM', 'Expected a positive quorum'])
+        self.assertEqual(aControl.recv(aControl.send(['RGET-QUORUM']))[:2], ['ERROR', 'BadArgument'])
+        self.assertTrue(aControl.rget(['asdf'], 'quorum', 1) in (['qwer'], ['newer']))
+
+    def testReadRepair(self):
+        (aNode, aControl) = self.nodes[0]
+        staleNode = self._firstOwner('asdf')
+        newNode = [node for node, control in self.nodes[1:] if node is not staleNode][0]
+        newNode._table.putValue('asdf', 'newer', time())
+        newNode._table.putValue('zxcv', 'only', time())
+        self.assertEqual(aControl.rget(['asdf', 'zxcv'], 'quorum', 2), ['newer', 'only'])
+        waitForUpdates()
+        self.assertEqual(staleNode._table.getValue('asdf')._value, 'newer')
+        self.assertEqual(staleNode._table.getValue('zxcv')._value, 'only')
+        self.assertEqual(aControl.stats()['reads']['repairs'], 2)
+        self.assertEqual(aControl.rget(['asdf', 'zxcv'], 'quorum', 2), ['newer', 'only'])
+        waitForUpdates()
+        self.assertEqual(aControl.stats()['reads']['repairs'], 2)
+
+    def testFailover(self):
+        (aNode, aControl) = self.nodes[0]
+        deadNode = self._firstOwner('asdf')
+        handleRepMessage = deadNode._handleRepMessage
+        def dropHandler(m):
+            if not 'MGET' in m:
+                return handleRepMessage(m)
+        deadNode._handleRepMessage = dropHandler
+        aNode._requestTimeout = 0.1
+        aNode._readTimeout = 0.5
+        started = time()
+        self.assertEqual(aControl.rget(['asdf']), ['qwer'])
+        self.assertTrue(time() - started < 1)
+        self.assertEqual(aControl.stats()['requestTimeouts'], 1)
+        self.assertEqual(aControl.rget(['asdf'], 'quorum', 2)[:2], ['ERROR', 'Timeout'])
+        aNode._readTimeout = 0.05
+        self.assertEqual(aControl.rget(['asdf'])[:2], ['ERROR', 'Timeout'])
+
+    def testConcurrentControl(self):
+        (aNode, aControl) = self.nodes[0]
+        slowNode = self._firstOwner('asdf')
+        handleRepMessage = slowNode._handleRepMessage
+        def slowHandler(m):
+            if 'MGET' in m:
+                gevent.sleep(0.5)
+            return handleRepMessage(m)
+        slowNode._handleRepMessage = slowHandler
+        started = time()
+        rget = aControl.send(['RGET', 'asdf'])
+        puts = [aControl.send(['PUT', 'key%d' % i, 'value']) for i in range(10)]
+        self.assertEqual(sorted(aControl.peers()), ['PEERS', 'b', 'c'])
+        self.assertEqual([aControl.recv(put) for put in reversed(puts)],
+                         [['OK', 'key%d' % i, 'value'] for i in reversed(range(10))])
+        self.assertTrue(time() - started < 0.4)
+        self.assertEqual(aControl.recv(rget), ['qwer'])
+        self.assertTrue(time() - started >= 0.5)
+
+class TestTimeouts(TestCase):
+    def setUp(self):
+        self.aNode, self.aControl = initNode('a', None, requestTimeout=0.1)
+
+    def tearDown(self):
+        closeNode(self.aNode, self.aControl)
+        self.aNode = self.aControl = None
+
+    def testConnectTimeout(self):
+        started = time()
+        self.assertEqual(self.aControl.connect(['ipc://testSocknobodyREP']), ['OK'])
+        self.assertTrue(time() - started < 1)
+        self.assertEqual(self.aControl.peers(), ['PEERS'])
+        self.assertEqual(self.aControl.stats()['requestTimeouts'], 1)
+
+    def testControlTimeout(self):
+        ctx = zmq.Context()
+        control = ZHTControl(ctx, 'nobody', timeout=0.1)
+        self.assertRaises(ControlTimeout, control.peers)
+        self.assertRaises(ControlTimeout, control.peers)
+        control._sock.close(linger=0)
+        ctx.term()
+        self.aControl.timeout = 1
+        self.assertEqual(self.aControl.peers(), ['PEERS'])
+
+    def testShellTimeout(self):
+        ctx = zmq.Context()
+        shell = ZHTCmd(ctx, 'nobody', timeout=0.1)
+        self.assertEqual(shell.onecmd('peers'), None)
+        shell._control._sock.close(linger=0)
+        ctx.term()
+
+class TestMembership(TestCase):
+    def setUp(self):
+        self.nodes = [initNode(identity, None, antiEntropyInterval=None, heartbeatInterval=0.2) for identity in 'abc']
+        (aNode, aControl) = self.nodes[0]
+        self.assertEqual(aControl.connect(['ipc://testSockbREP', 'ipc://testSockcREP']), ['OK'])
+        clearWaitingGreenlets(12)
+
+    def tearDown(self):
+        for node, control in self.nodes:
+            closeNode(node, control)
+        self.nodes = None
+
+    def testFailureDetection(self):
+        (aNode, aControl), (bNode, bControl), (cNode, cControl) = self.nodes
+        gevent.sleep(0.5)
+        members = aControl.members()
+        self.assertEqual(sorted(members), ['b', 'c'])
+        self.assertEqual([members[identity]['state'] for identity in 'bc'], ['alive', 'alive'])
+        self.assertEqual(aControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        crashNode(bNode, bControl)
+        self.nodes.remove((bNode, bControl))
+        gevent.sleep(1.5)
+        self.assertEqual(sorted(aControl.members()), ['c'])
+        self.assertEqual(aControl.peers(), ['PEERS', 'c'])
+        self.assertEqual(aControl.stats()['suspectPeers'], 0)
+        self.assertEqual(aControl.rget(['asdf']), ['qwer'])
+
+    def testTombstones(self):
+        (aNode, aControl), (bNode, bControl), (cNode, cControl) = self.nodes
+        gevent.sleep(0.5)
+        self.assertEqual(sorted(aNode._memberIds()), ['a', 'b', 'c'])
+        crashNode(bNode, bControl)
+        self.nodes.remove((bNode, bControl))
+        gevent.sleep(1.5)
+        self.assertEqual(aNode._memberIds(), ['a', 'c'])
+        aNode._learnNode('b', 'ipc://testSockbREP')
+        self.assertFalse('b' in aNode._knownNodes)
+        self.assertEqual(aControl.stats()['tombstones'], 1)
+        aNode._membership._states['c'] = 'suspect'
+        self.assertEqual(aNode._memberIds(), ['a'])
+        aNode._membership._states['c'] = 'alive'
+        aNode._tombstones['b'] = time() - 1
+        self.assertFalse(aNode._tombstoned('b'))
+        self.assertEqual(aControl.stats()['tombstones'], 0)
+
+    def testInboundFailureDetection(self):
+        (aNode, aControl), (bNode, bControl), (cNode, cControl) = self.nodes
+        gevent.sleep(0.5)
+        self.assertEqual(sorted(bControl.members()), ['a', 'c'])
+        crashNode(aNode, aControl)
+        self.nodes.remove((aNode, aControl))
+        gevent.sleep(1.5)
+        self.assertEqual(sorted(bControl.members()), ['c'])
+        self.assertEqual(bControl.peers(), ['PEERS', 'c'])
+
+class TestPartialViews(TestCase):
+    def setUp(self):
+        self.nodes = [initNode(identity, None, antiEntropyInterval=None, replicas=2, activeViewSize=2,
+                               shuffleInterval=0.2) for identity in 'abcde']
+
+    def tearDown(self):
+        for node, control in self.nodes:
+            closeNode(node, control)
+        self.nodes = None
+
+    def testGossipMembership(self):
+        for (node, control), (previous, previousControl) in zip(self.nodes[1:], self.nodes):
+            self.assertEqual(control.connect(['ipc://testSock%sREP' % previous._id]), ['OK'])
+        clearWaitingGreenlets(13)
+        gevent.sleep(0.5)
+        owners = dict()
+        for node, control in self.nodes:
+            self.assertEqual(sorted(node._knownNodes), sorted(set('abcde') - set(node._id)))
+            self.assertTrue(len(node._view) <= 2)
+            for partition in node._assigned:
+                owners.setdefault(partition, []).append(node._id)
+        self.assertEqual(sorted(owners), ['%x' % i for i in range(16)])
+        self.assertTrue(all(len(partitionOwners) == 2 for partitionOwners in owners.values()))
+        (aNode, aControl) = self.nodes[0]
+        (eNode, eControl) = self.nodes[4]
+        keys = ['key%d' % i for i in range(20)]
+        self.assertEqual(aControl.mput(dict((key, key.upper()) for key in keys)), ['OK', '20'])
+        waitForUpdates()
+        self.assertEqual(eControl.get(keys), [key.upper() for key in keys])
+        self.assertEqual(eControl.stats()['knownNodes'], 4)
+
+class TestAdmission(TestCase):
+    def setUp(self):
+        self.aNode, self.aControl = initNode('a', None, antiEntropyInterval=None)
+        self.bNode, self.bControl = initNode('b', None, antiEntropyInterval=None)
+        self.assertEqual(self.aControl.connect(['ipc://testSockbREP']), ['OK'])
+        for i in range(100):
+            if not (self.aNode._incoming or self.bNode._incoming):
+                break
+            gevent.sleep(0.01)
+        self.assertEqual(self.aControl.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        waitForUpdates()
+
+    def tearDown(self):
+        closeNode(self.aNode, self.aControl)
+        closeNode(self.bNode, self.bControl)
+        self.aNode = self.aControl = self.bNode = self.bControl = None
+
+    def testSyncStorm(self):
+        self.bNode._workQueues['sync'] = WorkQueue('sync', 1, 1)
+        handleRepMessage = self.bNode._handleRepMessage
+        def slowHandler(m):
+            if 'KEYS' in m:
+                gevent.sleep(0.5)
+            return handleRepMessage(m)
+        self.bNode._handleRepMessage = slowHandler
+        peer = self.aNode._peers['b']
+        syncs = []
+        for i in range(4):
+            syncs.append(gevent.spawn(peer._makeRequest, ['KEYS', ''], None, 0))
+            gevent.sleep(0.01)
+        started = time()
+        found = peer.mget([('asdf', self.aNode._table.keyHash('asdf'))])
+        self.assertEqual(found['asdf'][0], 'qwer')
+        self.assertTrue(time() - started < 0.1)
+        gevent.joinall(syncs)
+        self.assertEqual([sync.successful() for sync in syncs], [True, True, False, False])
+        self.assertTrue(all(isinstance(sync.exception, PeerBusy) for sync in syncs[2:]))
+        self.assertEqual(self.aControl.stats()['busyReplies'], 2)
+        stats = self.bControl.stats()['admission']
+        self.assertEqual((stats['sync']['processed'], stats['sync']['shed']), (2, 2))
+        self.assertEqual(stats['client']['shed'], 0)
+
+    def testFullPool(self):
+        sleepers = [self.bNode.spawn(gevent.sleep, 10) for i in range(self.bNode._greenletPool.free_count())]
+        try:
+            started = time()
+            found = self.aNode._peers['b'].mget([('asdf', self.aNode._table.keyHash('asdf'))])
+            self.assertEqual(found['asdf'][0], 'qwer')
+            self.assertTrue(time() - started < 0.5)
+        finally:
+            for sleeper in sleepers:
+                sleeper.kill()
+
+class TestShards(TestCase):
+    def setUp(self):
+        self.nodes = [initNode(shardIdentity('h', i), None, antiEntropyInterval=None, replicas=1) for i in range(3)]
+        self.frontend = Frontend('h', [(node._id, node._pubAddr) for node, control in self.nodes])
+        self.frontend.start()
+        self.control = ZHTControl(zmq.Context.instance(), 'h')
+
+    def tearDown(self):
+        self.control.EOF()
+        self.frontend._greenletPool.join()
+        for node, control in self.nodes:
+            node._greenletPool.join()
+            control._sock.close(linger=0)
+        self.nodes = self.frontend = self.control = None
+
+    def testFrontend(self):
+        (aNode, aControl) = self.nodes[0]
+        self.assertEqual(aControl.connect([node._repAddr for node, control in self.nodes[1:]]), ['OK'])
+        for i in range(100):
+            if len(self.frontend._routes.lookup('0')) + len(self.frontend._routes.lookup('f')) == 2:
+                break
+            gevent.sleep(0.01)
+        keys = ['key%d' % i for i in range(30)]
+        self.assertEqual(self.control.mput(dict((key, key.upper()) for key in keys)), ['OK', '30'])
+        self.assertEqual(self.control.put('asdf', 'qwer'), ['OK', 'asdf', 'qwer'])
+        self.assertEqual(self.control.get(keys + ['asdf', 'missing']),
+                         [key.upper() for key in keys] + ['qwer', 'KeyError'])
+        stored = [sum(len(bucket._entries) for bucket in node._table._buckets.values()) for node, control in self.nodes]
+        self.assertEqual(sum(stored), 31)
+        self.assertTrue(all(stored))
+        stats = self.control.stats()
+        self.assertEqual(sorted(stats['shards']), ['h#0', 'h#1', 'h#2'])
+        self.assertEqual(stats['shards']['h#0']['peers'], 2)
+
+    def testShardAddr(self):
+        self.assertEqual(shardAddr('tcp://127.0.0.1:5000', 2), 'tcp://127.0.0.1:5002')
+        self.assertEqual(shardAddr('ipc://testSockhREP', 2), 'ipc://testSockhREP-2')
+
+class TestClient(TestCase):
+    def setUp(self):
+        self.nodes = [initNode(identity, None, antiEntropyInterval=None, replicas=2) for identity in 'abc']
+        (aNode, aControl) = self.nodes[0]
+        self.assertEqual(aControl.connect(['ipc://testSockbREP', 'ipc://testSockcREP']), ['OK'])
+        for i in range(100):
+            if not any(node._incoming for node, control in self.nodes):
+                break
+            gevent.sleep(0.01)
+        self.client = ZHTClient(['ipc://testSockaREP'], timeout=1)
+
+    def tearDown(self):
+        self.client.close()
+        for node, control in self.nodes:
+            closeNode(node, control)
+        self.nodes = self.client = None
+
+    def testDirectAccess(self):
+        self.assertEqual(self.client.stats()['nodes'], 3)
+        keys = ['key%d' % i for i in range(30)]
+        self.assertEqual(self.client.mput(dict((key, key.upper()) for key in keys)), 30)
+        self.assertTrue(self.client.put('asdf', 'qwer'))
+        waitForUpdates()
+        for node, control in self.nodes:
+            self.assertEqual(control.get(keys + ['asdf']), [key.upper() for key in keys] + ['qwer'])
+        self.assertEqual(self.client.mget(keys + ['missing']), dict((key, key.upper()) for key in keys))
+        self.assertEqual(self.client.get('asdf'), 'qwer')
+        self.assertRaises(KeyError, self.client.get, 'missing')
+        reads = [gevent.spawn(self.client.get, key) for key in keys]
+        gevent.joinall(reads)
+        self.assertEqual([read.value for read in reads], [key.upper() for key in keys])
+        self.assertEqual(self.client.stats()['connections'], 3)
+        self.assertEqual(self.client.stats()['staleRoutes'], 0)
+
+    def testStaleRoutes(self):
+        (aNode, aControl) = self.nodes[0]
+        self.assertEqual(aControl.mput(dict(('key%d' % i, 'value') for i in range(30))), ['OK', '30'])
+        waitForUpdates()
+        for node, control in self.nodes:
+            self.client._routes.setPeerBuckets(node._repAddr, [] if node is aNode else ['%x' % i for i in range(16)])
+        refreshes = self.client.stats()['refreshes']
+        found = self.client.mget('key%d' % i for i in range(30))
+        self.assertEqual(found, dict(('key%d' % i, 'value') for i in range(30)))
+        stats = self.client.stats()
+        self.assertEqual(stats['staleRoutes'], 1)
+        self.assertEqual(stats['refreshes'], refreshes + 1)
+
+    def testHashMismatch(self):
+        client = ZHTClient(['ipc://testSockaREP'], hashFunction='md5', timeout=1)
+        try:
+            self.assertRaises(HashMismatch, client.put, 'asdf', 'qwer')
+            self.assertRaises(HashMismatch, client.get, 'asdf')
+        finally:
+            client.close()
+        for node, control in self.nodes:
+            self.assertEqual(control.get(['asdf']), ['KeyError'])
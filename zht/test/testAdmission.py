@@ -0,0 +1,51 @@
+from unittest import TestCase
+import gevent
+from zht.admission import WorkQueue
+
+class TestWorkQueue(TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def _work(self, i):
+        gevent.sleep(0.01)
+        self.calls.append(i)
+
+    def testConcurrency(self):
+        queue = WorkQueue('test', 2, 10)
+        for i in range(6):
+            self.assertTrue(queue.submit(self._work, i))
+        self.assertEqual(queue.stats()['active'], 2)
+        self.assertEqual(len(queue), 6)
+        queue.join()
+        self.assertEqual(sorted(self.calls), range(6))
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], stats['active'], stats['processed'], stats['shed']), (0, 0, 6, 0))
+        self.assertEqual(stats['maxDepth'], 6)
+        self.assertEqual(stats['wait']['samples'], 6)
+        self.assertTrue(stats['wait']['p99'] >= 0.02)
+
+    def testShedding(self):
+        queue = WorkQueue('test', 1, 2)
+        self.assertEqual([queue.submit(self._work, i) for i in range(4)], [True, True, False, False])
+        gevent.sleep(0)
+        self.assertTrue(queue.submit(self._work, 4))
+        queue.join()
+        self.assertEqual(self.calls, [0, 1, 4])
+        self.assertEqual(queue.stats()['shed'], 2)
+
+    def testErrors(self):
+        queue = WorkQueue('test', 1, 10)
+        queue.submit(lambda: 1 / 0)
+        queue.submit(self._work, 1)
+        queue.join()
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(queue.stats()['processed'], 2)
+
+    def testKill(self):
+        queue = WorkQueue('test', 1, 10)
+        queue.submit(self._work, 0)
+        queue.submit(self._work, 1)
+        gevent.sleep(0)
+        queue.kill()
+        self.assertEqual(queue.stats()['active'], 0)
+        self.assertEqual(self.calls, [])
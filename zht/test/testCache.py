@@ -0,0 +1,52 @@
+from unittest import TestCase
+from zht.cache import NearCache, RecentSet
+
+class TestRecentSet(TestCase):
+    def testEviction(self):
+        seen = RecentSet(3)
+        self.assertTrue(seen.add('a'))
+        self.assertFalse(seen.add('a'))
+        for item in 'bcd':
+            self.assertTrue(seen.add(item))
+        self.assertEqual(len(seen), 3)
+        self.assertFalse('a' in seen)
+        self.assertTrue('d' in seen)
+        self.assertTrue(seen.add('a'))
+
+class TestNearCache(TestCase):
+    def setUp(self):
+        self.cache = NearCache(20)
+
+    def tearDown(self):
+        self.cache = None
+
+    def testLRU(self):
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('a', '1f', '12345', 1.0)
+        self.cache.put('b', '2f', '12345', 1.0)
+        self.cache.put('c', '3f', '12345', 1.0)
+        self.assertEqual(self.cache.get('a'), ('12345', 1.0))
+        self.cache.put('d', '4f', '12345', 1.0)
+        self.assertFalse('b' in self.cache)
+        self.assertTrue('a' in self.cache)
+        self.assertEqual(self.cache.prefixes(), set(['1', '3', '4']))
+        self.assertEqual(self.cache.stats(), {'entries': 3, 'bytes': 18, 'hits': 1, 'misses': 1, 'hitRate': 0.5})
+        self.cache.put('e', '5f', 'x' * 30, 1.0)
+        self.assertFalse('e' in self.cache)
+
+    def testUpdate(self):
+        self.assertFalse(self.cache.update('a', 'new', 2.0))
+        self.cache.put('a', '1f', 'old', 1.0)
+        self.assertTrue(self.cache.update('a', 'new', 2.0))
+        self.assertFalse(self.cache.update('a', 'older', 0.5))
+        self.cache.put('a', '1f', 'stale', 1.5)
+        self.assertEqual(self.cache.get('a'), ('new', 2.0))
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.prefixes(), set())
+
+    def testTTL(self):
+        cache = NearCache(20, ttl=-1)
+        cache.put('a', '1f', '1', 1.0)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
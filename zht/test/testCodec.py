@@ -0,0 +1,44 @@
+from unittest import TestCase
+from zht.codec import CODECS, detect, negotiate
+from zht.table import Table
+
+class TestCodecs(TestCase):
+    def setUp(self):
+        self.table = Table()
+        for i in range(50):
+            self.table.putValue('key%d' % i, 'value\x00%d' % i, 1000.0 + i / 7.0)
+        self.entries = list(self.table.getEntries(''))
+
+    def tearDown(self):
+        self.table = self.entries = None
+
+    def testRoundTrip(self):
+        for name, codec in CODECS.items():
+            peers = {'a': 'ipc://a', 'b': 'tcp://127.0.0.1:5555'}
+            self.assertEqual(detect([codec.encodePeers(peers)]).decodePeers(codec.encodePeers(peers)), peers)
+            buckets = ['0', '1f', 'abc']
+            self.assertEqual(sorted(codec.decodeBuckets(codec.encodeBuckets(buckets))), buckets)
+            keys = codec.decodeKeys(codec.encodeKeys(self.entries))
+            self.assertEqual(sorted(keys), sorted((e._key, e._timestamp, e._hash) for e in self.entries))
+            levels = {'': [0, 2 ** 64 - 1], '3a': [12345]}
+            self.assertEqual(codec.decodeTree(codec.encodeTree(levels)), levels)
+            frames = codec.encodeValues(self.entries)
+            self.assertEqual(detect(frames).name, name)
+            self.assertEqual(detect(frames).decodeValues(frames),
+                             [(e._key, e._value, e._timestamp) for e in self.entries])
+            stores = [(e._key, e._hash, e._value, e._timestamp) for e in self.entries]
+            frames = codec.encodeStores(stores)
+            self.assertEqual(detect(frames).name, name)
+            self.assertEqual(detect(frames).decodeStores(frames), stores)
+
+    def testEmpty(self):
+        for name, codec in CODECS.items():
+            self.assertEqual(detect(codec.encodeValues([])).decodeValues(codec.encodeValues([])), [])
+            self.assertEqual(codec.decodeKeys(codec.encodeKeys([])), [])
+
+    def testNegotiate(self):
+        self.assertEqual(negotiate("bin1,json", ['bin1', 'json']).name, 'bin1')
+        self.assertEqual(negotiate("bin1,json", ['json']).name, 'json')
+        self.assertEqual(negotiate("json", ['bin1', 'json']).name, 'json')
+        self.assertEqual(negotiate("", ['bin1', 'json']).name, 'json')
+        self.assertEqual(negotiate("bin9,bin1", ['bin1', 'json']).name, 'bin1')
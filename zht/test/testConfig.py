@@ -14,4 +14,8 @@ class TestConfig(TestCase):
         self.assertEqual(c.identity, 'a')
         self.assertEqual(c.bindAddrREP, 'ipc://socks/aREP')
         self.assertEqual(c.bindAddrPUB, 'ipc://socks/aPUB')
-    
+
+    def testNodeOptions(self):
+        args = ['-C', 'zht/test/zhtrc', '--antiEntropyInterval', '2.5']
+        c = ZHTConfig(args)
+        self.assertEqual(c.nodeOptions(), {'splitEntries': 1000, 'antiEntropyInterval': 2.5})
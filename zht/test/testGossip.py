@@ -0,0 +1,29 @@
+from unittest import TestCase
+from zht.gossip import PartialView
+
+class TestPartialView(TestCase):
+    def testBounded(self):
+        view = PartialView(2)
+        self.assertTrue(view.add('a'))
+        self.assertTrue(view.add('b'))
+        self.assertTrue(view.isFull())
+        self.assertFalse(view.add('c'))
+        self.assertTrue(view.add('a'))
+        self.assertEqual(len(view), 2)
+        self.assertFalse('c' in view)
+        view.remove('a')
+        self.assertFalse(view.isFull())
+        self.assertEqual(view.stats(), {'active': 1, 'size': 2})
+
+    def testCandidates(self):
+        view = PartialView(3)
+        view.add('a')
+        self.assertEqual(sorted(view.candidates(['a', 'b', 'c', 'self'], ['self'])), ['b', 'c'])
+
+    def testSample(self):
+        view = PartialView(3)
+        known = dict(('n%d' % i, 'ipc://n%d' % i) for i in range(10))
+        sample = view.sample(known, 4)
+        self.assertEqual(len(sample), 4)
+        self.assertTrue(all(known[identity] == addr for identity, addr in sample.items()))
+        self.assertEqual(view.sample({'a': 'ipc://a'}, 4), {'a': 'ipc://a'})
@@ -0,0 +1,20 @@
+from unittest import TestCase
+from zht.latency import LatencyTracker
+
+class TestLatencyTracker(TestCase):
+    def testPercentile(self):
+        tracker = LatencyTracker()
+        self.assertEqual(tracker.percentile(50), None)
+        for i in range(100, 0, -1):
+            tracker.add(i / 1000.0)
+        self.assertEqual(len(tracker), 100)
+        self.assertEqual(tracker.percentile(50), 0.05)
+        self.assertEqual(tracker.percentile(95), 0.095)
+        self.assertEqual(tracker.percentile(100), 0.1)
+        self.assertEqual(tracker.percentile(0), 0.001)
+
+    def testWindow(self):
+        tracker = LatencyTracker(10)
+        for i in range(20):
+            tracker.add(float(i))
+        self.assertEqual(tracker.stats(), {'samples': 10, 'p50': 14.0, 'p95': 19.0, 'p99': 19.0})
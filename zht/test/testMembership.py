@@ -0,0 +1,43 @@
+from unittest import TestCase
+from zht.membership import Membership, PhiAccrualDetector
+
+class TestPhiAccrualDetector(TestCase):
+    def testPhi(self):
+        detector = PhiAccrualDetector(1.0, now=100.0)
+        for i in range(1, 11):
+            detector.heartbeat(100.0 + i)
+        self.assertTrue(detector.phi(110.5) < 0.1)
+        self.assertTrue(detector.phi(111.0) < 1)
+        self.assertTrue(detector.phi(111.5) > 5)
+        self.assertTrue(detector.phi(113.0) > 12)
+        self.assertTrue(detector.phi(111.2) < detector.phi(111.3))
+
+    def testIrregular(self):
+        regular = PhiAccrualDetector(1.0, now=0.0)
+        irregular = PhiAccrualDetector(1.0, now=0.0)
+        for i in range(1, 21):
+            regular.heartbeat(float(i))
+            irregular.heartbeat(i + (0.3 if i % 2 else 0.0))
+        self.assertTrue(irregular.phi(21.6) < regular.phi(21.6))
+
+class TestMembership(TestCase):
+    def testStates(self):
+        members = Membership(1.0, suspectPhi=5, deadPhi=12)
+        members.add('a', now=0.0)
+        members.add('b', now=0.0)
+        for i in range(1, 11):
+            members.heartbeat('a', float(i))
+            members.heartbeat('b', float(i))
+        members.heartbeat('a', 11.0)
+        self.assertEqual(members.update(11.0), [])
+        self.assertEqual(members.update(11.6), [('b', 'alive', 'suspect')])
+        self.assertFalse(members.isAlive('b'))
+        self.assertTrue(members.isAlive('a'))
+        self.assertEqual(sorted(members.update(14.0)), [('a', 'alive', 'dead'), ('b', 'suspect', 'dead')])
+        members.heartbeat('b', 14.0)
+        self.assertEqual(members.state('b', 14.0), 'alive')
+        self.assertEqual(members.view(14.0)['b']['state'], 'alive')
+        members.remove('b')
+        self.assertFalse('b' in members)
+        self.assertTrue(members.isAlive('b'))
+        self.assertEqual(len(members), 1)
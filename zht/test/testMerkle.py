@@ -0,0 +1,51 @@
+from unittest import TestCase
+from zht.merkle import HashTree, entryDigest
+from zht.table import Table, hex_hash
+
+class TestHashTree(TestCase):
+    def setUp(self):
+        self.tree = HashTree(2)
+
+    def tearDown(self):
+        self.tree = None
+
+    def testUpdate(self):
+        digest = entryDigest(hex_hash('asdf'), 1.0)
+        self.tree.update('3f', 0, digest)
+        self.assertEqual(self.tree.digest(), digest)
+        self.assertEqual(self.tree.digest('3'), digest)
+        self.assertEqual(self.tree.digest('3f'), digest)
+        self.assertEqual(self.tree.digest('3e'), 0)
+        self.assertEqual(self.tree.children('3'), [0] * 15 + [digest])
+        self.tree.update('3f', digest, 0)
+        self.assertEqual(self.tree.digest(), 0)
+        self.assertEqual(self.tree.digest('3f'), 0)
+
+class TestTableTree(TestCase):
+    def setUp(self):
+        self.a = Table()
+        self.b = Table()
+
+    def tearDown(self):
+        self.a = self.b = None
+
+    def testIdenticalTables(self):
+        for i in range(100):
+            self.a.putValue('key%d' % i, 'value', float(i))
+            self.b.putValue('key%d' % (99 - i), 'value', float(99 - i))
+        self.assertNotEqual(self.a.treeDigest(''), 0)
+        self.assertEqual(self.a.treeDigest(''), self.b.treeDigest(''))
+        self.assertEqual(self.a.treeChildren(''), self.b.treeChildren(''))
+
+    def testDifferingEntry(self):
+        for i in range(100):
+            self.a.putValue('key%d' % i, 'value', 1.0)
+            self.b.putValue('key%d' % i, 'value', 1.0)
+        self.b.putValue('key7', 'newer', 2.0)
+        h = hex_hash('key7')
+        for length in range(self.a._treeDepth + 1):
+            self.assertNotEqual(self.a.treeDigest(h[:length]), self.b.treeDigest(h[:length]))
+        differing = [digit for digit, x, y in zip('0123456789abcdef', self.a.treeChildren(h[:2]),
+                                                  self.b.treeChildren(h[:2])) if x != y]
+        self.assertEqual(differing, [h[2]])
+        self.assertEqual(self.b.getKeySet(h[:3], True), {'key7': 2.0})
@@ -0,0 +1,52 @@
+import gevent
+from unittest import TestCase
+from zht.migration import Migration, TokenBucket
+
+class TestTokenBucket(TestCase):
+    def testUnlimited(self):
+        bucket = TokenBucket(None)
+        self.assertEqual(bucket.take(10 ** 9), 0.0)
+
+    def testRate(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.take(1000), 0.0)
+        self.assertAlmostEqual(bucket.take(100), 0.1, places=2)
+        self.assertAlmostEqual(bucket.take(200), 0.2, places=2)
+
+    def testBurst(self):
+        bucket = TokenBucket(1000, burst=100)
+        self.assertAlmostEqual(bucket.take(200), 0.1, places=2)
+
+class RefusingPeer(object):
+    """
+    A Peer that accepts every MIGRATE request but refuses to take the partition over.
+    """
+    _id = 'b'
+
+    def migrate(self, partition, chunk):
+        return len(chunk)
+
+    def migrated(self, partition):
+        gevent.sleep(0.01)
+        return False
+
+class StubTable(object):
+    def getEntries(self, partition, since=None):
+        return []
+
+class StubNode(object):
+    def __init__(self):
+        self._peers = {'b': RefusingPeer()}
+        self._table = StubTable()
+
+    def _migrationTargets(self, partition):
+        return ['b']
+
+    def spawn(self, func, *args):
+        return gevent.spawn(func, *args)
+
+class TestMigration(TestCase):
+    def testHandOverRefused(self):
+        migration = Migration(StubNode(), '0', TokenBucket(None), timeout=0.2)
+        gevent.with_timeout(5, migration.run)
+        self.assertEqual(migration.state, 'failed')
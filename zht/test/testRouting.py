@@ -0,0 +1,60 @@
+from unittest import TestCase
+from zht.routing import RoutingTable, rendezvousOwners, hostIdentity
+
+class TestRoutingTable(TestCase):
+    def setUp(self):
+        self.routes = RoutingTable()
+
+    def tearDown(self):
+        self.routes = None
+
+    def testLookup(self):
+        self.routes.setPeerBuckets('a', ['0', '1'])
+        self.routes.setPeerBuckets('b', ['1', 'f'])
+        self.assertEqual(self.routes.lookup('0abc'), set(['a']))
+        self.assertEqual(self.routes.lookup('1abc'), set(['a', 'b']))
+        self.assertEqual(self.routes.lookup('fabc'), set(['b']))
+        self.assertEqual(self.routes.lookup('7abc'), set())
+
+    def testMixedDepth(self):
+        self.routes.setPeerBuckets('a', ['a'])
+        self.routes.setPeerBuckets('b', ['a3', 'a41'])
+        self.assertEqual(self.routes.lookup('a3ff'), set(['a', 'b']))
+        self.assertEqual(self.routes.lookup('a41f'), set(['a', 'b']))
+        self.assertEqual(self.routes.lookup('a42f'), set(['a']))
+
+    def testUpdateAndRemove(self):
+        self.routes.setPeerBuckets('a', ['0', '1'])
+        self.routes.setPeerBuckets('a', ['2'])
+        self.assertEqual(self.routes.lookup('0abc'), set())
+        self.assertEqual(self.routes.lookup('2abc'), set(['a']))
+        self.routes.removePeer('a')
+        self.assertEqual(self.routes.lookup('2abc'), set())
+        self.assertEqual(len(self.routes), 0)
+        self.assertEqual(self.routes._root.children, {})
+
+class TestRendezvous(TestCase):
+    def testOwners(self):
+        nodes = ['node%d' % i for i in range(10)]
+        partitions = ['%x' % i for i in range(16)]
+        owners = dict((p, rendezvousOwners(p, nodes, 3)) for p in partitions)
+        for p in partitions:
+            self.assertEqual(len(set(owners[p])), 3)
+            self.assertEqual(rendezvousOwners(p, reversed(nodes), 3), owners[p])
+        grown = dict((p, rendezvousOwners(p, nodes + ['node10'], 3)) for p in partitions)
+        for p in partitions:
+            self.assertEqual([n for n in grown[p] if n != 'node10'], owners[p][:len(grown[p]) - ('node10' in grown[p])])
+        self.assertEqual(rendezvousOwners('0', ['a'], 3), ['a'])
+
+    def testHosts(self):
+        nodes = ['host%d#%d' % (host, shard) for host in range(4) for shard in range(4)]
+        partitions = ['%x' % i for i in range(16)]
+        for p in partitions:
+            owners = rendezvousOwners(p, nodes, 3)
+            self.assertEqual(len(set(hostIdentity(owner) for owner in owners)), 3)
+        for host in range(4):
+            shards = [node for node in nodes if hostIdentity(node) == 'host%d' % host]
+            owned = [p for p in partitions for shard in shards if shard in rendezvousOwners(p, nodes, 3)]
+            self.assertEqual(len(owned), len(set(owned)))
+        self.assertEqual(sorted(rendezvousOwners('0', ['a#0', 'a#1', 'b'], 3)), ['a#0', 'a#1', 'b'])
+        self.assertEqual(hostIdentity('a'), 'a')
@@ -0,0 +1,75 @@
+from unittest import TestCase
+from zht.storage import LogStorage
+from zht.table import Table
+import os
+import shutil
+import tempfile
+
+class TestLogStorage(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def openTable(self, hashFunction='sha1'):
+        """
+        Open a Table backed by the storage directory, returning it and the marks loaded.
+        """
+        storage = LogStorage(self.path, fsyncPolicy='never')
+        table = Table(splitEntries=4, hashFunction=hashFunction)
+        marks = storage.load(table)
+        table._storage = storage
+        return table, marks
+
+    def assertTablesEqual(self, a, b):
+        self.assertEqual(a.getKeySet(''), b.getKeySet(''))
+        for key in a.getKeySet(''):
+            self.assertEqual(a.getValue(key)._value, b.getValue(key)._value)
+        self.assertEqual(a.treeDigest(''), b.treeDigest(''))
+
+    def testLogReplay(self):
+        table, marks = self.openTable()
+        self.assertEqual(marks, {})
+        for i in range(20):
+            table.putValue('key%d' % i, 'value%d' % i, 1.0)
+        table.putValue('key0', 'newer', 2.0)
+        table.putValue('key1', 'older', 0.5)
+        table._storage.close()
+        reopened, marks = self.openTable()
+        self.assertTablesEqual(table, reopened)
+        self.assertEqual(reopened.getValue('key0')._value, 'newer')
+        self.assertEqual(reopened.getValue('key1')._value, 'value1')
+
+    def testSnapshot(self):
+        table, marks = self.openTable()
+        for i in range(20):
+            table.putValue('key%d' % i, 'value%d' % i, 1.0)
+        table._storage.snapshot(table, {('b', '0'): 'abcd:1.0'})
+        table.putValue('key0', 'newer', 2.0)
+        table._storage.close()
+        self.assertEqual(sorted(os.listdir(self.path)), ['log-2', 'meta.json', 'snapshot-2'])
+        reopened, marks = self.openTable()
+        self.assertTablesEqual(table, reopened)
+        self.assertEqual(marks, {('b', '0'): 'abcd:1.0'})
+
+    def testTruncatedLog(self):
+        table, marks = self.openTable()
+        table.putValue('a', '1', 1.0)
+        table.putValue('b', '2', 1.0)
+        table._storage.close()
+        path = os.path.join(self.path, 'log-1')
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        reopened, marks = self.openTable()
+        self.assertEqual(reopened.getKeySet(''), {'a': 1.0})
+
+    def testHashFunctionChange(self):
+        table, marks = self.openTable()
+        table.putValue('a', '1', 1.0)
+        table._storage.close()
+        reopened, marks = self.openTable('md5')
+        self.assertEqual(reopened.getValue('a')._hash, reopened.keyHash('a'))
+        reopened._storage.close()
+        reopened, marks = self.openTable('md5')
+        self.assertEqual(reopened.getValue('a')._hash, reopened.keyHash('a'))
@@ -0,0 +1,102 @@
+from unittest import TestCase
+from zht.merkle import entryDigest
+from zht.table import Table
+
+class TestTable(TestCase):
+    def setUp(self):
+        self.table = Table()
+
+    def tearDown(self):
+        self.table = None
+
+    def testPutValue(self):
+        self.assertTrue(self.table.putValue('asdf', 'qwer', 2.0))
+        self.assertFalse(self.table.putValue('asdf', 'older', 1.0))
+        self.assertEqual(self.table['asdf'], 'qwer')
+        self.assertRaises(KeyError, self.table.getValue, 'zxcv')
+
+    def testKeySetSince(self):
+        prefix = self.table._getKeyHashPrefix('asdf')
+        self.table.putValue('asdf', 'qwer', 1.0)
+        since = self.table.getValue('asdf')._modified
+        self.assertEqual(self.table.getKeySet(prefix, since), {'asdf': 1.0})
+        self.assertEqual(self.table.getKeySet(prefix, since + 1), {})
+        self.table.putValue('asdf', 'newer', 2.0)
+        later = self.table.getValue('asdf')._modified
+        self.assertEqual(self.table.getKeySet(prefix, later), {'asdf': 2.0})
+        self.assertEqual(self.table.getKeySet(prefix, True), {'asdf': 2.0})
+
+    def testModificationIndexCompaction(self):
+        for i in range(100):
+            self.table.putValue('asdf', str(i), float(i))
+        bucket = self.table._getKeyBucket('asdf')
+        self.assertTrue(len(bucket._modTimes) <= 2)
+        self.assertEqual([entry._value for entry in bucket.modifiedSince(0)], ['99'])
+
+class TestBucketSplit(TestCase):
+    def setUp(self):
+        self.table = Table(splitEntries=20)
+        self.unsplit = Table()
+
+    def tearDown(self):
+        self.table = self.unsplit = None
+
+    def testSplit(self):
+        for i in range(1000):
+            self.table.putValue('key%d' % i, 'value%d' % i, float(i))
+            self.unsplit.putValue('key%d' % i, 'value%d' % i, float(i))
+        self.assertTrue(self.table._maxPrefixLength > 1)
+        self.assertTrue(all(len(bucket._entries) <= 20 for bucket in self.table._buckets.values()))
+        self.assertEqual(sorted(self.table.ownedBuckets()), sorted(self.table._buckets))
+        for i in range(1000):
+            self.assertEqual(self.table['key%d' % i], 'value%d' % i)
+        self.assertEqual(self.table.getKeySet(''), self.unsplit.getKeySet(''))
+        self.assertEqual(self.table.getKeySet('a'), self.unsplit.getKeySet('a'))
+        self.assertEqual(self.table.getKeySet('ab'), self.unsplit.getKeySet('ab'))
+        for prefix in ('', 'a', 'ab', 'abc'):
+            self.assertEqual(self.table.treeDigest(prefix), self.unsplit.treeDigest(prefix))
+        for prefix in ('', 'a', 'ab'):
+            self.assertEqual(self.table.treeChildren(prefix), self.unsplit.treeChildren(prefix))
+
+    def testSplitKeepsModificationOrder(self):
+        for i in range(100):
+            self.table.putValue('key%d' % i, 'value', float(i))
+        since = self.table.getValue('key50')._modified
+        keys = set(self.table.getKeySet('', since))
+        self.assertTrue(set('key%d' % i for i in range(50, 100)) <= keys)
+        self.assertTrue(all(self.table.getValue(key)._modified >= since for key in keys))
+
+    def testSharedPrefixes(self):
+        for i in range(1000):
+            self.table.putValue('key%d' % i, 'value', float(i))
+        split = [prefix for prefix in self.table.ownedBuckets() if prefix.startswith('a')]
+        self.assertEqual(self.table.sharedPrefixes(['a']), set(prefix[:3] for prefix in split))
+        self.assertEqual(self.unsplit.sharedPrefixes(split), set(split))
+
+class TestOwnership(TestCase):
+    def setUp(self):
+        self.table = Table(splitEntries=16)
+        for i in range(100):
+            self.table['key%d' % i] = 'value%d' % i
+
+    def tearDown(self):
+        self.table = None
+
+    def testSetOwned(self):
+        keyHash = self.table.keyHash('key0')
+        partition = keyHash[0]
+        others = set('%x' % i for i in range(16)) - set([partition])
+        self.assertEqual(self.table.setOwned(others), (set(), set([partition])))
+        self.assertEqual(self.table.ownedPartitions(), others)
+        self.assertFalse(self.table.owns('key0'))
+        self.assertEqual(self.table.getValue('key0')._value, 'value0')
+        self.assertTrue(len(self.table.partitionEntries(partition)) > 0)
+        self.table.clearPartition(partition)
+        self.assertEqual(self.table.partitionEntries(partition), [])
+        self.assertRaises(NotImplementedError, self.table.getValue, 'key0')
+        self.assertRaises(NotImplementedError, self.table.putValue, 'key0', 'value', 1.0)
+        self.assertEqual(self.table.setOwned(others | set([partition])), (set([partition]), set()))
+        self.assertRaises(KeyError, self.table.getValue, 'key0')
+        self.table['key0'] = 'again'
+        entry = self.table.getValue('key0')
+        self.assertEqual(self.table.treeDigest(partition), entryDigest(entry._hash, entry._timestamp))